@@ -0,0 +1,266 @@
+# Authors: Yutong Zhao <proteneer@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Microbenchmarks of cc.apollo against a throwaway local redis-server.
+
+    python -m benchmarks.bench_apollo --sizes 100 1000 --output before.json
+
+Every benchmark is run at each size and reports operations per second, as
+well as the round trips, commands and bytes sent per operation recorded by
+apollo.instrument. Results are printed as a table, and written as JSON if
+--output is given, so that runs on different commits can be compared.
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import redis
+
+import cc.apollo as apollo
+
+
+class Person(apollo.Entity):
+    prefix = 'bench_person'
+    fields = {'age': int,
+              'ssn': str,
+              'emails': {str},
+              }
+
+
+class Cat(apollo.Entity):
+    prefix = 'bench_cat'
+    fields = {'age': int,
+              'queue': apollo.zset(str),
+              }
+
+
+Person.add_lookup('ssn')
+Person.add_lookup('emails')
+apollo.relate(Person, 'cats', {Cat}, 'owner')
+
+
+def _person_items(size):
+    return [(str(i), {'age': i, 'ssn': 'ssn'+str(i),
+                      'emails': {str(i)+'@bench.com'}}) for i in range(size)]
+
+
+def _cats(db, size):
+    Cat.create_many([('cat'+str(i), {}) for i in range(size)], db)
+    return ['cat'+str(i) for i in range(size)]
+
+
+# Each benchmark prepares the db for a given size, and returns a function
+# performing the measured operations along with how many operations it does.
+
+def bench_create(db, size):
+    items = _person_items(size)
+
+    def run():
+        for id, fields in items:
+            Person.create(id, db, fields)
+    return run, size
+
+
+def bench_create_many(db, size):
+    items = _person_items(size)
+
+    def run():
+        Person.create_many(items, db)
+    return run, size
+
+
+def bench_hget(db, size):
+    Person.create_many(_person_items(size), db)
+    persons = [Person(str(i), db) for i in range(size)]
+
+    def run():
+        for person in persons:
+            person.hget('age')
+    return run, size
+
+
+def bench_load_many(db, size):
+    Person.create_many(_person_items(size), db)
+    ids = [str(i) for i in range(size)]
+
+    def run():
+        Person.load_many(ids, db)
+    return run, size
+
+
+def bench_lookup(db, size):
+    Person.create_many(_person_items(size), db)
+
+    def run():
+        for i in range(size):
+            Person.lookup('ssn', 'ssn'+str(i), db)
+    return run, size
+
+
+def bench_relation_sadd(db, size):
+    """ sadd then srem size cats to a person, one cat per call """
+    joe = Person.create('joe', db)
+    cats = _cats(db, size)
+
+    def run():
+        for cat in cats:
+            joe.sadd('cats', cat)
+        for cat in cats:
+            joe.srem('cats', cat)
+    return run, 2*size
+
+
+def bench_relation_sadd_bulk(db, size):
+    """ sadd then srem size cats to a person in a single call each """
+    joe = Person.create('joe', db)
+    cats = _cats(db, size)
+
+    def run():
+        joe.sadd('cats', *cats)
+        joe.srem('cats', *cats)
+    return run, 2
+
+
+def bench_delete(db, size):
+    Person.create_many(_person_items(size), db)
+    for i, cat in enumerate(_cats(db, size)):
+        Cat(cat, db).hset('owner', Person(str(i), db))
+    persons = [Person(str(i), db) for i in range(size)]
+
+    def run():
+        for person in persons:
+            person.delete()
+    return run, size
+
+
+def bench_delete_many(db, size):
+    Person.create_many(_person_items(size), db)
+    ids = [str(i) for i in range(size)]
+
+    def run():
+        Person.delete_many(ids, db)
+    return run, size
+
+
+def bench_zrevpop(db, size):
+    cat = Cat.create('kitty', db)
+    cat.zadd('queue', *[x for i in range(size) for x in (str(i), i)])
+
+    def run():
+        for i in range(size):
+            cat.zrevpop('queue')
+    return run, size
+
+
+def bench_zrevpop_batch(db, size):
+    cat = Cat.create('kitty', db)
+    cat.zadd('queue', *[x for i in range(size) for x in (str(i), i)])
+
+    def run():
+        cat.zrevpop('queue', count=size)
+    return run, 1
+
+
+BENCHMARKS = [(name[len('bench_'):], func) for name, func in
+              sorted(globals().items()) if name.startswith('bench_')]
+
+
+def measure(db, func, size, repeat):
+    """ Returns the best of repeat runs of func at size """
+    best = None
+    for attempt in range(repeat):
+        db.flushdb()
+        run, ops = func(db, size)
+        with apollo.instrument() as stats:
+            start = time.perf_counter()
+            run()
+            seconds = time.perf_counter() - start
+        if best is None or seconds < best['seconds']:
+            best = {'size': size,
+                    'ops': ops,
+                    'seconds': seconds,
+                    'ops_per_sec': ops/seconds,
+                    'round_trips_per_op': stats.round_trips/ops,
+                    'commands_per_op': stats.commands/ops,
+                    'bytes_sent_per_op': stats.bytes_sent/ops}
+    return best
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per benchmark, the best one is kept')
+    parser.add_argument('--port', type=int, default=3830)
+    parser.add_argument('--redis-server', default='redis-server')
+    parser.add_argument('--only', nargs='+', default=None,
+                        help='names of the benchmarks to run')
+    parser.add_argument('--output', help='write the results as JSON here')
+    args = parser.parse_args(argv)
+
+    redis_process = subprocess.Popen(
+        [args.redis_server, '--port', str(args.port), '--save', ''],
+        stdout=open(os.devnull, 'w'))
+    try:
+        db = apollo.connect(port=args.port, instrument=True)
+        for i in range(50):
+            try:
+                db.ping()
+                break
+            except redis.exceptions.ConnectionError:
+                time.sleep(0.1)
+        report = {'commit': _commit(),
+                  'python': platform.python_version(),
+                  'redis_py': redis.__version__,
+                  'redis_server': db.info()['redis_version'],
+                  'results': []}
+        print('%-22s %7s %12s %14s' % ('benchmark', 'size', 'ops/s',
+                                       'round trips/op'), file=sys.stderr)
+        for name, func in BENCHMARKS:
+            if args.only and name not in args.only:
+                continue
+            for size in args.sizes:
+                result = measure(db, func, size, args.repeat)
+                result['name'] = name
+                report['results'].append(result)
+                print('%-22s %7d %12.1f %14.2f' % (
+                      name, size, result['ops_per_sec'],
+                      result['round_trips_per_op']), file=sys.stderr)
+    finally:
+        redis_process.terminate()
+        redis_process.wait()
+
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(report, handle, indent=2, sort_keys=True)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,832 @@
+# Authors: Yutong Zhao <proteneer@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" asyncio flavor of apollo. Entities are declared exactly as in apollo, but
+subclass aioapollo.Entity and are used with a redis.asyncio client, so that
+no call blocks the event loop. Tornado 5 and later run on the asyncio event
+loop, so these methods can be awaited from Tornado coroutines as well.
+
+Every operation that reads before it writes (create, hset, sadd, delete, ...)
+reuses apollo's plans, so the relation and lookup semantics are identical.
+
+Example:
+
+    class Person(aioapollo.Entity):
+        prefix = 'person'
+        fields = {'age': int, 'ssn': str}
+
+    Person.add_lookup('ssn')
+
+    db = redis.asyncio.Redis(decode_responses=True)
+    joe = await Person.create('joe', db, {'age': 25})
+    async with aioapollo.pipeline(db) as pipe:
+        await joe.hset('ssn', '123', pipeline=pipe)
+        await joe.hincrby('age', 1)
+
+Entities declared with hash_tags = True can also be used with a
+redis.asyncio.cluster.RedisCluster client. Redis cluster cannot WATCH or run
+MULTI/EXEC across slots, so on a cluster the writes of an operation are split
+by slot and committed with one MULTI/EXEC per slot, and the keys read are not
+watched. Every write made to a single entity is then still atomic, while a
+relation between two entities is updated by two transactions. Use
+aioapollo.close to close a cluster client, as the transactions are run on
+connections to its nodes.
+
+This module requires Python 3.7 and redis-py 5.0.1 or later. They are not
+part of the cc stack, which stays on the versions of requirements.txt, so its
+dependencies are pinned separately in requirements-aio.txt. apollo supports
+those versions as well.
+
+"""
+
+from functools import wraps
+import collections
+import contextvars
+import inspect
+import time
+import redis.asyncio
+import redis.asyncio.connection
+import redis.commands
+import redis.exceptions
+from redis.crc import key_slot
+
+try:
+    from redis.asyncio.cluster import RedisCluster
+except ImportError:
+    RedisCluster = None
+
+from cc import apollo
+from cc.apollo import check_field, zset, relate, instrument, call_stats, \
+    pool_stats
+
+
+# the outermost aioapollo method run by the current task, see _traced
+_instrument_method = contextvars.ContextVar('aioapollo_instrument_method',
+                                            default=None)
+
+
+def _traced(func):
+    """ apollo._traced for coroutine functions. The method name is tracked
+    per task, so that the round trips of concurrent tasks are recorded under
+    their own methods. """
+    name = func.__qualname__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        result = func(*args, **kwargs)
+        if not apollo._scopes() or _instrument_method.get() is not None or \
+                not inspect.isawaitable(result):
+            return result
+        return _traced_await(result, name)
+    return wrapper
+
+
+async def _traced_await(awaitable, name):
+    token = _instrument_method.set(name)
+    try:
+        return await awaitable
+    finally:
+        _instrument_method.reset(token)
+
+
+async def _arun(plan, pipeline=None):
+    """ Drive an apollo plan, awaiting each pipeline of reads it yields. If
+    pipeline belongs to a transaction, the keys read are watched first. """
+    watcher = getattr(pipeline, 'apollo_watcher', None)
+    try:
+        reads = next(plan)
+        while True:
+            keys = apollo._read_keys(reads) if watcher is not None else ()
+            if keys:
+                await watcher.watch(*keys)
+            reads = plan.send(await reads.execute())
+    except StopIteration as stop:
+        return stop.value
+
+
+def _slot_groups(command_stack):
+    """ Group the (args, options) of command_stack by the hash slot of their
+    first key, keeping their order. Returns a list of (slot, [(position,
+    args, options)]) in the order the slots first appear. """
+    groups = collections.OrderedDict()
+    for position, (args, options) in enumerate(command_stack):
+        key = args[1]
+        if isinstance(key, str):
+            key = key.encode()
+        slot = key_slot(key)
+        groups.setdefault(slot, []).append((position, args, options))
+    return list(groups.items())
+
+
+def _is_cluster(db):
+    return RedisCluster is not None and isinstance(db, RedisCluster)
+
+
+class _cluster_writes(redis.commands.CoreCommands):
+    """ Buffers the writes queued by apollo methods for _cluster_transact """
+
+    def __init__(self):
+        self.command_stack = []
+
+    def execute_command(self, *args, **options):
+        self.command_stack.append((args, options))
+        return self
+
+
+def _node_client(db, node):
+    """ Returns a redis.asyncio.Redis connected to node of the cluster db,
+    created once per node. The cluster pipeline of redis-py 5 and earlier
+    refuses MULTI/EXEC, even when every key is in the same slot, so the
+    transactions of _cluster_transact are run on the node itself. """
+    clients = getattr(db, 'apollo_node_clients', None)
+    if clients is None:
+        clients = db.apollo_node_clients = dict()
+    client = clients.get(node.name)
+    if client is None:
+        pool = redis.asyncio.ConnectionPool(
+            connection_class=node.connection_class,
+            max_connections=node.max_connections, **node.connection_kwargs)
+        client = redis.asyncio.Redis(connection_pool=pool)
+        clients[node.name] = client
+    return client
+
+
+async def close(db):
+    """ Close the client db, along with the node connections opened by
+    aioapollo if it is a cluster client, see _node_client """
+    for client in getattr(db, 'apollo_node_clients', dict()).values():
+        await client.connection_pool.disconnect()
+    await db.aclose()
+
+
+async def _cluster_transact(db, func):
+    """ _transact on a redis cluster: func runs without watching the keys it
+    reads, and its writes are committed using one MULTI/EXEC per slot, on the
+    connection of the node serving the slot. The replies are returned in the
+    order the writes were queued. A slot being migrated fails the transaction
+    with a redis.exceptions.ResponseError. """
+    writes = _cluster_writes()
+    result = await func(writes)
+    replies = [None]*len(writes.command_stack)
+    for slot, commands in _slot_groups(writes.command_stack):
+        node = db.get_node_from_key(commands[0][1][1])
+        pipeline = _node_client(db, node).pipeline(transaction=True)
+        for position, args, options in commands:
+            pipeline.execute_command(*args, **options)
+        for (position, args, options), reply in zip(
+                commands, await pipeline.execute()):
+            replies[position] = reply
+    apollo._commit_invalidations(writes)
+    return result, replies
+
+
+async def _transact(db, func, watch=(), retries=16):
+    """ See apollo._transact, func is a coroutine function. On a cluster,
+    see _cluster_transact, watch and retries are ignored. """
+    if _is_cluster(db):
+        return await _cluster_transact(db, func)
+    for attempt in range(retries):
+        watcher = db.pipeline()
+        pipeline = db.pipeline()
+        try:
+            if watch:
+                await watcher.watch(*watch)
+            pipeline.apollo_watcher = watcher
+            result = await func(pipeline)
+            watcher.multi()
+            for script in pipeline.scripts:
+                watcher.scripts.add(script)
+            for args, options in pipeline.command_stack:
+                watcher.execute_command(*args, **options)
+            replies = await watcher.execute()
+            apollo._commit_invalidations(pipeline)
+            return result, replies
+        except redis.exceptions.WatchError:
+            continue
+        finally:
+            await watcher.reset()
+            await pipeline.reset()
+    raise redis.exceptions.WatchError('transaction aborted '+str(retries)+
+                                      ' times')
+
+
+@_traced
+async def transaction(db, func, watch=(), retries=16):
+    """ asyncio version of apollo.transaction, func is a coroutine function
+    that is awaited with the pipeline. """
+    return (await _transact(db, func, watch, retries))[0]
+
+
+async def _run_script(script, client, keys=[], args=[]):
+    """ Run an apollo._lua_script using EVALSHA, loading it on NOSCRIPT. """
+    args = tuple(keys) + tuple(args)
+    try:
+        return await client.evalsha(script.sha, len(keys), *args)
+    except redis.exceptions.NoScriptError:
+        await client.script_load(script.script)
+        return await client.evalsha(script.sha, len(keys), *args)
+
+
+def _invalidate_on_execute(pipeline):
+    """ See apollo._invalidate_on_execute """
+    if isinstance(pipeline, _cluster_writes) or 'execute' in vars(pipeline):
+        return
+    execute = pipeline.execute
+
+    async def wrapper(*args, **kwargs):
+        replies = await execute(*args, **kwargs)
+        apollo._commit_invalidations(pipeline)
+        return replies
+    pipeline.execute = wrapper
+
+
+def auto_pipeline(method):
+    """ asyncio version of apollo.auto_pipeline: the pipeline is executed iff
+    it was not given explicitly, as an optimistic transaction. """
+    @wraps(method)
+    async def wrapper(self, *args, pipeline=None):
+        if pipeline is not None:
+            if getattr(pipeline, 'apollo_watcher', None) is None:
+                _invalidate_on_execute(pipeline)
+            return await method(self, *args, pipeline=pipeline)
+
+        async def queue(pipeline):
+            await method(self, *args, pipeline=pipeline)
+        return (await _transact(self._db, queue))[1]
+
+    return wrapper
+
+
+class counting_connection(redis.asyncio.Connection):
+    """ A redis.asyncio.Connection reporting its traffic to
+    apollo.instrument """
+
+    def __init__(self, *args, **kwargs):
+        super(counting_connection, self).__init__(*args, **kwargs)
+        self._packed_commands = 0
+
+    def pack_commands(self, commands):
+        commands = list(commands)
+        packed = super(counting_connection, self).pack_commands(commands)
+        self._packed_commands = len(commands)
+        return packed
+
+    async def send_packed_command(self, command, *args, **kwargs):
+        apollo._record(max(self._packed_commands, 1), command,
+                       _instrument_method.get())
+        self._packed_commands = 0
+        return await super(counting_connection, self).send_packed_command(
+            command, *args, **kwargs)
+
+
+_parsers = {'python': apollo._parser(redis.asyncio.connection,
+                                     'PythonParser', '_AsyncRESP2Parser'),
+            'hiredis': apollo._parser(redis.asyncio.connection,
+                                      'HiredisParser', '_AsyncHiredisParser')}
+
+
+def connect(host='localhost', port=6379, db=0, max_connections=None,
+            socket_timeout=None, pool_timeout=None, parser=None,
+            instrument=False, **connection_kwargs):
+    """ Returns a redis.asyncio.Redis client suitable for aioapollo, backed
+    by its own connection pool, see apollo.connect """
+    kwargs = apollo._connection_pool_kwargs(
+        max_connections, pool_timeout, parser, _parsers,
+        apollo._hiredis_available())
+    if instrument:
+        kwargs['connection_class'] = counting_connection
+    kwargs.update(connection_kwargs)
+    if pool_timeout is not None:
+        pool_class = redis.asyncio.BlockingConnectionPool
+    else:
+        pool_class = redis.asyncio.ConnectionPool
+    pool = pool_class(host=host, port=port, db=db,
+                      socket_timeout=socket_timeout, decode_responses=True,
+                      **kwargs)
+    return redis.asyncio.Redis(connection_pool=pool)
+
+
+async def _decode_scan(decode, elements):
+    """ Decode the elements yielded by an async scan iterator """
+    async for element in elements:
+        yield decode(element)
+
+
+async def _scan_ids(db, entity, serials, count):
+    """ Translate the serials of entity yielded by an async scan iterator into
+    ids, count at a time """
+    batch = []
+    async for serial in serials:
+        batch.append(serial)
+        if len(batch) < count:
+            continue
+        for id in await _arun(apollo._ids_plan(db, entity, batch)):
+            if id is not None:
+                yield id
+        batch = []
+    for id in await _arun(apollo._ids_plan(db, entity, batch)):
+        if id is not None:
+            yield id
+
+
+class pipeline():
+    """ Async context manager yielding a pipeline that is executed when the
+    block exits without an exception, and discarded otherwise. The replies
+    are available as the result attribute afterwards.
+
+        async with aioapollo.pipeline(db) as pipe:
+            await person.hset('age', 5, pipeline=pipe)
+            await person.sadd('emails', 'a@b.com', pipeline=pipe)
+
+    """
+    def __init__(self, db, transaction=True):
+        self._db = db
+        self._transaction = transaction
+        self._pipeline = None
+        self.result = None
+
+    async def __aenter__(self):
+        self._pipeline = self._db.pipeline(transaction=self._transaction)
+        return self._pipeline
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.result = await self._pipeline.execute()
+                apollo._commit_invalidations(self._pipeline)
+        finally:
+            await self._pipeline.reset()
+
+
+class Entity(apollo.Entity):
+    """ An apollo.Entity whose methods are coroutines. See apollo.Entity for
+    how entities, lookups and relations are declared. Instances are created
+    without an existence check, use instance() for a verified handle.
+
+    """
+
+    @classmethod
+    async def members(cls, db):
+        """ List all entities """
+        return await db.smembers(cls._members_key)
+
+    @classmethod
+    def iter_members(cls, db, count=1000):
+        """ Async generator over all entity ids using SSCAN """
+        return db.sscan_iter(cls._members_key, count=count)
+
+    @classmethod
+    async def exists(cls, id, db):
+        """ See apollo.Entity.exists """
+        return (await cls.exists_many([id], db))[0]
+
+    @classmethod
+    async def create(cls, id, db, fields=dict(), pipeline=None, ttl=None):
+        """ Create an object with identifier id on the redis client db
+
+            fields is a dictionary of fields that are all created in a single
+            transaction
+
+            ttl is the time to live of the object in seconds, and defaults to
+            the class attribute ttl, see apollo.Entity.expire
+
+            if pipeline is given, the writes are queued on it and the check
+            for an existing entity is skipped.
+
+            An id that has expired but has not been purged yet is purged
+            in the same transaction, then created again.
+
+        """
+        if isinstance(id, bytes):
+            raise TypeError('id must be a string')
+
+        instance = cls(id, db)
+        if pipeline is not None:
+            await cls._allocate_serials([id], db)
+            await _arun(instance._create_plan(fields, pipeline, ttl),
+                        pipeline)
+            return instance
+
+        await cls._allocate_serials([id], db)
+
+        async def queue(pipeline):
+            return await _arun(
+                instance._create_new_plan(fields, pipeline, ttl), pipeline)
+        if not (await _transact(db, queue))[0]:
+            raise KeyError(id, 'already exists')
+        return instance
+
+    @classmethod
+    async def create_many(cls, items, db, chunk_size=1000, ttl=None):
+        """ See apollo.Entity.create_many """
+        pending, conflicts = cls._check_create_many(items)
+        existing = []
+        if _is_cluster(db):
+            # the writes of each entity are committed on their own slots
+            for id, fields in pending:
+                await cls._allocate_serials([id], db)
+                instance = cls(id, db)
+
+                async def queue(pipeline):
+                    return await _arun(
+                        instance._create_new_plan(fields, pipeline, ttl),
+                        pipeline)
+                if not (await _transact(db, queue))[0]:
+                    existing.append(id)
+            return conflicts+existing
+        size = chunk_size
+        while pending:
+            chunk = pending[:size]
+            await cls._allocate_serials([id for id, fields in chunk], db)
+
+            async def queue(pipeline):
+                return await _arun(
+                    cls._create_chunk_plan(chunk, db, pipeline, ttl),
+                    pipeline)
+            postponed, found = (await _transact(db, queue))[0]
+            existing.extend(found)
+            pending = postponed + pending[size:]
+            size = 1 if len(postponed) == len(chunk) else chunk_size
+        return conflicts+existing
+
+    @classmethod
+    async def _allocate_serials(cls, ids, db):
+        """ See apollo.Entity._allocate_serials """
+        if cls.compact_ids and ids:
+            await _run_script(cls._allocate_serials_script, db,
+                              keys=[cls._serials_key, cls._ids_key], args=ids)
+
+    @classmethod
+    async def exists_many(cls, ids, db, chunk_size=1000):
+        """ See apollo.Entity.exists_many """
+        return await _arun(cls._exists_many_plan(ids, db, chunk_size))
+
+    @classmethod
+    async def instance(cls, id, db):
+        """ Returns a handle to id, raising KeyError if it does not exist """
+        if not await cls.exists(id, db):
+            raise KeyError(id, 'has not been created yet')
+        return cls(id, db)
+
+    @classmethod
+    async def instance_many(cls, ids, db, chunk_size=1000):
+        """ See apollo.Entity.instance_many """
+        ids = list(ids)
+        exists = await cls.exists_many(ids, db, chunk_size)
+        missing = [id for id, found in zip(ids, exists) if not found]
+        if missing:
+            raise KeyError(missing, 'have not been created yet')
+        return [cls.ref(id, db) for id in ids]
+
+    @classmethod
+    async def load_many(cls, ids, db, fields=None, chunk_size=1000):
+        """ See apollo.Entity.load_many """
+        return await _arun(cls._load_many_plan(ids, db, fields, chunk_size))
+
+    @classmethod
+    async def delete_many(cls, ids, db, chunk_size=1000):
+        """ See apollo.Entity.delete_many """
+        await _arun(cls._delete_many_plan(ids, db, chunk_size))
+
+    @classmethod
+    @check_field
+    async def range(cls, field, min, max, db, limit=None, offset=0):
+        """ See apollo.Entity.range """
+        index = cls._plans[field].index
+        if index is None:
+            raise TypeError('field is not indexed: '+field)
+        if limit is None and not offset:
+            return await db.zrangebyscore(index, min, max)
+        if limit is None:
+            limit = -1
+        return await db.zrangebyscore(index, min, max, start=offset,
+                                      num=limit)
+
+    @classmethod
+    @check_field
+    async def rebuild_index(cls, field, db, count=1000):
+        """ See apollo.Entity.rebuild_index """
+        await _arun(cls._rebuild_index_plan(field, db, count))
+
+    @classmethod
+    @check_field
+    async def lookup(self, field, value, db):
+        assert field in self.lookups
+        # if its injective
+        if self.lookups[field]:
+            return await db.hget(self._lookup_key(field, value), self.prefix)
+        else:
+            return await _arun(self._lookup_set_plan(field, value, db))
+
+    @auto_pipeline
+    async def expire(self, ttl, pipeline=None):
+        """ See apollo.Entity.expire """
+        self._queue_expire(ttl, pipeline)
+
+    @auto_pipeline
+    async def persist(self, pipeline=None):
+        """ See apollo.Entity.persist """
+        pipeline.persist(self._key)
+        for field_name in self._container_fields:
+            pipeline.persist(self._key+':'+field_name)
+        pipeline.zrem(self._expiry_key, self.id)
+
+    async def time_to_live(self):
+        """ See apollo.Entity.time_to_live """
+        deadline = await self._db.zscore(self._expiry_key, self.id)
+        if deadline is None:
+            return None
+        return max(deadline/1000-time.time(), 0.0)
+
+    @classmethod
+    async def purge_expired(cls, db, count=1000):
+        """ See apollo.Entity.purge_expired """
+        purged = 0
+        while True:
+            async def queue(pipeline):
+                return await _arun(
+                    cls._purge_expired_plan(db, count, pipeline), pipeline)
+            ids = (await _transact(db, queue))[0]
+            purged += len(ids)
+            if len(ids) < count:
+                return purged
+
+    @auto_pipeline
+    async def delete(self, pipeline=None):
+        """ Remove this entity from the db, all associated fields and related
+            fields will also be cleaned up
+
+        """
+        await _arun(self._delete_plan(pipeline), pipeline)
+
+    async def transaction(self, func, watch=(), retries=16):
+        """ See apollo.Entity.transaction """
+        return await transaction(self._db, func, (self._key,)+tuple(watch),
+                                 retries)
+
+    @check_field
+    async def hincrby(self, field, count=1):
+        """ Increment the field by count, field must be declared int """
+        if self.fields[field] != int:
+            raise TypeError('cannot call hincrby on a non-int field')
+        index = self._plans[field].index
+        if index is None:
+            result = await self._db.hincrby(self._key, field, count)
+        else:
+            async with self._db.pipeline() as pipeline:
+                pipeline.hincrby(self._key, field, count)
+                pipeline.zincrby(index, count, self.id)
+                result = (await pipeline.execute())[0]
+        self._invalidate(self.id, field)
+        return result
+
+    @check_field
+    async def hincrbyfloat(self, field, count):
+        """ Increment the field by count, field must be declared float """
+        if self.fields[field] != float:
+            raise TypeError('cannot call hincrbyfloat on a non-float field')
+        index = self._plans[field].index
+        if index is None:
+            result = await self._db.hincrbyfloat(self._key, field, count)
+        else:
+            async with self._db.pipeline() as pipeline:
+                pipeline.hincrbyfloat(self._key, field, count)
+                pipeline.zincrby(index, count, self.id)
+                result = (await pipeline.execute())[0]
+        self._invalidate(self.id, field)
+        return result
+
+    @check_field
+    @auto_pipeline
+    async def hset(self, field, value, pipeline=None):
+        """ Set a hash field equal to value """
+        await _arun(self._hset_plan(field, value, pipeline), pipeline)
+
+    @check_field
+    @auto_pipeline
+    async def hdel(self, field, pipeline=None):
+        """ Delete a hash field and its related fields and lookups """
+        await _arun(self._hdel_plan(field, pipeline), pipeline)
+
+    @check_field
+    async def hget(self, field):
+        """ Get a hash field """
+        if self.cache is not None:
+            return (await _arun(self._cached_hmget_plan((field,))))[0]
+        return self._decode_hash_field(
+            field, await self._db.hget(self._key, field))
+
+    async def hmget(self, *fields):
+        """ Get many hash fields in a single round trip """
+        for field in fields:
+            if not field in self._plans:
+                raise TypeError('invalid field: '+field)
+        if self.cache is not None:
+            return await _arun(self._cached_hmget_plan(fields))
+        values = await self._db.hmget(self._key, fields)
+        return [self._decode_hash_field(field, val)
+                for field, val in zip(fields, values)]
+
+    async def hgetall(self):
+        """ Get every hash field of this entity in a single round trip """
+        result = dict()
+        values = await self._db.hgetall(self._key)
+        for field, val in values.items():
+            if field in self._plans:
+                result[field] = self._decode_hash_field(field, val)
+        return result
+
+    @check_field
+    async def smembers(self, field):
+        """ Return members of a set """
+        if self._plans[field].kind != 'set':
+            raise KeyError('called smembers on non-set field')
+        members = await self._db.smembers(self._key+':'+field)
+        return await _arun(self._decode_members_plan(field, members,
+                                                     self._db))
+
+    @check_field
+    def iter_smembers(self, field, count=1000):
+        """ Async generator over the members of a set field using SSCAN """
+        plan = self._plans[field]
+        if plan.kind != 'set':
+            raise KeyError('called iter_smembers on non-set field')
+        members = self._db.sscan_iter(self._key+':'+field, count=count)
+        if plan.serials is not None:
+            return _scan_ids(self._db, plan.serials, members, count)
+        return _decode_scan(plan.decode, members)
+
+    @check_field
+    def iter_zmembers(self, field, count=1000):
+        """ Async generator over the (member, score) pairs of a zset field
+        using ZSCAN """
+        plan = self._plans[field]
+        if plan.kind != 'zset':
+            raise KeyError('called iter_zmembers on non-zset field')
+        return _decode_scan(lambda pair: (plan.decode(pair[0]),
+                                          plan.score(pair[1])),
+                            self._db.zscan_iter(self._key+':'+field,
+                                                count=count))
+
+    @check_field
+    async def sismember(self, field, value):
+        return await _arun(self._sismember_plan(field, value))
+
+    @check_field
+    async def scard(self, field):
+        return await self._db.scard(self._key+':'+field)
+
+    @check_field
+    async def srandmember(self, field):
+        member = await self._db.srandmember(self._key+':'+field)
+        return await _arun(self._decode_member_plan(field, member))
+
+    @check_field
+    @auto_pipeline
+    async def sremall(self, field, pipeline=None):
+        """ Empty the set """
+        await _arun(self._sremall_plan(field, pipeline), pipeline)
+
+    @check_field
+    @auto_pipeline
+    async def srem(self, field, *values, pipeline=None):
+        """ Remove values from the set field """
+        await _arun(self._srem_plan(field, *values, pipeline=pipeline),
+                    pipeline)
+
+    @check_field
+    @auto_pipeline
+    async def sadd(self, field, *values, pipeline=None):
+        """ Add values to the field, see apollo.Entity.sadd """
+        await _arun(self._sadd_plan(field, *values, pipeline=pipeline),
+                    pipeline)
+
+    @check_field
+    async def zscore(self, field, member):
+        """ See apollo.Entity.zscore """
+        plan = self._zset_plan(field, 'zscore')
+        score = await self._db.zscore(self._key+':'+field, member)
+        if score is None:
+            return None
+        return plan.score(score)
+
+    @check_field
+    async def zcard(self, field):
+        self._zset_plan(field, 'zcard')
+        return await self._db.zcard(self._key+':'+field)
+
+    @check_field
+    async def zrange(self, field, start=0, stop=-1, withscores=False):
+        """ See apollo.Entity.zrange """
+        self._zset_plan(field, 'zrange')
+        reply = await self._db.zrange(self._key+':'+field, start, stop,
+                                      withscores=withscores)
+        return self._decode_zset_reply(field, reply, withscores)
+
+    @check_field
+    async def zrevrange(self, field, start=0, stop=-1, withscores=False):
+        """ See apollo.Entity.zrevrange """
+        self._zset_plan(field, 'zrevrange')
+        reply = await self._db.zrevrange(self._key+':'+field, start, stop,
+                                         withscores=withscores)
+        return self._decode_zset_reply(field, reply, withscores)
+
+    @check_field
+    async def zrangebyscore(self, field, min, max, limit=None, offset=0,
+                            withscores=False):
+        """ See apollo.Entity.zrangebyscore """
+        self._zset_plan(field, 'zrangebyscore')
+        reply = await self._zrangebyscore(
+            self._db, self._key+':'+field, min, max, limit, offset,
+            withscores)
+        return self._decode_zset_reply(field, reply, withscores)
+
+    @check_field
+    async def zrevrangebyscore(self, field, max, min, limit=None, offset=0,
+                               withscores=False):
+        """ See apollo.Entity.zrevrangebyscore """
+        self._zset_plan(field, 'zrevrangebyscore')
+        reply = await self._zrangebyscore(
+            self._db, self._key+':'+field, max, min, limit, offset,
+            withscores, desc=True)
+        return self._decode_zset_reply(field, reply, withscores)
+
+    @classmethod
+    @check_field
+    async def zrange_many(cls, field, ids, db, start=0, stop=-1,
+                          withscores=False, chunk_size=1000):
+        """ See apollo.Entity.zrange_many """
+        return await _arun(cls._zrange_many_plan(field, ids, db, start, stop,
+                                                 withscores, chunk_size))
+
+    @classmethod
+    @check_field
+    async def zrangebyscore_many(cls, field, ids, db, min, max, limit=None,
+                                 offset=0, withscores=False,
+                                 chunk_size=1000):
+        """ See apollo.Entity.zrangebyscore_many """
+        return await _arun(cls._zrangebyscore_many_plan(
+            field, ids, db, min, max, limit, offset, withscores, chunk_size))
+
+    @check_field
+    async def zremrangebyrank(self, field, start, stop):
+        self._zset_plan(field, 'zremrangebyrank')
+        return await self._db.zremrangebyrank(
+            self._key+':'+field, start, stop)
+
+    @check_field
+    async def zrevpop(self, field, count=None):
+        """ See apollo.Entity.zrevpop """
+        plan = self._zset_plan(field, 'zrevpop')
+        if count is not None and count <= 0:
+            return []
+        result = await _run_script(
+            self._zrevpop_script, self._db,
+            keys=[self._key+':'+field],
+            args=[1 if count is None else count])
+        if count is not None:
+            return [plan.decode(member) for member in result]
+        if result:
+            return plan.decode(result[0])
+        else:
+            return None
+
+    @check_field
+    @auto_pipeline
+    async def zadd(self, field, *args, pipeline=None):
+        """ See apollo.Entity.zadd """
+        plan = self._plans[field]
+        assert plan.lookup is None and plan.relation is None
+        if len(args) == 1 and isinstance(args[0], dict):
+            mapping = args[0]
+        else:
+            mapping = dict(zip(args[0::2], args[1::2]))
+        return self._queue_zadd(field, mapping, pipeline)
+
+    @check_field
+    @auto_pipeline
+    async def zrem(self, field, *args, pipeline=None):
+        self._zset_plan(field, 'zrem')
+        plan = self._plans[field]
+        assert plan.lookup is None and plan.relation is None
+        return pipeline.zrem(self._key+':'+field, *args)
+
+    def __init__(self, id, db):
+        assert type(id) in (str, int)
+        self._db = db
+        self._id = id
+        self._key = self._entity_key(id)
+
+
+apollo._trace_methods(Entity, _traced)
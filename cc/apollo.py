@@ -13,19 +13,527 @@
 # under the License.
 
 from functools import wraps
+import collections
+import hashlib
+import inspect
+import itertools
+import threading
+import time
 import redis
 
 
-# generic container used to denote zset
+# generic container used to denote zset, score is the type of the scores
 class zset():
-    def __init__(self, primitive):
+    def __init__(self, primitive, score=float):
+        if score not in (int, float):
+            raise TypeError('zset scores must be int or float')
         self.primitive = primitive
+        self.score = score
+
+
+class _lua_script():
+    """ A Lua script that can be run on any redis client. Unlike
+    redis.Redis.register_script, the sha is computed locally, so scripts can
+    be created once at class level and no SCRIPT LOAD round trip is needed
+    until a server reports NOSCRIPT.
+
+    """
+    def __init__(self, script):
+        self.script = script
+        self.sha = hashlib.sha1(script.encode()).hexdigest()
+
+    def __call__(self, client, keys=[], args=[]):
+        args = tuple(keys) + tuple(args)
+        if isinstance(client, redis.client.Pipeline):
+            # the pipeline loads missing scripts before it executes
+            client.scripts.add(self)
+            return client.evalsha(self.sha, len(keys), *args)
+        try:
+            return client.evalsha(self.sha, len(keys), *args)
+        except redis.exceptions.NoScriptError:
+            client.script_load(self.script)
+            return client.evalsha(self.sha, len(keys), *args)
+
+
+class _field_plan():
+    """ Everything needed to access one field of an Entity, worked out once
+    when the schema is compiled instead of on every call.
+
+        kind - 'hash', 'set' or 'zset'
+        primitive - the declared primitive type or Entity subclass
+        decode - coerces a raw redis value into primitive
+        score - coerces a raw zset score into its declared type, or None
+        relation - (other_entity, other_field, other_kind) or None
+        lookup - None, or True/False if the lookup is injective or not
+        index - None, or the key of the sorted set indexing the field
+        serials - the Entity subclass whose serials are the members of the
+            set, or None if they are plain ids or values, see compact_ids
+        bound_serial - True if the sets that bind this field to the entity
+            hold its serial instead of its id
+
+    """
+    __slots__ = ('name', 'kind', 'primitive', 'decode', 'score', 'relation',
+                 'lookup', 'index', 'serials', 'bound_serial')
+
+    def __init__(self, entity, name):
+        self.name = name
+        self.kind, self.primitive = _field_kind(entity.fields[name])
+        if isinstance(self.primitive, type) and \
+                issubclass(self.primitive, Entity):
+            self.decode = _identity
+        elif self.primitive in (str, int, bool, float):
+            self.decode = self.primitive
+        else:
+            raise TypeError('Unknown field type')
+        if self.kind == 'zset':
+            self.score = _score_decoder(entity.fields[name].score)
+        else:
+            self.score = None
+        if name in entity.relations:
+            other_entity, other_field = entity.relations[name]
+            other_kind = _field_kind(other_entity.fields[other_field])[0]
+            self.relation = (other_entity, other_field, other_kind)
+        else:
+            self.relation = None
+        self.lookup = entity.lookups.get(name)
+        if name in entity.indexes:
+            self.index = entity._members_key+':'+name
+        else:
+            self.index = None
+        if self.kind == 'set' and self.decode is _identity and \
+                self.primitive.compact_ids:
+            self.serials = self.primitive
+        else:
+            self.serials = None
+        self.bound_serial = entity.compact_ids and (
+            self.lookup is False or
+            (self.relation is not None and self.relation[2] == 'set'))
+
+
+def _identity(value):
+    return value
+
+
+def _int_score(value):
+    return int(float(value))
+
+
+def _score_decoder(score):
+    """ Returns a function coercing raw scores, which redis may send as
+    floats or strings, into score """
+    if score is int:
+        return _int_score
+    return float
+
+
+def _field_kind(field_type):
+    """ Returns (kind, primitive) of a declared field type """
+    if type(field_type) is set:
+        for primitive in field_type:
+            return 'set', primitive
+    elif type(field_type) is zset:
+        return 'zset', field_type.primitive
+    else:
+        return 'hash', field_type
+
+
+_missing = object()
+
+
+class entity_cache():
+    """ A per process LRU cache of decoded hash field values, keyed by
+    (prefix, id, field). Attach one to an Entity to serve repeated hget and
+    hmget calls locally:
+
+        class Target(apollo.Entity):
+            prefix = 'target'
+            fields = {'owner': str, 'weight': int}
+            cache = apollo.entity_cache(maxsize=10000, ttl=1)
+
+    apollo's own writes evict the entries they touch once they are committed,
+    so a read racing the write cannot cache the old value. Entries expire after
+    ttl seconds, which bounds how stale a value written by another process
+    can be. Use listen() to also evict entries as soon as redis reports a
+    change through keyspace notifications.
+
+    """
+    def __init__(self, maxsize=10000, ttl=1.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # bumped by every invalidation, so that a value read from redis
+        # before an invalidation is never put back into the cache
+        self.generation = 0
+        self._entries = collections.OrderedDict()
+        self._fields = collections.defaultdict(set)
+        self._lock = threading.Lock()
+        self._pubsub = None
+        self._patterns = None
+        self._thread = None
+
+    def get(self, key):
+        """ Returns the cached value of key, or _missing """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.time():
+                self.misses += 1
+                return _missing
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, generation):
+        """ Cache value if nothing was invalidated since generation """
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = (value, time.time()+self.ttl)
+            self._entries.move_to_end(key)
+            self._fields[key[:2]].add(key[2])
+            while len(self._entries) > self.maxsize:
+                self._forget(self._entries.popitem(last=False)[0])
+
+    def _forget(self, key):
+        fields = self._fields[key[:2]]
+        fields.discard(key[2])
+        if not fields:
+            del self._fields[key[:2]]
+
+    def invalidate(self, prefix, id, field=None):
+        """ Evict field of the entity, or every field if field is None """
+        with self._lock:
+            self.generation += 1
+            if field is None:
+                for field in self._fields.pop((prefix, id), ()):
+                    del self._entries[(prefix, id, field)]
+            elif self._entries.pop((prefix, id, field), None) is not None:
+                self._forget((prefix, id, field))
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._fields.clear()
+
+    def listen(self, db, *entities):
+        """ Evict entries of entities whenever their hashes change on db,
+        including writes made by other processes. This starts a daemon thread
+        subscribed to redis keyspace notifications, which must be enabled on
+        the server, eg. notify-keyspace-events Kghx to also evict entities
+        as they expire. """
+        patterns = ['__keyspace@*__:'+entity._key_prefix+'*'
+                    for entity in entities]
+        self._patterns = patterns
+        self._pubsub = db.pubsub()
+        self._pubsub.psubscribe(patterns)
+        messages = self._pubsub.listen()
+        # wait for the subscriptions to be confirmed
+        for pattern in patterns:
+            next(messages)
+        prefixes = dict((entity._key_prefix, entity.prefix)
+                        for entity in entities)
+
+        def evict():
+            for message in messages:
+                if message['type'] != 'pmessage':
+                    continue
+                key = message['channel'].split(':', 1)[1]
+                for key_prefix, prefix in prefixes.items():
+                    if key.startswith(key_prefix):
+                        id = key[len(key_prefix):]
+                        if id.startswith('{'):
+                            id = id[1:id.find('}')]
+                        self.invalidate(prefix, id)
+
+        self._thread = threading.Thread(target=evict)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop listening for keyspace notifications, ending the thread
+        started by listen and closing its connection """
+        if self._pubsub is not None:
+            # the thread returns once the unsubscription is confirmed
+            self._pubsub.punsubscribe(self._patterns)
+            self._thread.join()
+            self._pubsub.close()
+            self._pubsub = None
+            self._thread = None
+
+
+class call_stats():
+    """ Redis traffic recorded by instrument. methods maps the qualified name
+    of each apollo method called to the call_stats of its own traffic. """
+    __slots__ = ('commands', 'round_trips', 'pipelines', 'bytes_sent',
+                 'methods')
+
+    def __init__(self, methods=True):
+        self.commands = 0
+        self.round_trips = 0
+        self.pipelines = 0
+        self.bytes_sent = 0
+        self.methods = collections.defaultdict(
+            lambda: call_stats(methods=False)) if methods else None
+
+    def _add(self, commands, bytes_sent):
+        self.commands += commands
+        self.round_trips += 1
+        if commands > 1:
+            self.pipelines += 1
+        self.bytes_sent += bytes_sent
+
+    def __repr__(self):
+        return '<call_stats commands:'+str(self.commands)+' round_trips:' + \
+            str(self.round_trips)+' pipelines:'+str(self.pipelines) + \
+            ' bytes_sent:'+str(self.bytes_sent)+'>'
+
+
+# the instrument scopes opened by the current thread, and the outermost
+# apollo method it is running
+_instrument_state = threading.local()
+
+
+def _scopes():
+    return getattr(_instrument_state, 'scopes', ())
+
+
+class instrument():
+    """ Context manager recording the redis traffic made within its scope,
+    per apollo method. Only connections of class counting_connection are
+    recorded, so instrumentation is opt-in:
+
+        db = apollo.connect(instrument=True)
+        with apollo.instrument() as stats:
+            person.hset('age', 5)
+        assert stats.round_trips <= 2
+        print(stats.methods['Entity.hset'])
+
+    Scopes can be nested, and are tracked per thread. With aioapollo, a scope
+    records the traffic of every task run by the event loop while it is open.
+
+    """
+    def __init__(self):
+        self.stats = call_stats()
+        self._outer = ()
+
+    def __enter__(self):
+        self._outer = _scopes()
+        _instrument_state.scopes = self._outer+(self.stats,)
+        return self.stats
+
+    def __exit__(self, exc_type, exc, tb):
+        _instrument_state.scopes = self._outer
+
+
+def _traced(func):
+    """ Wrap func so that the traffic it makes within instrument scopes is
+    recorded under its qualified name, unless it is called by another apollo
+    method. The name is resolved once per call here, instead of on every
+    round trip. """
+    name = func.__qualname__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _scopes() or \
+                getattr(_instrument_state, 'method', None) is not None:
+            return func(*args, **kwargs)
+        _instrument_state.method = name
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _instrument_state.method = None
+    return wrapper
+
+
+def _trace_methods(cls, traced=_traced):
+    """ Trace the public methods defined by cls, see _traced """
+    for name, attr in list(vars(cls).items()):
+        if name.startswith('_'):
+            continue
+        if isinstance(attr, (classmethod, staticmethod)):
+            setattr(cls, name, type(attr)(traced(attr.__func__)))
+        elif inspect.isfunction(attr):
+            setattr(cls, name, traced(attr))
+
+
+def _record(commands, packed, method):
+    """ Record a round trip of commands made by method, the name of an
+    apollo method or None, on every active instrument scope """
+    scopes = _scopes()
+    if not scopes:
+        return
+    if isinstance(packed, (bytes, bytearray)):
+        bytes_sent = len(packed)
+    else:
+        bytes_sent = sum(len(chunk) for chunk in packed)
+    for stats in scopes:
+        stats._add(commands, bytes_sent)
+        if method is not None:
+            stats.methods[method]._add(commands, bytes_sent)
+
+
+class counting_connection(redis.Connection):
+    """ A redis.Connection reporting its traffic to instrument. A pipeline
+    is sent as a single packed command, ie. a single round trip. Pipelines
+    are packed by pack_commands, or by pack_command per command in redis-py
+    2, and anything else sent is a single command. """
+
+    def __init__(self, *args, **kwargs):
+        super(counting_connection, self).__init__(*args, **kwargs)
+        self._packed_commands = 0
+
+    def pack_command(self, *args):
+        self._packed_commands += 1
+        return super(counting_connection, self).pack_command(*args)
+
+    def pack_commands(self, commands):
+        commands = list(commands)
+        packed = super(counting_connection, self).pack_commands(commands)
+        self._packed_commands = len(commands)
+        return packed
+
+    def send_packed_command(self, command, *args, **kwargs):
+        _record(max(self._packed_commands, 1), command,
+                getattr(_instrument_state, 'method', None))
+        self._packed_commands = 0
+        return super(counting_connection, self).send_packed_command(
+            command, *args, **kwargs)
+
+
+def _parser(module, *names):
+    """ Returns the first parser class of names found in module, as parsers
+    were renamed in redis-py 5 """
+    for name in names:
+        if hasattr(module, name):
+            return getattr(module, name)
+
+
+_parsers = {'python': _parser(redis.connection, 'PythonParser',
+                              '_RESP2Parser'),
+            'hiredis': _parser(redis.connection, 'HiredisParser',
+                               '_HiredisParser')}
+
+
+def _hiredis_available():
+    return getattr(redis.connection, 'hiredis_available',
+                   getattr(redis.utils, 'HIREDIS_AVAILABLE', False))
+
+
+def _connection_pool_kwargs(max_connections, pool_timeout, parser, parsers,
+                            hiredis_available):
+    """ Returns the keyword arguments selecting the parser and bounding the
+    pool, shared by connect and aioapollo.connect """
+    kwargs = dict()
+    if parser is not None:
+        if parser not in parsers:
+            raise ValueError('unknown parser: '+parser)
+        if parser == 'hiredis' and not hiredis_available:
+            raise redis.exceptions.RedisError('hiredis is not installed')
+        kwargs['parser_class'] = parsers[parser]
+    if pool_timeout is not None:
+        kwargs['timeout'] = pool_timeout
+        kwargs['max_connections'] = max_connections or 50
+    elif max_connections is not None:
+        kwargs['max_connections'] = max_connections
+    return kwargs
+
+
+def connect(host='localhost', port=6379, db=0, max_connections=None,
+            socket_timeout=None, pool_timeout=None, parser=None,
+            instrument=False, **connection_kwargs):
+    """ Returns a redis.Redis client suitable for apollo, ie. decoding
+    responses, backed by its own connection pool. Share the returned client
+    rather than calling connect per request.
+
+        max_connections - bounds the number of connections of the pool
+        socket_timeout - seconds to wait for a reply before giving up
+        pool_timeout - if given, a caller finding all max_connections (50
+            by default) in use waits up to pool_timeout seconds for one to be
+            released, instead of failing right away
+        parser - 'hiredis' or 'python', defaults to hiredis when installed
+        instrument - count the traffic of the pool, see instrument
+
+    Other keyword arguments are passed to the connections. See pool_stats to
+    monitor the pool.
+
+    """
+    kwargs = _connection_pool_kwargs(max_connections, pool_timeout, parser,
+                                     _parsers, _hiredis_available())
+    if instrument:
+        kwargs['connection_class'] = counting_connection
+    kwargs.update(connection_kwargs)
+    if pool_timeout is not None:
+        pool_class = redis.BlockingConnectionPool
+    else:
+        pool_class = redis.ConnectionPool
+    pool = pool_class(host=host, port=port, db=db,
+                      socket_timeout=socket_timeout, decode_responses=True,
+                      **kwargs)
+    return redis.Redis(connection_pool=pool)
+
+
+class pool_stats():
+    """ A snapshot of the connections of the pool of a client, or of a pool,
+    made by connect or otherwise. A pool with as many connections in_use as
+    max_connections is starved: further callers fail, or wait if the pool
+    blocks.
+
+        max_connections - the bound of the pool
+        created - connections opened so far, in use or idle
+        in_use - connections currently checked out by a command or pipeline
+        idle - connections available for reuse
+
+    Works with the pools of both redis.Redis and redis.asyncio.Redis. The
+    pools do not expose their connections publicly, so the counts are None
+    for a pool whose private layout is not one of those known here.
+
+    """
+    __slots__ = ('max_connections', 'created', 'in_use', 'idle')
+
+    def __init__(self, db):
+        pool = getattr(db, 'connection_pool', db)
+        self.max_connections = getattr(pool, 'max_connections', None)
+        self.in_use = None
+        self.idle = None
+        self.created = None
+        in_use = getattr(pool, '_in_use_connections', None)
+        available = getattr(pool, '_available_connections', None)
+        # blocking pools keep their idle connections in a queue, padded with
+        # None up to max_connections
+        queue = getattr(getattr(pool, 'pool', None), 'queue', None)
+        connections = getattr(pool, '_connections', None)
+        if in_use is not None and available is not None:
+            self.in_use = len(in_use)
+            self.idle = len(available)
+        elif queue is not None and connections is not None:
+            self.idle = sum(1 for connection in list(queue)
+                            if connection is not None)
+            self.in_use = len(connections)-self.idle
+        if self.in_use is not None:
+            self.created = self.in_use+self.idle
+
+    def __repr__(self):
+        return 'pool_stats(max_connections='+str(self.max_connections) + \
+            ', created='+str(self.created)+', in_use='+str(self.in_use) + \
+            ', idle='+str(self.idle)+')'
+
+
+def _pool_client(pipeline):
+    """ Returns a redis.Redis sharing the connection pool of pipeline. It is
+    created once per pool, instead of once per call. """
+    pool = pipeline.connection_pool
+    client = getattr(pool, 'apollo_client', None)
+    if client is None:
+        client = redis.Redis(connection_pool=pool)
+        pool.apollo_client = client
+    return client
 
 
 def check_field(func):
     @wraps(func)
     def _wrapper(self_cls, field, *args, **kwargs):
-        if not field in self_cls.fields:
+        if not field in self_cls._plans:
             raise TypeError('invalid field: '+field)
         return func(self_cls, field, *args, **kwargs)
     return _wrapper
@@ -57,28 +565,219 @@ def auto_pipeline(method):
                 inner2(pipeline=pipeline)
         pipeline.execute()  # flush happens here
 
-    pipeline must be a named argument
+    pipeline must be a named argument. When the pipeline is flushed here, the
+    method runs as an optimistic transaction, see transaction.
 
     """
     @wraps(method)
     def wrapper(self, *args, pipeline=None):
         if pipeline is not None:
             assert isinstance(pipeline, redis.client.Pipeline)
-            flush = False
-        else:
-            pipeline = self._db.pipeline()
-            flush = True
-
-        retval = method(self, *args, pipeline=pipeline)
+            if getattr(pipeline, 'apollo_watcher', None) is None:
+                _invalidate_on_execute(pipeline)
+            return method(self, *args, pipeline=pipeline)
 
-        if flush:
-            return pipeline.execute()
-        else:
-            return retval
+        def queue(pipeline):
+            method(self, *args, pipeline=pipeline)
+        return _transact(self._db, queue)[1]
 
     return wrapper
 
 
+def _invalidations(pipeline):
+    """ The cache entries to evict once the writes queued on pipeline are
+    committed, as (cache, prefix, id, field). Evicting them earlier would let
+    a concurrent read cache the value being replaced. """
+    pending = getattr(pipeline, 'apollo_invalidations', None)
+    if pending is None:
+        pending = pipeline.apollo_invalidations = []
+    return pending
+
+
+def _commit_invalidations(pipeline):
+    """ Evict the cache entries of the writes of pipeline, which were just
+    committed """
+    for cache, prefix, id, field in _invalidations(pipeline):
+        cache.invalidate(prefix, id, field)
+    pipeline.apollo_invalidations = []
+
+
+def _invalidate_on_execute(pipeline):
+    """ Make a pipeline executed by the caller commit its invalidations """
+    if 'execute' in vars(pipeline):
+        return
+    execute = pipeline.execute
+
+    def wrapper(*args, **kwargs):
+        replies = execute(*args, **kwargs)
+        _commit_invalidations(pipeline)
+        return replies
+    pipeline.execute = wrapper
+
+
+# the keys of the id registries of compact entities, see Entity.compact_ids
+_registry_keys = set()
+
+
+def _read_keys(reads):
+    """ The keys read by a pipeline of single key commands. Id registries are
+    left out since a serial is never reused, so a stale one cannot name
+    another id: it is simply dropped when it is decoded. """
+    return set(args[1] for args, options in reads.command_stack
+               if args[1] not in _registry_keys)
+
+
+def _serials_plan(db, entity, ids):
+    """ Returns the serials of ids in the id registry of entity, None for ids
+    without one. ids are returned as they are if entity is None, without a
+    round trip. """
+    ids = list(ids)
+    if entity is None or not ids:
+        return ids
+    reads = db.pipeline(transaction=False)
+    reads.hmget(entity._serials_key, ids)
+    return (yield reads)[0]
+
+
+def _ids_plan(db, entity, serials):
+    """ The inverse of _serials_plan """
+    serials = list(serials)
+    if entity is None or not serials:
+        return serials
+    reads = db.pipeline(transaction=False)
+    reads.hmget(entity._ids_key, serials)
+    return (yield reads)[0]
+
+
+def _decode_serials_plan(db, entity, sets):
+    """ Translate each set of serials of entity in sets into the set of their
+    ids, using a single round trip """
+    serials = list(set().union(*sets))
+    ids = dict(zip(serials, (yield from _ids_plan(db, entity, serials))))
+    return [set(ids[serial] for serial in members
+                if ids[serial] is not None) for members in sets]
+
+
+def _run(plan, pipeline=None):
+    """ Drive a plan synchronously. A plan is a generator implementing an
+    operation that needs to read before it writes: it yields a pipeline of
+    reads, is sent back the replies, and returns the operation's result. This
+    lets aioapollo share every plan with this module. Plans compose using
+    yield from.
+
+    If pipeline belongs to a transaction, the keys of each read are watched
+    before they are read.
+
+    """
+    watcher = getattr(pipeline, 'apollo_watcher', None)
+    try:
+        reads = next(plan)
+        while True:
+            keys = _read_keys(reads) if watcher is not None else ()
+            if keys:
+                watcher.watch(*keys)
+            reads = plan.send(reads.execute())
+    except StopIteration as stop:
+        return stop.value
+
+
+def _check_client(db):
+    """ Raise TypeError if db is a redis cluster client. apollo commits the
+    writes of an operation with one MULTI/EXEC, after WATCHing the keys it
+    read, which a cluster refuses across slots. aioapollo splits the writes
+    by slot instead. """
+    cluster = getattr(redis, 'RedisCluster', None)
+    if cluster is not None and isinstance(db, cluster):
+        raise TypeError('apollo does not support redis cluster clients, '
+                        'use aioapollo')
+
+
+def _transact(db, func, watch=(), retries=16):
+    """ Implements transaction, returning func's result along with the
+    replies of the committed writes """
+    _check_client(db)
+    for attempt in range(retries):
+        watcher = db.pipeline()
+        pipeline = db.pipeline()
+        try:
+            if watch:
+                watcher.watch(*watch)
+            pipeline.apollo_watcher = watcher
+            result = func(pipeline)
+            watcher.multi()
+            for script in pipeline.scripts:
+                watcher.scripts.add(script)
+            for args, options in pipeline.command_stack:
+                watcher.execute_command(*args, **options)
+            replies = watcher.execute()
+            _commit_invalidations(pipeline)
+            return result, replies
+        except redis.exceptions.WatchError:
+            continue
+        finally:
+            watcher.reset()
+            pipeline.reset()
+    raise redis.exceptions.WatchError('transaction aborted '+str(retries)+
+                                      ' times')
+
+
+@_traced
+def transaction(db, func, watch=(), retries=16):
+    """ Run func(pipeline) as an optimistic transaction and return its
+    result. apollo methods called with pipeline=pipeline make their reads
+    right away and queue their writes. Every key they read is WATCHed, as are
+    the keys in watch, and the writes are committed using MULTI/EXEC. If a
+    watched key was modified in the meantime, func is called again with a new
+    pipeline. WatchError is raised after retries attempts.
+
+        def adopt(pipeline):
+            joe.sadd('cats', kitty, pipeline=pipeline)
+            joe.hset('ssn', '123', pipeline=pipeline)
+
+        apollo.transaction(db, adopt)
+
+    Since func may be called several times, it should not have other side
+    effects. Every apollo method that reads before it writes already runs
+    this way when it is not given a pipeline.
+
+    """
+    return _transact(db, func, watch, retries)[0]
+
+
+def _scan(db, command, key, count):
+    """ Iterate over the elements of key using SSCAN or ZSCAN. count is a hint
+    of how many elements each round trip returns. As with any SCAN, elements
+    added or removed during the iteration may or may not be returned.
+
+    ZSCAN elements are (member, score) pairs. redis-py 2 returns them as a
+    flat list of members and scores, and later versions as pairs.
+
+    """
+    cursor = 0
+    while True:
+        cursor, elements = db.execute_command(command, key, cursor,
+                                              'COUNT', count)
+        if command == 'ZSCAN' and elements and \
+                not isinstance(elements[0], (tuple, list)):
+            elements = zip(elements[0::2], elements[1::2])
+        for element in elements:
+            yield element
+        if int(cursor) == 0:
+            break
+
+
+def _scan_ids(db, entity, serials, count):
+    """ Translate the serials of entity yielded by a scan into ids, count at
+    a time """
+    while True:
+        batch = list(itertools.islice(serials, count))
+        if not batch:
+            break
+        for id in _run(_ids_plan(db, entity, batch)):
+            if id is not None:
+                yield id
+
+
 def relate(entityA, fieldA, entityB, fieldB=None):
     """ Relate entityA's fieldA with that of entityB's fieldB. fieldA and
     fieldB are new fields to be defined.
@@ -111,18 +810,25 @@ def relate(entityA, fieldA, entityB, fieldB=None):
         entity2 = _set_relation(entityB, fieldB, entityA)
         entity1.relations[fieldA] = (entity2, fieldB)
         entity2.relations[fieldB] = (entity1, fieldA)
+        entity2._compile()
+    entity1._compile()
 
 
 class _entity_metaclass(type):
 
     def __new__(cls, clsname, bases, attrs):
         if len(bases) > 0:
-            mandatory_fields = ('fields', 'relations', 'lookups')
+            mandatory_fields = ('fields', 'relations', 'lookups', 'indexes')
             for field in mandatory_fields:
                 if not field in attrs:
                     attrs[field] = dict()
-        return super(_entity_metaclass, cls).__new__(
+            # instances only ever hold _db, _id and _key
+            attrs.setdefault('__slots__', ())
+        entity = super(_entity_metaclass, cls).__new__(
             cls, clsname, bases, attrs)
+        if len(bases) > 0:
+            entity._compile()
+        return entity
 
 
 class Entity(metaclass=_entity_metaclass):
@@ -166,6 +872,37 @@ class Entity(metaclass=_entity_metaclass):
     For this reason, sorted sets and lists can only map to either single
     objects or sets, but not to other sorted sets or lists.
 
+    Keys are laid out as follows, with hash_tags = False (the default) and
+    hash_tags = True respectively:
+
+        entity hash             prefix:id           prefix:{id}
+        set and zset fields     prefix:id:field     prefix:{id}:field
+        members                 prefixs             {prefix}s
+        range index             prefixs:field       {prefix}s:field
+        expiry index            prefix_expiry       {prefix}_expiry
+        injective lookup        field:value         field:{value}
+        non injective lookup    field:value:prefix  field:{value}:prefix
+        id to serial registry   prefix_serials      {prefix}_serials
+        serial to id registry   prefix_ids          {prefix}_ids
+
+    With hash tags, redis cluster stores all the keys of an entity in one
+    slot, as well as the class wide keys, and the lookup keys of a value.
+    A relation is stored as fields of both of its entities, so it spans
+    their two slots. Only aioapollo supports cluster clients, as it groups
+    writes by slot.
+
+    With compact_ids = True, the sets that hold ids of the entity, namely the
+    set fields related to it and its non injective lookups, hold small integer
+    serials instead. Redis keeps sets of up to set-max-intset-entries integers
+    as compact intsets, which take a few bytes per member instead of a string
+    each. Serials are allocated by create and create_many in an id registry,
+    and removed from it by delete, so a recreated id gets a new serial. They
+    are never reused, so that a serial read once cannot name another id.
+    Serials are translated back to ids when such sets are read, which costs
+    an extra round trip, and writes to them read the serials they need first.
+    compact_ids should be set when the class is declared, since the sets
+    already stored are not converted.
+
     Example:
 
     class Person(apollo.Entity):
@@ -210,62 +947,392 @@ class Entity(metaclass=_entity_metaclass):
     apollo.relate({Person},'cats_to_feed',{Cat},'persons_feeding_me')
 
     """
+    __slots__ = ('_db', '_id', '_key')
+    cache = None
+    # default time to live in seconds of created entities, see expire
+    ttl = None
+    # colocate the keys of each entity in a redis cluster slot, see _compile
+    hash_tags = False
+    # store integer serials instead of ids in relation and lookup sets
+    compact_ids = False
+
+    @classmethod
+    def _compile(cls):
+        """ Compile the schema into key templates and a _field_plan per field.
+        This is called by the metaclass, and again by relate and add_lookup
+        since they modify the schema of existing classes. """
+        prefix = getattr(cls, 'prefix', None)
+        if prefix is not None:
+            tagged_prefix = '{'+prefix+'}' if cls.hash_tags else prefix
+            cls._members_key = tagged_prefix+'s'
+            cls._key_prefix = prefix+':'
+            cls._expiry_key = tagged_prefix+'_expiry'
+            cls._serials_key = tagged_prefix+'_serials'
+            cls._ids_key = tagged_prefix+'_ids'
+            if cls.compact_ids:
+                _registry_keys.update((cls._serials_key, cls._ids_key))
+        cls._plans = dict((name, _field_plan(cls, name))
+                          for name in cls.fields)
+        cls._reference_hash_fields = []
+        cls._reference_set_fields = []
+        cls._container_fields = []
+        cls._index_fields = []
+        cls._bound_serial = False
+        for name, plan in cls._plans.items():
+            if plan.kind != 'hash':
+                cls._container_fields.append(name)
+            if plan.index:
+                cls._index_fields.append(name)
+            if plan.bound_serial:
+                cls._bound_serial = True
+            if plan.relation or plan.lookup is not None:
+                if plan.kind == 'set':
+                    cls._reference_set_fields.append(name)
+                elif plan.kind == 'hash':
+                    cls._reference_hash_fields.append(name)
+
+    @classmethod
+    def _entity_key(cls, id):
+        """ Returns the key of the hash of id, which also prefixes the keys of
+        its set and zset fields """
+        if cls.hash_tags:
+            return cls._key_prefix+'{'+id+'}'
+        return cls._key_prefix+id
+
+    @classmethod
+    def _lookup_key(cls, field, value):
+        """ Returns the key of the hash mapping value to the ids of entities
+        whose field is value, for injective lookups """
+        if cls.hash_tags:
+            return field+':{'+value+'}'
+        return field+':'+value
+
+    @classmethod
+    def _lookup_set_key(cls, field, value):
+        """ Returns the key of the set of ids of entities whose field has
+        value, for non injective lookups """
+        return cls._lookup_key(field, value)+':'+cls.prefix
 
     @classmethod
     def members(cls, db):
         """ List all entities """
-        return db.smembers(cls.prefix+'s')
+        return db.smembers(cls._members_key)
+
+    @classmethod
+    def iter_members(cls, db, count=1000):
+        """ Generator over all entity ids using SSCAN, so that only about
+        count ids are held in memory or sent by redis at a time. An id may be
+        yielded more than once if the set is modified during iteration. """
+        return _scan(db, 'SSCAN', cls._members_key, count)
 
     @classmethod
     def exists(cls, id, db):
-        """ Returns true if an entity with id id exists on the db """
-        return db.sismember(cls.prefix+'s', id)
+        """ Returns true if an entity with id id exists on the db. An entity
+        that has expired no longer exists, even before purge_expired removes
+        it from the members of the class. """
+        return cls.exists_many([id], db)[0]
+
+    @classmethod
+    def exists_many(cls, ids, db, chunk_size=1000):
+        """ Returns a list of booleans, one per id in the same order, telling
+        whether each entity exists. Each chunk of chunk_size ids costs a
+        single round trip. """
+        return _run(cls._exists_many_plan(ids, db, chunk_size))
+
+    @classmethod
+    def _exists_many_plan(cls, ids, db, chunk_size):
+        states = yield from cls._membership_plan(ids, db, chunk_size)
+        return [member and not expired for member, expired in states]
 
     @classmethod
-    def create(cls, id, db, fields=dict()):
+    def _membership_plan(cls, ids, db, chunk_size=1000):
+        """ Returns a (member, expired) pair per id: whether it is a member of
+        the class, and whether its deadline has passed although it has not
+        been purged yet. The expiry index is only read if the class can
+        expire. """
+        ids = list(ids)
+        expires = not (cls.relations or cls.lookups)
+        states = []
+        for offset in range(0, len(ids), chunk_size):
+            chunk = ids[offset:offset+chunk_size]
+            pipeline = db.pipeline(transaction=False)
+            for id in chunk:
+                pipeline.sismember(cls._members_key, id)
+                if expires:
+                    pipeline.zscore(cls._expiry_key, id)
+            replies = iter((yield pipeline))
+            now = time.time()*1000
+            for id in chunk:
+                member = bool(next(replies))
+                deadline = next(replies) if expires else None
+                states.append((member, deadline is not None and
+                               deadline <= now))
+        return states
+
+    @classmethod
+    def ref(cls, id, db):
+        """ Returns a handle to id without checking that it exists. Unlike
+        the constructor, no arguments are checked, so this is the cheapest
+        way to materialize many handles. """
+        entity = cls.__new__(cls)
+        entity._db = db
+        entity._id = id
+        entity._key = cls._entity_key(id)
+        return entity
+
+    @classmethod
+    def load_many(cls, ids, db, fields=None, chunk_size=1000):
+        """ Load many entities with as few round trips as possible. Each chunk
+        of chunk_size ids is fetched using a single pipeline, which bounds the
+        size of any one reply.
+
+        Returns a list of dicts, one per id in the same order, mapping field
+        names to typed values. Hash fields that are not set are omitted, set
+        fields map to sets and zset fields map to lists ordered by score. Ids
+        that do not exist map to None.
+
+        """
+        return _run(cls._load_many_plan(ids, db, fields, chunk_size))
+
+    @classmethod
+    def _load_many_plan(cls, ids, db, fields, chunk_size):
+        if fields is None:
+            fields = list(cls.fields)
+        hash_fields = []
+        set_fields = []
+        zset_fields = []
+        for field in fields:
+            if not field in cls._plans:
+                raise TypeError('invalid field: '+field)
+            kind = cls._plans[field].kind
+            if kind == 'set':
+                set_fields.append(field)
+            elif kind == 'zset':
+                zset_fields.append(field)
+            else:
+                hash_fields.append(field)
+
+        records = []
+        ids = list(ids)
+        for offset in range(0, len(ids), chunk_size):
+            chunk = ids[offset:offset+chunk_size]
+            pipeline = db.pipeline(transaction=False)
+            for id in chunk:
+                pipeline.sismember(cls._members_key, id)
+                if hash_fields:
+                    pipeline.hmget(cls._entity_key(id), hash_fields)
+                for field in set_fields:
+                    pipeline.smembers(cls._entity_key(id)+':'+field)
+                for field in zset_fields:
+                    pipeline.zrange(cls._entity_key(id)+':'+field, 0, -1)
+            replies = iter((yield pipeline))
+            for id in chunk:
+                exists = next(replies)
+                record = dict()
+                if hash_fields:
+                    for field, val in zip(hash_fields, next(replies)):
+                        if val is not None:
+                            record[field] = cls._decode_hash_field(field, val)
+                for field in set_fields:
+                    record[field] = cls._decode_set_members(field,
+                                                            next(replies))
+                for field in zset_fields:
+                    decode = cls._plans[field].decode
+                    record[field] = [decode(member) for member in
+                                     next(replies)]
+                records.append(record if exists else None)
+            loaded = [record for record in records[offset:] if record]
+            for field in set_fields:
+                entity = cls._plans[field].serials
+                if entity is not None and loaded:
+                    decoded = yield from _decode_serials_plan(
+                        db, entity, [record[field] for record in loaded])
+                    for record, ids in zip(loaded, decoded):
+                        record[field] = ids
+        return records
+
+    @classmethod
+    def create(cls, id, db, fields=dict(), ttl=None):
         """ Create an object with identifier id on the redis client db
 
             fields is a dictionary of fields that are all created in a single
             transaction
 
+            ttl is the time to live of the object in seconds, and defaults to
+            the class attribute ttl, see expire
+
             if db is a pipeline object, then the returned instance is None
             since the object does not exist yet. The onus is on the developer
             to execute pipe first, and then creating the instance.
 
+            An id that has expired but has not been purged yet is purged
+            in the same transaction, then created again.
+
         """
         if isinstance(id, bytes):
             raise TypeError('id must be a string')
 
         if isinstance(db, redis.client.Pipeline):
-            flush = False
-            instance_db = redis.Redis(connection_pool=db.connection_pool)
-            pipeline = db
-        else:
-            assert isinstance(db, redis.client.Redis)
-            if cls.exists(id, db):
-                raise KeyError(id, 'already exists')
-            flush = True
-            instance_db = db
-            pipeline = db.pipeline()
-
-        instance = cls(id, instance_db, verify=False)
+            instance = cls.ref(id, _pool_client(db))
+            cls._allocate_serials([id], instance._db)
+            _run(instance._create_plan(fields, db, ttl), db)
+            return None
 
+        _check_client(db)
+        cls._allocate_serials([id], db)
+        instance = cls.ref(id, db)
+
+        def queue(pipeline):
+            return _run(instance._create_new_plan(fields, pipeline, ttl),
+                        pipeline)
+        if not _transact(db, queue)[0]:
+            raise KeyError(id, 'already exists')
+        return instance
+
+    def _create_new_plan(self, fields, pipeline, ttl=None):
+        """ Run _create_plan unless the entity exists, returning whether it
+        did. The check is read within the transaction, so it is WATCHed along
+        with the other reads. An expired entity is purged first. """
+        member, expired = (yield from self._membership_plan([self.id],
+                                                            self._db))[0]
+        if member and not expired:
+            return False
+        if expired:
+            self._queue_delete(self.id, dict(), pipeline)
+        yield from self._create_plan(fields, pipeline, ttl)
+        return True
+
+    def _create_plan(self, fields, pipeline, ttl=None):
         for field_name, field_value in fields.items():
+            if not field_name in self._plans:
+                raise TypeError('invalid field: '+field_name)
             if type(field_value) is set:
-                instance.sadd(field_name, *field_value, pipeline=pipeline)
+                yield from self._sadd_plan(field_name, *field_value,
+                                           pipeline=pipeline)
+            elif type(field_value) is dict:
+                self._queue_zadd(field_name, field_value, pipeline)
             elif type(field_value) in (str, int, bool, float):
-                instance.hset(field_name, field_value, pipeline=pipeline)
+                yield from self._hset_plan(field_name, field_value,
+                                           pipeline=pipeline)
             elif isinstance(field_value, Entity):
-                instance.hset(field_name, field_value, pipeline=pipeline)
+                yield from self._hset_plan(field_name, field_value,
+                                           pipeline=pipeline)
             else:
                 raise TypeError('unsupported type:'+field_value)
 
-        pipeline.sadd(cls.prefix + 's', id)
-        if flush:
-            pipeline.execute()
-            return instance
-        else:
-            return None
+        pipeline.sadd(self._members_key, self.id)
+        if ttl is None:
+            ttl = self.ttl
+        if ttl is not None:
+            self._queue_expire(ttl, pipeline)
+
+    @classmethod
+    def create_many(cls, items, db, chunk_size=1000, ttl=None):
+        """ Create many entities from (id, fields) pairs. Each chunk of
+        entities is created in a single optimistic transaction, which first
+        checks which ids exist in one round trip: the reads needed by their
+        relations and lookups are then merged into one pipeline per step,
+        instead of one per entity. ttl is as in create.
+
+        Returns the ids that were not created because they already exist or
+        are repeated in items. Expired ids are purged and created again, as
+        in create.
+
+        """
+        _check_client(db)
+        pending, conflicts = cls._check_create_many(items)
+        existing = []
+        size = chunk_size
+        while pending:
+            chunk = pending[:size]
+            cls._allocate_serials([id for id, fields in chunk], db)
+
+            def queue(pipeline):
+                return _run(cls._create_chunk_plan(chunk, db, pipeline, ttl),
+                            pipeline)
+            postponed, found = _transact(db, queue)[0]
+            existing.extend(found)
+            pending = postponed + pending[size:]
+            # entities that read each other's keys may not make progress
+            # together, in which case the first one is created on its own
+            size = 1 if len(postponed) == len(chunk) else chunk_size
+        return conflicts+existing
+
+    @classmethod
+    def _check_create_many(cls, items):
+        """ Validate items, returning the (id, fields) to create along with
+        the ids that are repeated """
+        pending = []
+        conflicts = []
+        seen = set()
+        for id, fields in items:
+            if isinstance(id, bytes):
+                raise TypeError('id must be a string')
+            for field_name in fields:
+                if not field_name in cls._plans:
+                    raise TypeError('invalid field: '+field_name)
+            if id in seen:
+                conflicts.append(id)
+            else:
+                seen.add(id)
+                pending.append((id, fields))
+        return pending, conflicts
+
+    @classmethod
+    def _create_chunk_plan(cls, chunk, db, pipeline, ttl=None):
+        """ Run the _create_plan of every (id, fields) in chunk that does not
+        exist yet in lockstep, merging their reads. Expired ones are purged
+        first, as in _create_new_plan. An entity that reads a key another
+        entity of the chunk has read is postponed, since their writes could
+        conflict. The writes of the others are queued on pipeline. Returns the
+        postponed items and the ids that exist. """
+        states = yield from cls._membership_plan(
+            [id for id, fields in chunk], db, len(chunk))
+        steps = []
+        done = []
+        postponed = []
+        existing = []
+        for item, (member, expired) in zip(chunk, states):
+            if member and not expired:
+                existing.append(item[0])
+                continue
+            writes = db.pipeline()
+            if expired:
+                cls._queue_delete(item[0], dict(), writes)
+            plan = cls.ref(item[0], db)._create_plan(item[1], writes, ttl)
+            try:
+                steps.append((item, plan, writes, next(plan)))
+            except StopIteration:
+                done.append(writes)
+        owners = dict()
+        while steps:
+            merged = db.pipeline(transaction=False)
+            batch = []
+            for item, plan, writes, reads in steps:
+                keys = _read_keys(reads)
+                if any(owners.get(key, item[0]) != item[0] for key in keys):
+                    postponed.append(item)
+                    continue
+                for key in keys:
+                    owners[key] = item[0]
+                for args, options in reads.command_stack:
+                    merged.execute_command(*args, **options)
+                batch.append((item, plan, writes, len(reads.command_stack)))
+            replies = (yield merged) if batch else []
+            steps = []
+            offset = 0
+            for item, plan, writes, count in batch:
+                try:
+                    steps.append((item, plan, writes,
+                                  plan.send(replies[offset:offset+count])))
+                except StopIteration:
+                    done.append(writes)
+                offset += count
+        for writes in done:
+            for args, options in writes.command_stack:
+                pipeline.execute_command(*args, **options)
+            _invalidations(pipeline).extend(_invalidations(writes))
+        return postponed, existing
 
     @classmethod
     def add_lookup(cls, field, injective=True):
@@ -277,14 +1344,110 @@ class Entity(metaclass=_entity_metaclass):
         """
         # ensure lookup field is not a prefix for any existing derived Entity
         for subclass in Entity.__subclasses__():
-            if subclass.prefix == field:
+            if getattr(subclass, 'prefix', None) == field:
                 raise AttributeError('lookup field cannot be a prefix for \
                                       any existing entity')
         cls.lookups[field] = injective
+        cls._compile()
+
+    @classmethod
+    def add_index(cls, field, kind='range'):
+        """ Index a numeric hash field using a sorted set, so that entities
+        can be queried by a range of values using Entity.range. The index is
+        updated in the same transaction as hset, hincrby, hincrbyfloat, hdel
+        and delete. Entities written before the index was added can be
+        indexed using rebuild_index.
+
+        """
+        if kind != 'range':
+            raise ValueError('unsupported index kind: '+kind)
+        if not field in cls._plans:
+            raise TypeError('invalid field: '+field)
+        plan = cls._plans[field]
+        if plan.kind != 'hash' or plan.primitive not in (int, float):
+            raise TypeError('only int and float fields can be indexed')
+        cls.indexes[field] = kind
+        cls._compile()
+
+    @classmethod
+    @check_field
+    def range(cls, field, min, max, db, limit=None, offset=0):
+        """ Returns the ids of entities whose field is between min and max
+        inclusive, ordered by value. min and max can also be '-inf', '+inf',
+        or prefixed with '(' to be exclusive. At most limit ids are returned
+        after skipping offset ids.
+
+        """
+        index = cls._plans[field].index
+        if index is None:
+            raise TypeError('field is not indexed: '+field)
+        if limit is None and not offset:
+            return db.zrangebyscore(index, min, max)
+        if limit is None:
+            limit = -1
+        return db.zrangebyscore(index, min, max, start=offset, num=limit)
+
+    @classmethod
+    @check_field
+    def rebuild_index(cls, field, db, count=1000):
+        """ Rebuild the index of field from the values currently stored. The
+        members of the class are iterated using SSCAN, count at a time, and
+        indexed in a temporary sorted set that then replaces the index. Each
+        batch costs two round trips, the ZADDs of a batch being sent along
+        with the SSCAN of the next one. """
+        _run(cls._rebuild_index_plan(field, db, count))
+
+    @classmethod
+    def _rebuild_index_plan(cls, field, db, count):
+        index = cls._plans[field].index
+        if index is None:
+            raise TypeError('field is not indexed: '+field)
+        # the temporary index hashes to the slot of the index, see hash_tags
+        if cls.hash_tags:
+            rebuilt = index+':rebuild'
+        else:
+            rebuilt = '{'+index+'}:rebuild'
+        pipeline = db.pipeline(transaction=False)
+        pipeline.delete(rebuilt)
+        cursor = 0
+        indexed = False
+        while True:
+            pipeline.execute_command('SSCAN', cls._members_key, cursor,
+                                     'COUNT', count)
+            cursor, ids = (yield pipeline)[-1]
+            pipeline = db.pipeline(transaction=False)
+            if ids:
+                reads = db.pipeline(transaction=False)
+                for id in ids:
+                    reads.hget(cls._entity_key(id), field)
+                for id, value in zip(ids, (yield reads)):
+                    if value is not None:
+                        pipeline.execute_command('ZADD', rebuilt, value, id)
+                        indexed = True
+            if int(cursor) == 0:
+                break
+        # RENAME replaces the index at once
+        if indexed:
+            pipeline.execute_command('RENAME', rebuilt, index)
+        else:
+            pipeline.delete(index)
+        yield pipeline
 
     @classmethod
     def instance(cls, id, db):
-        return cls(id, db)
+        """ Returns a handle to id, raising KeyError if it does not exist """
+        return cls(id, db, verify=True)
+
+    @classmethod
+    def instance_many(cls, ids, db, chunk_size=1000):
+        """ Returns handles to ids, verifying that they all exist using one
+        round trip per chunk. Raises KeyError listing the missing ids. """
+        ids = list(ids)
+        exists = cls.exists_many(ids, db, chunk_size)
+        missing = [id for id, found in zip(ids, exists) if not found]
+        if missing:
+            raise KeyError(missing, 'have not been created yet')
+        return [cls.ref(id, db) for id in ids]
 
     @classmethod
     @check_field
@@ -292,186 +1455,549 @@ class Entity(metaclass=_entity_metaclass):
         assert field in self.lookups
         # if its injective
         if self.lookups[field]:
-            return db.hget(field+':'+value, self.prefix)
+            return db.hget(self._lookup_key(field, value), self.prefix)
         else:
-            return db.smembers(field+':'+value+':'+self.prefix)
+            return _run(self._lookup_set_plan(field, value, db))
+
+    @classmethod
+    def _lookup_set_plan(cls, field, value, db):
+        """ Returns the ids of the entities whose field has value, for non
+        injective lookups """
+        reads = db.pipeline(transaction=False)
+        reads.smembers(cls._lookup_set_key(field, value))
+        members = (yield reads)[0]
+        if not cls._plans[field].bound_serial:
+            return members
+        return (yield from _decode_serials_plan(db, cls, [members]))[0]
+
+    @classmethod
+    def _allocate_serials(cls, ids, db):
+        """ Allocate the serials of ids that do not have one yet, see
+        compact_ids """
+        if cls.compact_ids and ids:
+            cls._allocate_serials_script(
+                db, keys=[cls._serials_key, cls._ids_key], args=ids)
+
+    _allocate_serials_script = _lua_script("""
+    for i, id in ipairs(ARGV) do
+        if redis.call('hexists', KEYS[1], id) == 0 then
+            local serial = redis.call('hincrby', KEYS[2], 'next', 1)
+            redis.call('hset', KEYS[1], id, serial)
+            redis.call('hset', KEYS[2], serial, id)
+        end
+    end
+    """)
+
+    @classmethod
+    def _read_references_plan(cls, ids, db):
+        """ Fetch the current values of the reference fields of ids using a
+        single pipeline. Returns a list of dicts, one per id, mapping fields
+        to their value (hash fields) or members (set fields). """
+        hash_fields = cls._reference_hash_fields
+        set_fields = cls._reference_set_fields
+        if not hash_fields and not set_fields:
+            return [dict() for id in ids]
+        pipeline = db.pipeline(transaction=False)
+        for id in ids:
+            if hash_fields:
+                pipeline.hmget(cls._entity_key(id), hash_fields)
+            for field_name in set_fields:
+                pipeline.smembers(cls._entity_key(id)+':'+field_name)
+        replies = iter((yield pipeline))
+        references = []
+        for id in ids:
+            reference = dict()
+            if hash_fields:
+                reference.update(zip(hash_fields, next(replies)))
+            for field_name in set_fields:
+                reference[field_name] = next(replies)
+            references.append(reference)
+        for field_name in set_fields:
+            entity = cls._plans[field_name].serials
+            if entity is not None:
+                decoded = yield from _decode_serials_plan(
+                    db, entity, [reference[field_name]
+                                 for reference in references])
+                for reference, ids in zip(references, decoded):
+                    reference[field_name] = ids
+        return references
+
+    @classmethod
+    def _registered_serials_plan(cls, ids, db):
+        """ Returns the serials of ids if the class has compact ids, else a
+        None per id """
+        if not cls.compact_ids:
+            return [None for id in ids]
+        return (yield from _serials_plan(db, cls, ids))
+
+    @classmethod
+    def _queue_unreference(cls, id, field, value, pipeline, member=None):
+        """ Queue the removal of the relation or lookup entry that binds id to
+        value through field. member is what stands for id in the sets of
+        other entities and lookups, if it is not id itself. """
+        plan = cls._plans[field]
+        if member is None:
+            member = id
+        if plan.relation:
+            other_entity, other_field_name, other_kind = plan.relation
+            if other_kind == 'set':
+                pipeline.srem(other_entity._entity_key(value)+':'+
+                              other_field_name, member)
+            elif other_kind == 'hash':
+                pipeline.hdel(other_entity._entity_key(value),
+                              other_field_name)
+                other_entity._invalidate(value, other_field_name, pipeline)
+        elif plan.lookup is not None:
+            # if it is injective, implies mapping to a single hash
+            if plan.lookup:
+                pipeline.hdel(cls._lookup_key(field, value), cls.prefix)
+            # lookup maps to many different values
+            else:
+                pipeline.srem(cls._lookup_set_key(field, value), member)
+
+    @classmethod
+    def _queue_delete(cls, id, reference, pipeline, serial=None):
+        """ Queue every write needed to delete id given its references as
+        returned by _read_references, and its serial as returned by
+        _registered_serials_plan. The serial is dropped from the id registry
+        but the counter is left alone, so it is never reused. """
+        member = serial if cls._bound_serial else None
+        for field_name, value in reference.items():
+            if cls._plans[field_name].kind == 'set':
+                for element in value:
+                    cls._queue_unreference(id, field_name, element, pipeline,
+                                           member)
+            elif value:
+                cls._queue_unreference(id, field_name, value, pipeline,
+                                       member)
+        for field_name in cls._container_fields:
+            pipeline.delete(cls._entity_key(id)+':'+field_name)
+        for field_name in cls._index_fields:
+            pipeline.zrem(cls._plans[field_name].index, id)
+        pipeline.delete(cls._entity_key(id))
+        pipeline.srem(cls._members_key, id)
+        pipeline.zrem(cls._expiry_key, id)
+        if serial is not None:
+            pipeline.hdel(cls._serials_key, id)
+            pipeline.hdel(cls._ids_key, serial)
+        cls._invalidate(id, pipeline=pipeline)
+
+    @classmethod
+    def _invalidate(cls, id, field=None, pipeline=None):
+        """ Evict cached values of id that were just written, or once the
+        writes queued on pipeline are committed """
+        if cls.cache is None:
+            return
+        if pipeline is None:
+            cls.cache.invalidate(cls.prefix, id, field)
+        else:
+            _invalidations(pipeline).append((cls.cache, cls.prefix, id,
+                                             field))
+
+    def _queue_expire(self, ttl, pipeline):
+        """ Queue the writes expiring this entity in ttl seconds """
+        if self.relations or self.lookups:
+            raise TypeError('entities with relations or lookups cannot expire')
+        deadline = int((time.time()+ttl)*1000)
+        pipeline.pexpireat(self._key, deadline)
+        for field_name in self._container_fields:
+            pipeline.pexpireat(self._key+':'+field_name, deadline)
+        pipeline.execute_command('ZADD', self._expiry_key, deadline, self.id)
+
+    @auto_pipeline
+    def expire(self, ttl, pipeline=None):
+        """ Expire this entity in ttl seconds, replacing any previous time to
+        live. The hash and the set and zset fields of the entity are given
+        the same deadline in a single transaction, so redis drops them
+        together. The id remains a member of the class, and of its range
+        indexes, until purge_expired is called. Containers first written after
+        expire have no deadline of their own and are dropped by purge_expired.
+
+        Since the lookups and the relations of an expired entity could not be
+        cleaned up, entities that have them cannot expire.
+
+        """
+        self._queue_expire(ttl, pipeline)
+
+    @auto_pipeline
+    def persist(self, pipeline=None):
+        """ Remove the time to live of this entity """
+        pipeline.persist(self._key)
+        for field_name in self._container_fields:
+            pipeline.persist(self._key+':'+field_name)
+        pipeline.zrem(self._expiry_key, self.id)
+
+    def time_to_live(self):
+        """ Returns the seconds left before this entity expires, or None if it
+        does not expire """
+        deadline = self._db.zscore(self._expiry_key, self.id)
+        if deadline is None:
+            return None
+        return max(deadline/1000-time.time(), 0.0)
+
+    @classmethod
+    def purge_expired(cls, db, count=1000):
+        """ Remove the expired entities from the members of the class, its
+        range indexes and the expiry index, along with any of their keys left.
+        Expired ids are found using the expiry index, a sorted set of
+        deadlines, so the cost is proportional to the number of expired
+        entities rather than to the number of entities. Each batch of count
+        ids is purged in one transaction. Returns the number of purged ids.
+
+        """
+        purged = 0
+        while True:
+            def queue(pipeline):
+                return _run(cls._purge_expired_plan(db, count, pipeline),
+                            pipeline)
+            ids = _transact(db, queue)[0]
+            purged += len(ids)
+            if len(ids) < count:
+                return purged
+
+    @classmethod
+    def _purge_expired_plan(cls, db, count, pipeline):
+        reads = db.pipeline(transaction=False)
+        reads.zrangebyscore(cls._expiry_key, '-inf', int(time.time()*1000),
+                            start=0, num=count)
+        ids = (yield reads)[0]
+        serials = yield from cls._registered_serials_plan(ids, db)
+        for id, serial in zip(ids, serials):
+            # entities that expire have no references to clean up
+            cls._queue_delete(id, dict(), pipeline, serial)
+        return ids
 
     @auto_pipeline
     def delete(self, pipeline=None):
         """ Remove this entity from the db, all associated fields and related
-            fields will also be cleaned up
+            fields will also be cleaned up. The references are read in one
+            round trip, and the writes are queued on the pipeline.
 
         """
-        for field_name, field_type in self.fields.items():
-            if type(field_type) is set:
-                if field_name in self.relations or field_name in self.lookups:
-                    for member in self._db.smembers(self.prefix+':'+self.id
-                                                    +':'+field_name):
-                        self.srem(field_name, member, pipeline=pipeline)
-                pipeline.delete(self.prefix+':'+self.id+':'+field_name)
-            elif type(field_type) is zset:
-                pipeline.delete(self.prefix+':'+self.id+':'+field_name)
-            elif issubclass(field_type, Entity):
-                self.hdel(field_name, pipeline=pipeline)
-            elif field_type in (str, int, bool, float):
-                self.hdel(field_name, pipeline=pipeline)
-        pipeline.delete(self.prefix+':'+self.id)
-        pipeline.srem(self.prefix+'s', self.id)
+        _run(self._delete_plan(pipeline), pipeline)
+
+    def _delete_plan(self, pipeline):
+        references = yield from self._read_references_plan([self.id],
+                                                           self._db)
+        serials = yield from self._registered_serials_plan([self.id],
+                                                           self._db)
+        self._queue_delete(self.id, references[0], pipeline, serials[0])
+
+    @classmethod
+    def delete_many(cls, ids, db, chunk_size=1000):
+        """ Delete many entities. Each chunk of chunk_size ids costs one round
+        trip to read references and one transaction to write. """
+        _run(cls._delete_many_plan(ids, db, chunk_size))
+
+    @classmethod
+    def _delete_many_plan(cls, ids, db, chunk_size):
+        ids = list(ids)
+        for offset in range(0, len(ids), chunk_size):
+            chunk = ids[offset:offset+chunk_size]
+            references = yield from cls._read_references_plan(chunk, db)
+            serials = yield from cls._registered_serials_plan(chunk, db)
+            pipeline = db.pipeline()
+            for id, reference, serial in zip(chunk, references, serials):
+                cls._queue_delete(id, reference, pipeline, serial)
+            yield pipeline
+            _commit_invalidations(pipeline)
 
     @property
     def id(self):
         return self._id
 
+    def transaction(self, func, watch=(), retries=16):
+        """ Run func(pipeline) as an optimistic transaction that also watches
+        the hash of this entity, see apollo.transaction. """
+        return transaction(self._db, func, (self._key,)+tuple(watch),
+                           retries)
+
     @check_field
     def hincrby(self, field, count=1):
         """ Increment the field by count, field must be declared int """
         if self.fields[field] != int:
             raise TypeError('cannot call hincrby on a non-int field')
-        return self._db.hincrby(self.prefix + ':' + self._id, field, count)
+        index = self._plans[field].index
+        if index is None:
+            result = self._db.hincrby(self._key, field, count)
+        else:
+            pipeline = self._db.pipeline()
+            pipeline.hincrby(self._key, field, count)
+            pipeline.execute_command('ZINCRBY', index, count, self.id)
+            result = pipeline.execute()[0]
+        self._invalidate(self.id, field)
+        return result
 
     @check_field
     def hincrbyfloat(self, field, count):
         """ Increment the field by count, field must be declared float """
         if self.fields[field] != float:
             raise TypeError('cannot call hincrbyfloat on a non-float field')
-        return self._db.hincrbyfloat(self.prefix + ':' + self._id, field, count)
+        index = self._plans[field].index
+        if index is None:
+            result = self._db.hincrbyfloat(self._key, field, count)
+        else:
+            pipeline = self._db.pipeline()
+            pipeline.hincrbyfloat(self._key, field, count)
+            pipeline.execute_command('ZINCRBY', index, count, self.id)
+            result = pipeline.execute()[0]
+        self._invalidate(self.id, field)
+        return result
 
     @check_field
     @auto_pipeline
     def hset(self, field, value, pipeline=None):
-        """ Set a hash field equal to value """
+        """ Set a hash field equal to value. If the field is related or looked
+        up, the current bindings are read in a single round trip. """
+        _run(self._hset_plan(field, value, pipeline), pipeline)
+
+    def _hset_plan(self, field, value, pipeline):
         # set local value
-        assert (self.fields[field] in (str, int, bool, float) or
-                issubclass(self.fields[field], Entity))
+        plan = self._plans[field]
+        assert plan.kind == 'hash'
+
+        if plan.relation:
+            assert isinstance(value, Entity)
+        if isinstance(value, Entity):
+            value = value.id
 
         # clean up this field first since it can only be bound to a single
         # object hash field (implicitly).
-        if field in self.relations:
-            self.hdel(field, pipeline=pipeline)
-            assert isinstance(value, Entity)
-            other_entity = self.relations[field][0]
-            other_field_name = self.relations[field][1]
-            other_field_type = other_entity.fields[other_field_name]
-            if type(other_field_type) is set:
-                pipeline.sadd(other_entity.prefix+':'+value.id+':'+
-                              other_field_name, self.id)
-            elif issubclass(other_field_type, Entity):
-                # raise?
-                value.hdel(other_field_name, pipeline=pipeline)
-                pipeline.hset(other_entity.prefix+':'+value.id,
-                              other_field_name, self.id)
-            self.hdel(field, pipeline=pipeline)
-        elif field in self.lookups:
-            self.hdel(field, pipeline=pipeline)
-            if self.lookups[field]:
+        if plan.relation or plan.lookup is not None:
+            reads = self._db.pipeline(transaction=False)
+            reads.hget(self._key, field)
+            if plan.relation:
+                other_entity, other_field_name, other_kind = plan.relation
+                if other_kind != 'set':
+                    # value may already be bound to another entity
+                    reads.hget(other_entity._entity_key(value),
+                               other_field_name)
+            elif plan.lookup:
                 # see if this field is mapped to something already
-                reference = self.__class__.lookup(field, value, self._db)
-                if reference:
-                    pipeline.hdel(self.prefix+':'+reference+':'+field, value)
-                pipeline.hset(field+':'+value, self.prefix, self.id)
+                reads.hget(self._lookup_key(field, value), self.prefix)
+            replies = yield reads
+            member = yield from self._bound_member_plan(plan)
+            if replies[0]:
+                self._queue_unreference(self.id, field, replies[0], pipeline,
+                                        member)
+            if plan.relation:
+                if other_kind == 'set':
+                    pipeline.sadd(other_entity._entity_key(value)+':'+
+                                  other_field_name, member)
+                elif other_kind == 'hash':
+                    if replies[1]:
+                        other_entity._queue_unreference(
+                            value, other_field_name, replies[1], pipeline)
+                    pipeline.hset(other_entity._entity_key(value),
+                                  other_field_name, self.id)
+                    other_entity._invalidate(value, other_field_name, pipeline)
+            elif plan.lookup:
+                if replies[1]:
+                    pipeline.hdel(self._entity_key(replies[1]), field)
+                    self._invalidate(replies[1], field, pipeline)
+                pipeline.hset(self._lookup_key(field, value), self.prefix,
+                              self.id)
             else:
-                pipeline.sadd(field+':'+value+':'+self.prefix, self.id)
-        if isinstance(value, Entity):
-            value = value.id
-        pipeline.hset(self.prefix + ':' + self._id, field, value)
+                pipeline.sadd(self._lookup_set_key(field, value), member)
+        if plan.index:
+            # the score must be valid, or the index would silently diverge
+            float(value)
+            pipeline.execute_command('ZADD', plan.index, value, self.id)
+        pipeline.hset(self._key, field, value)
+        self._invalidate(self.id, field, pipeline)
+
+    def _bound_member_plan(self, plan):
+        """ Returns what stands for this entity in the sets bound to the field
+        of plan, its serial or its id, see compact_ids """
+        entity = type(self) if plan.bound_serial else None
+        member = (yield from _serials_plan(self._db, entity, [self.id]))[0]
+        if member is None:
+            raise KeyError(self.id, 'has no serial, see compact_ids')
+        return member
 
     @check_field
     @auto_pipeline
     def hdel(self, field, pipeline=None):
         """ Delete a hash field and its related fields and lookups """
-        assert (self.fields[field] in (str, int, bool, float) or
-                issubclass(self.fields[field], Entity))
-
-        if field in self.relations:
-        #if issubclass(self.fields[field], Entity):
-            other_entity = self.relations[field][0]
-            other_field_name = self.relations[field][1]
-            other_field_type = other_entity.fields[other_field_name]
-
-            # Not pipelined (but should be safe)
-            other_entity_id = self._db.hget(self.prefix+':'+self.id, field)
-            if other_entity_id:
-                if type(other_field_type) is set:
-                    pipeline.srem(other_entity.prefix+':'+other_entity_id+':'+
-                                  other_field_name, self.id)
-                elif issubclass(other_field_type, Entity):
-                    pipeline.hdel(other_entity.prefix+':'+other_entity_id,
-                                  other_field_name)
-        elif field in self.lookups:
-
-            # Not pipelined (but should be safe)
-            lookup_value = self._db.hget(self.prefix+':'+self.id, field)
-            if lookup_value:
-                # if it is injective, implies mapping to a single hash
-                if self.lookups[field]:
-                    pipeline.hdel(field+':'+lookup_value, self.prefix)
-                # lookup maps to many different values
-                else:
-                    pipeline.srem(field+':'+lookup_value+':'+self.prefix,
-                                  self.id)
-
-        pipeline.hdel(self.prefix+':'+self.id, field)
+        _run(self._hdel_plan(field, pipeline), pipeline)
+
+    def _hdel_plan(self, field, pipeline):
+        plan = self._plans[field]
+        assert plan.kind == 'hash'
+
+        if plan.relation or plan.lookup is not None:
+            reads = self._db.pipeline(transaction=False)
+            reads.hget(self._key, field)
+            value = (yield reads)[0]
+            if value:
+                member = yield from self._bound_member_plan(plan)
+                self._queue_unreference(self.id, field, value, pipeline,
+                                        member)
+
+        if plan.index:
+            pipeline.zrem(plan.index, self.id)
+        pipeline.hdel(self._key, field)
+        self._invalidate(self.id, field, pipeline)
 
     @check_field
     def hget(self, field):
         """ Get a hash field """
-        field_type = self.fields[field]
-        if (field_type in (str, int, bool, float)):
-            val = self._db.hget(self.prefix+':' + self._id, field)
-            if val:
-                return field_type(val)
-            else:
-                return val
-        elif issubclass(field_type, Entity):
-            return self._db.hget(self.prefix+':'+self._id, field)
-        else:
-            raise TypeError('Unknown type')
+        if self.cache is not None:
+            return _run(self._cached_hmget_plan((field,)))[0]
+        return self._decode_hash_field(
+            field, self._db.hget(self._key, field))
 
     @check_field
     def hget_pipe(self, field, pipeline):
-        pipeline.hget(self.prefix + ':' + self._id, field)
-        
+        pipeline.hget(self._key, field)
+
+    @classmethod
+    def _decode_hash_field(cls, field, val):
+        """ Coerce a raw hash value of field into its declared type """
+        plan = cls._plans[field]
+        if plan.kind != 'hash':
+            raise TypeError('Unknown type')
+        if val:
+            return plan.decode(val)
+        else:
+            return val
+
+    def hmget(self, *fields):
+        """ Get many hash fields in a single round trip. Returns a list of
+        values in the same order as fields """
+        for field in fields:
+            if not field in self._plans:
+                raise TypeError('invalid field: '+field)
+        if self.cache is not None:
+            return _run(self._cached_hmget_plan(fields))
+        values = self._db.hmget(self._key, fields)
+        return [self._decode_hash_field(field, val)
+                for field, val in zip(fields, values)]
+
+    def _cached_hmget_plan(self, fields):
+        """ Read fields through the cache, fetching the missing ones in a
+        single round trip """
+        cache = self.cache
+        generation = cache.generation
+        keys = [(self.prefix, self._id, field) for field in fields]
+        result = [cache.get(key) for key in keys]
+        missing = [field for field, value in zip(fields, result)
+                   if value is _missing]
+        if missing:
+            reads = self._db.pipeline(transaction=False)
+            reads.hmget(self._key, missing)
+            values = iter((yield reads)[0])
+            for i, key in enumerate(keys):
+                if result[i] is _missing:
+                    result[i] = self._decode_hash_field(key[2], next(values))
+                    cache.put(key, result[i], generation)
+        return result
+
+    def hgetall(self):
+        """ Get every hash field of this entity in a single round trip.
+        Returns a dict of field names to values, fields that are not set are
+        omitted """
+        result = dict()
+        for field, val in self._db.hgetall(self._key).items():
+            if field in self._plans:
+                result[field] = self._decode_hash_field(field, val)
+        return result
+
     @check_field
     def smembers(self, field):
         """ Return members of a set """
-        if type(self.fields[field]) != set:
+        if self._plans[field].kind != 'set':
             raise KeyError('called smembers on non-set field')
-        set_values = set()
-        for member in self._db.smembers(self.prefix + ':' + self._id + ':' +
-                                        field):
-            for primitive_type in self.fields[field]:
-                if issubclass(primitive_type, Entity):
-                    set_values.add(member)
-                elif primitive_type in (str, int, bool, float):
-                    set_values.add(primitive_type(member))
-                else:
-                    raise TypeError('Unknown field type')
-        return set_values
+        members = self._db.smembers(self._key+':'+field)
+        return _run(self._decode_members_plan(field, members, self._db))
+
+    @check_field
+    def iter_smembers(self, field, count=1000):
+        """ Generator over the members of a set field using SSCAN, see
+        iter_members """
+        plan = self._plans[field]
+        if plan.kind != 'set':
+            raise KeyError('called iter_smembers on non-set field')
+        members = _scan(self._db, 'SSCAN', self._key+':'+field, count)
+        if plan.serials is not None:
+            return _scan_ids(self._db, plan.serials, members, count)
+        return map(plan.decode, members)
+
+    @check_field
+    def iter_zmembers(self, field, count=1000):
+        """ Generator over the (member, score) pairs of a zset field using
+        ZSCAN, in no particular order. See iter_members """
+        plan = self._plans[field]
+        if plan.kind != 'zset':
+            raise KeyError('called iter_zmembers on non-zset field')
+        return ((plan.decode(member), plan.score(score)) for member, score in
+                _scan(self._db, 'ZSCAN', self._key+':'+field, count))
+
+    @classmethod
+    def _decode_set_members(cls, field, members):
+        """ Coerce raw members of set field into its declared type """
+        decode = cls._plans[field].decode
+        return set(decode(member) for member in members)
+
+    @classmethod
+    def _decode_members_plan(cls, field, members, db):
+        """ _decode_set_members, translating serials into ids first """
+        entity = cls._plans[field].serials
+        if entity is not None:
+            members = (yield from _decode_serials_plan(db, entity,
+                                                       [members]))[0]
+        return cls._decode_set_members(field, members)
 
     @check_field
     def sismember(self, field, value):
+        return _run(self._sismember_plan(field, value))
+
+    def _sismember_plan(self, field, value):
         if isinstance(value, Entity):
             value = value.id
-        return self._db.sismember(self.prefix+':'+self.id+':'+field, value)
+        member = (yield from _serials_plan(
+            self._db, self._plans[field].serials, [value]))[0]
+        if member is None:
+            return False
+        reads = self._db.pipeline(transaction=False)
+        reads.sismember(self._key+':'+field, member)
+        return (yield reads)[0]
 
     @check_field
     def scard(self, field):
-        return self._db.scard(self.prefix+':'+self.id+':'+field)
+        return self._db.scard(self._key+':'+field)
 
     @check_field
     def srandmember(self, field):
-        return self._db.srandmember(self.prefix+':'+self.id+':'+field)
+        member = self._db.srandmember(self._key+':'+field)
+        return _run(self._decode_member_plan(field, member))
+
+    def _decode_member_plan(self, field, member):
+        """ Translate member of set field into an id if it is a serial """
+        if member is not None:
+            member = (yield from _ids_plan(
+                self._db, self._plans[field].serials, [member]))[0]
+        return member
 
     @check_field
     @auto_pipeline
     def sremall(self, field, pipeline=None):
         """ Empty the set """
-        assert type(self.fields[field]) == set
-        if field in self.relations or field in self.lookups:
-            values = list(self.smembers(field))
-            self.srem(field, *values, pipeline=pipeline)
+        _run(self._sremall_plan(field, pipeline), pipeline)
+
+    def _sremall_plan(self, field, pipeline):
+        plan = self._plans[field]
+        assert plan.kind == 'set'
+        if plan.relation or plan.lookup is not None:
+            reads = self._db.pipeline(transaction=False)
+            reads.smembers(self._key+':'+field)
+            values = (yield reads)[0]
+            if plan.serials is not None:
+                values = (yield from _decode_serials_plan(
+                    self._db, plan.serials, [values]))[0]
+            yield from self._srem_plan(field, *values, pipeline=pipeline)
         else:
-            pipeline.delete(self.prefix+':'+self._id+':'+field)
+            pipeline.delete(self._key+':'+field)
 
     @check_field
     @auto_pipeline
@@ -479,49 +2005,56 @@ class Entity(metaclass=_entity_metaclass):
         """ Remove values from the set field. Is pipeline is specified, then
             the pipeline will be used. Else, it will use its own pipeline
             to ensure transaction integrity """
-        assert type(self.fields[field]) == set
+        _run(self._srem_plan(field, *values, pipeline=pipeline), pipeline)
+
+    def _srem_plan(self, field, *values, pipeline):
+        plan = self._plans[field]
+        assert plan.kind == 'set'
         carbon_copy_values = []
         for value in values:
             if isinstance(value, Entity):
                 carbon_copy_values.append(value.id)
             else:
                 carbon_copy_values.append(value)
-
-        for value in carbon_copy_values:
-            if field in self.relations:
-                if not self.sismember(field, value):
+        if not carbon_copy_values:
+            return
+        members = yield from _serials_plan(self._db, plan.serials,
+                                           carbon_copy_values)
+
+        if plan.relation or plan.lookup is not None:
+            reads = self._db.pipeline(transaction=False)
+            for value, member in zip(carbon_copy_values, members):
+                # an id without a serial cannot be a member
+                if member is None:
                     raise ValueError(value+' is not in '+self.id+'\'s '+field)
-                other_entity = self.relations[field][0]
-                other_field_name = self.relations[field][1]
-                other_field_type = other_entity.fields[other_field_name]
-
-                if type(other_field_type) is set:
-                    pipeline.srem(other_entity.prefix+':'+value+':'+
-                                  other_field_name, self.id)
-                elif issubclass(other_field_type, Entity):
-                    pipeline.hdel(other_entity.prefix+':'+value,
-                                  other_field_name)
-            elif field in self.lookups:
-                if not self.sismember(field, value):
+                reads.sismember(self._key+':'+field, member)
+            for value, is_member in zip(carbon_copy_values, (yield reads)):
+                if not is_member:
                     raise ValueError(value+' is not in '+self.id+'\'s '+field)
-                if self.lookups[field]:
-                    # see if this field mapped to something already
-                    pipeline.hdel(field+':'+value, self.prefix, self.id)
-                else:
-                    pipeline.srem(field+':'+value+':'+self.prefix, self.id)
+            bound = yield from self._bound_member_plan(plan)
+            for value in carbon_copy_values:
+                self._queue_unreference(self.id, field, value, pipeline,
+                                        bound)
 
-        pipeline.srem(self.prefix+':'+self._id+':'+field, *carbon_copy_values)
+        members = [member for member in members if member is not None]
+        if members:
+            pipeline.srem(self._key+':'+field, *members)
 
     @check_field
     @auto_pipeline
     def sadd(self, field, *values, pipeline=None):
         """ Add values to the field. If the field expects Entities, then values
         can either be a list of strings, a list of Entities, or a mix of both.
+        The current bindings of related or looked up values are read in a
+        single round trip regardless of the number of values.
 
         """
-        assert type(self.fields[field]) == set
-        for key in self.fields[field]:
-            derived_entity = key
+        _run(self._sadd_plan(field, *values, pipeline=pipeline), pipeline)
+
+    def _sadd_plan(self, field, *values, pipeline):
+        plan = self._plans[field]
+        assert plan.kind == 'set'
+        derived_entity = plan.primitive
         carbon_copy_values = []
         # convert all values to strings first
         for value in values:
@@ -531,92 +2064,278 @@ class Entity(metaclass=_entity_metaclass):
                 carbon_copy_values.append(value)
             else:
                 raise TypeError('Bad sadd type')
-
-        if field in self.relations:
-            other_entity = self.relations[field][0]
-            other_field_name = self.relations[field][1]
-            other_field_type = other_entity.fields[other_field_name]
-            for value in carbon_copy_values:
-                if type(other_field_type) is set:
-                    pipeline.sadd(other_entity.prefix+':'+value+':'+
+        if not carbon_copy_values:
+            return
+        members = yield from _serials_plan(self._db, plan.serials,
+                                           carbon_copy_values)
+        for value, member in zip(carbon_copy_values, members):
+            if member is None:
+                raise KeyError(value, 'has not been created yet')
+
+        if plan.relation:
+            other_entity, other_field_name, other_kind = plan.relation
+            if other_kind == 'set':
+                bound = yield from self._bound_member_plan(plan)
+                for value in carbon_copy_values:
+                    pipeline.sadd(other_entity._entity_key(value)+':'+
+                                  other_field_name, bound)
+            elif other_kind == 'hash':
+                reads = self._db.pipeline(transaction=False)
+                for value in carbon_copy_values:
+                    reads.sismember(other_entity._members_key, value)
+                    reads.hget(other_entity._entity_key(value),
+                               other_field_name)
+                replies = yield reads
+                exists, partners = replies[0::2], replies[1::2]
+                for value, value_exists in zip(carbon_copy_values, exists):
+                    if not value_exists:
+                        raise KeyError(value, 'has not been created yet')
+                for value, member, partner in zip(carbon_copy_values,
+                                                  members, partners):
+                    if partner:
+                        other_entity._queue_unreference(
+                            value, other_field_name, partner, pipeline,
+                            member)
+                    pipeline.hset(other_entity._entity_key(value),
                                   other_field_name, self.id)
-                elif issubclass(other_field_type, Entity):
-                    other_entity(value, self._db).hdel(other_field_name)
-                    pipeline.hset(other_entity.prefix+':'+value,
-                                  other_field_name, self.id)
-        elif field in self.lookups:
-            for value in carbon_copy_values:
-                if self.lookups[field]:
-                    # see if this field mapped to something already
-                    reference = self.__class__.lookup(field, value, self._db)
+                    other_entity._invalidate(value, other_field_name, pipeline)
+        elif plan.lookup is not None:
+            if plan.lookup:
+                # see if these values mapped to something already
+                reads = self._db.pipeline(transaction=False)
+                for value in carbon_copy_values:
+                    reads.hget(self._lookup_key(field, value), self.prefix)
+                references = yield reads
+                for value, reference in zip(carbon_copy_values, references):
                     if reference:
-                        pipeline.srem(self.prefix+':'+reference+':'+field,
+                        pipeline.srem(self._entity_key(reference)+':'+field,
                                       value)
-                    pipeline.hset(field+':'+value, self.prefix, self.id)
-                else:
-                    pipeline.sadd(field+':'+value+':'+self.prefix, self.id)
+                    pipeline.hset(self._lookup_key(field, value),
+                                  self.prefix, self.id)
+            else:
+                bound = yield from self._bound_member_plan(plan)
+                for value in carbon_copy_values:
+                    pipeline.sadd(self._lookup_set_key(field, value), bound)
+
+        pipeline.sadd(self._key+':'+field, *members)
 
-        pipeline.sadd(self.prefix+':'+self._id+':'+field, *carbon_copy_values)
+    @classmethod
+    def _zset_plan(cls, field, method):
+        """ Returns the plan of field, raising KeyError if it is not a zset """
+        plan = cls._plans[field]
+        if plan.kind != 'zset':
+            raise KeyError('called '+method+' on non-zset field')
+        return plan
+
+    @classmethod
+    def _decode_zset_reply(cls, field, reply, withscores):
+        """ Coerce the raw reply of a zset range read into typed members, or
+        (member, score) pairs if withscores """
+        plan = cls._plans[field]
+        if withscores:
+            return [(plan.decode(member), plan.score(score))
+                    for member, score in reply]
+        return [plan.decode(member) for member in reply]
+
+    @staticmethod
+    def _zrangebyscore(client, key, min, max, limit, offset, withscores,
+                       desc=False):
+        """ Queue or run ZRANGEBYSCORE on client, see Entity.range """
+        command = client.zrevrangebyscore if desc else client.zrangebyscore
+        if limit is None and not offset:
+            return command(key, min, max, withscores=withscores)
+        if limit is None:
+            limit = -1
+        return command(key, min, max, start=offset, num=limit,
+                       withscores=withscores)
+
+    @check_field
+    def zscore(self, field, member):
+        """ Returns the score of member, or None if it is not in the zset """
+        plan = self._zset_plan(field, 'zscore')
+        score = self._db.zscore(self._key+':'+field, member)
+        if score is None:
+            return None
+        return plan.score(score)
+
+    @check_field
+    def zcard(self, field):
+        self._zset_plan(field, 'zcard')
+        return self._db.zcard(self._key+':'+field)
+
+    @check_field
+    def zrange(self, field, start=0, stop=-1, withscores=False):
+        """ Returns the members ranked start to stop inclusive from the lowest
+        score, as (member, score) pairs if withscores """
+        self._zset_plan(field, 'zrange')
+        reply = self._db.zrange(self._key+':'+field, start, stop,
+                                withscores=withscores)
+        return self._decode_zset_reply(field, reply, withscores)
 
     @check_field
-    def zscore(self, field, key):
-        assert type(self.fields[field] == zset)
-        return self._db.zscore(self.prefix+':'+self.id+':'+field, key)
+    def zrevrange(self, field, start=0, stop=-1, withscores=False):
+        """ Like zrange, ranking from the highest score """
+        self._zset_plan(field, 'zrevrange')
+        reply = self._db.zrevrange(self._key+':'+field, start, stop,
+                                   withscores=withscores)
+        return self._decode_zset_reply(field, reply, withscores)
 
     @check_field
-    def zrange(self, field, start, stop):
-        assert type(self.fields[field] == zset)
-        return self._db.zrange(self.prefix+':'+self.id+':'+field, start, stop)
+    def zrangebyscore(self, field, min, max, limit=None, offset=0,
+                      withscores=False):
+        """ Returns the members scored between min and max inclusive, ordered
+        by score. min and max can also be '-inf', '+inf', or prefixed with
+        '(' to be exclusive. At most limit members are returned after
+        skipping offset members.
+
+        """
+        self._zset_plan(field, 'zrangebyscore')
+        reply = self._zrangebyscore(self._db, self._key+':'+field, min, max,
+                                    limit, offset, withscores)
+        return self._decode_zset_reply(field, reply, withscores)
+
+    @check_field
+    def zrevrangebyscore(self, field, max, min, limit=None, offset=0,
+                         withscores=False):
+        """ Like zrangebyscore, ordered from the highest score """
+        self._zset_plan(field, 'zrevrangebyscore')
+        reply = self._zrangebyscore(self._db, self._key+':'+field, max, min,
+                                    limit, offset, withscores, desc=True)
+        return self._decode_zset_reply(field, reply, withscores)
+
+    @classmethod
+    @check_field
+    def zrange_many(cls, field, ids, db, start=0, stop=-1, withscores=False,
+                    chunk_size=1000):
+        """ Read the same rank range of field for many entities, using one
+        pipeline per chunk of chunk_size ids. Returns a list with the result
+        of zrange for each id, in the same order.
+
+        """
+        return _run(cls._zrange_many_plan(field, ids, db, start, stop,
+                                          withscores, chunk_size))
 
+    @classmethod
     @check_field
-    def zrevrange(self, field, start, stop):
-        assert type(self.fields[field] == zset)
-        return self._db.zrevrange(self.prefix+':'+self.id+':'+field,
-                                  start, stop)
+    def zrangebyscore_many(cls, field, ids, db, min, max, limit=None,
+                           offset=0, withscores=False, chunk_size=1000):
+        """ Like zrange_many, with the result of zrangebyscore for each id """
+        return _run(cls._zrangebyscore_many_plan(
+            field, ids, db, min, max, limit, offset, withscores, chunk_size))
+
+    @classmethod
+    def _zrange_many_plan(cls, field, ids, db, start, stop, withscores,
+                          chunk_size):
+        cls._zset_plan(field, 'zrange_many')
+
+        def read(pipeline, key):
+            pipeline.zrange(key, start, stop, withscores=withscores)
+        return cls._zread_many_plan(field, ids, db, read, withscores,
+                                    chunk_size)
+
+    @classmethod
+    def _zrangebyscore_many_plan(cls, field, ids, db, min, max, limit,
+                                 offset, withscores, chunk_size):
+        cls._zset_plan(field, 'zrangebyscore_many')
+
+        def read(pipeline, key):
+            cls._zrangebyscore(pipeline, key, min, max, limit, offset,
+                               withscores)
+        return cls._zread_many_plan(field, ids, db, read, withscores,
+                                    chunk_size)
+
+    @classmethod
+    def _zread_many_plan(cls, field, ids, db, read, withscores, chunk_size):
+        """ Queue read(pipeline, key) for the zset field of every id, one
+        pipeline per chunk, and decode the replies """
+        results = []
+        ids = list(ids)
+        for offset in range(0, len(ids), chunk_size):
+            pipeline = db.pipeline(transaction=False)
+            for id in ids[offset:offset+chunk_size]:
+                read(pipeline, cls._entity_key(id)+':'+field)
+            replies = yield pipeline
+            results.extend(cls._decode_zset_reply(field, reply, withscores)
+                           for reply in replies)
+        return results
 
     @check_field
     def zremrangebyrank(self, field, start, stop):
-        assert type(self.fields[field] == zset)
-        return self._db.zremrangebyrank(self.prefix+':'+self.id+':'+field,
+        self._zset_plan(field, 'zremrangebyrank')
+        return self._db.zremrangebyrank(self._key+':'+field,
                                         start, stop)
 
+    _zrevpop_script = _lua_script("""
+    local vals = redis.call('zrevrange', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+    if #vals > 0 then redis.call('zremrangebyrank', KEYS[1], -#vals, -1) end
+    return vals
+    """)
+
     @check_field
-    def zrevpop(self, field):
-        lua = """
-        local val = redis.call('zrange', KEYS[1], -1, -1)
-        if val then redis.call('zremrangebyrank', KEYS[1], -1, -1) end
-        return val
+    def zrevpop(self, field, count=None):
+        """ Atomically remove and return the member with the highest score.
+        If count is given, up to count members are popped in one round trip
+        and returned as a list ordered from highest to lowest score.
+
         """
-        multiply = self._db.register_script(lua)
-        result = multiply(keys=[self.prefix+':'+self.id+':'+field])
+        plan = self._zset_plan(field, 'zrevpop')
+        if count is not None and count <= 0:
+            # ZREVRANGE 0 -1 would pop the whole zset
+            return []
+        result = self._zrevpop_script(
+            self._db, keys=[self._key+':'+field],
+            args=[1 if count is None else count])
+        if count is not None:
+            return [plan.decode(member) for member in result]
         if result:
-            return result[0]
+            return plan.decode(result[0])
         else:
             return None
 
+    def _queue_zadd(self, field, mapping, pipeline):
+        """ Queue a single ZADD of mapping, a dict of members to scores, on
+        pipeline """
+        self._zset_plan(field, 'zadd')
+        args = []
+        for member, score in mapping.items():
+            if isinstance(member, Entity):
+                member = member.id
+            args.extend((score, member))
+        if args:
+            pipeline.execute_command('ZADD', self._key+':'+field, *args)
+
     @check_field
     @auto_pipeline
-    def zadd(self, field, *args,  pipeline=None, **kwargs):
-        assert type(self.fields[field] == zset)
+    def zadd(self, field, *args, pipeline=None):
+        """ Add members to the zset in a single command. Members are given
+        either as a dict of members to scores, or as member, score pairs of
+        arguments. """
         assert not field in self.lookups
         assert not field in self.relations
-        return pipeline.zadd(self.prefix+':'+self.id+':'+field, *args,
-                             **kwargs)
+        if len(args) == 1 and isinstance(args[0], dict):
+            mapping = args[0]
+        else:
+            mapping = dict(zip(args[0::2], args[1::2]))
+        return self._queue_zadd(field, mapping, pipeline)
 
     @check_field
     @auto_pipeline
     def zrem(self, field, *args, pipeline=None):
-        assert type(self.fields[field] == zset)
+        self._zset_plan(field, 'zrem')
         assert not field in self.lookups
         assert not field in self.relations
-        return pipeline.zrem(self.prefix+':'+self.id+':'+field, *args)
+        return pipeline.zrem(self._key+':'+field, *args)
 
-    def __init__(self, id, db, verify=True):
+    def __init__(self, id, db, verify=False):
+        """ Returns a handle to id. If verify is True, a round trip is made
+        to check that the entity exists, see also instance_many. """
         assert type(id) in (str, int)
         assert isinstance(db, redis.client.Pipeline) is False
         self._db = db
         self._id = id
-        # overhead
+        self._key = self._entity_key(id)
         if verify and not self.__class__.exists(id, db):
             raise KeyError(id, 'has not been created yet')
-        self.__dict__['_id'] = id
+
+
+_trace_methods(Entity)
@@ -5,6 +5,7 @@ import (
 	"compress/gzip"
 	"container/list"
 	"crypto/md5"
+	"crypto/sha256"
 	"encoding/base64"
 	"encoding/hex"
 	"encoding/json"
@@ -30,6 +31,11 @@ import (
 
 var _ = fmt.Printf
 
+// Unused blobs are collected every BLOB_SWEEP_INTERVAL seconds, once they are
+// older than BLOB_GRACE_PERIOD seconds.
+const BLOB_SWEEP_INTERVAL = 60
+const BLOB_GRACE_PERIOD = 600
+
 type Application struct {
 	Config  Configuration
 	Mongo   *mgo.Session
@@ -40,6 +46,7 @@ type Application struct {
 	stats      *list.List // things we put in this list should persist when server dies
 	statsWG    sync.WaitGroup
 	statsMutex sync.Mutex
+	blobsMutex sync.RWMutex // held for writing while blobs are collected
 	shutdown   chan os.Signal
 	finish     chan struct{}
 }
@@ -120,9 +127,11 @@ func (app *Application) drainStats() {
 	app.statsMutex.Unlock()
 }
 
-// A separate goroutine that populates MongoDB with stats entries.
+// A separate goroutine that populates MongoDB with stats entries. It also
+// collects the unused blobs every BLOB_SWEEP_INTERVAL seconds.
 func (app *Application) RecordDeferredDocs() {
 	defer app.statsWG.Done()
+	lastSweep := time.Now()
 	for {
 		select {
 		case <-app.finish:
@@ -133,6 +142,10 @@ func (app *Application) RecordDeferredDocs() {
 			return
 		default:
 			app.drainStats()
+			if time.Since(lastSweep) > BLOB_SWEEP_INTERVAL*time.Second {
+				app.CollectBlobs(BLOB_GRACE_PERIOD * time.Second)
+				lastSweep = time.Now()
+			}
 			time.Sleep(1 * time.Second)
 		}
 	}
@@ -214,6 +227,8 @@ func (app *Application) LoadStreams() {
 		}
 	}
 
+	app.CollectBlobs(BLOB_GRACE_PERIOD * time.Second)
+
 	for _, stream := range mongoStreamIds {
 		stream_copy := stream
 		if stream.MongoStatus == "enabled" {
@@ -250,6 +265,8 @@ func NewApplication(config Configuration) *Application {
 	app.Router.Handle("/", app.AliveHandler()).Methods("GET")
 	app.Router.Handle("/active_streams", app.ActiveStreamsHandler()).Methods("GET")
 	app.Router.Handle("/streams", app.StreamsHandler()).Methods("POST")
+	app.Router.Handle("/blobs/missing", app.BlobsMissingHandler()).Methods("POST")
+	app.Router.Handle("/blobs/{hash}", app.BlobUploadHandler()).Methods("PUT")
 	app.Router.Handle("/streams/info/{stream_id}", app.StreamInfoHandler()).Methods("GET")
 	app.Router.Handle("/streams/activate", app.StreamActivateHandler()).Methods("POST")
 	app.Router.Handle("/streams/download/{stream_id}/{file:.+}", app.StreamDownloadHandler()).Methods("GET")
@@ -330,6 +347,20 @@ func (app *Application) StreamDir(stream_id string) string {
 	return filepath.Join(app.Config.Name+"_data", "streams", stream_id)
 }
 
+// Return a path indicating where content addressed seed files are stored
+func (app *Application) BlobDir() string {
+	return filepath.Join(app.Config.Name+"_data", "blobs")
+}
+
+// Returns true if hash is a well formed hex encoded sha256 digest.
+func validBlobHash(hash string) bool {
+	if len(hash) != 2*sha256.Size {
+		return false
+	}
+	_, err := hex.DecodeString(hash)
+	return err == nil
+}
+
 // Starts the server. Listens and serves asynchronously. Also sets up necessary
 // signal handlers for graceful termination. This blocks until a signal is sent
 func (app *Application) Run() {
@@ -662,6 +693,8 @@ func (app *Application) StreamDisableHandler() AppHandler {
         }
     .. note:: When all streams belonging to a target is removed, the
         target and shard information is cleaned up automatically.
+    .. note:: The files of the stream are removed shortly after. Blobs no
+        other stream links to are removed by the next blob collection.
     :status 200: OK
     :status 400: Bad request
 */
@@ -677,7 +710,13 @@ func (app *Application) StreamDeleteHandler() AppHandler {
 			return err
 		}
 		fn1 := func() error {
-			return app.StreamsCursor().RemoveId(streamId)
+			err := app.StreamsCursor().RemoveId(streamId)
+			if err != nil {
+				return err
+			}
+			// LoadStreams requires the files of every stream in Mongo, so
+			// they are only removed now. This unlinks the stream's blobs.
+			return os.RemoveAll(app.StreamDir(streamId))
 		}
 		app.statsMutex.Lock()
 		app.stats.PushBack(fn1)
@@ -686,6 +725,143 @@ func (app *Application) StreamDeleteHandler() AppHandler {
 	}
 }
 
+/*
+.. http:post:: /blobs/missing
+    Given a list of sha256 hashes, return the ones that have not been
+    uploaded to this SCV yet.
+    :reqheader Authorization: manager authorization token
+    **Example request**
+    .. sourcecode:: javascript
+        {
+            "hashes": ["9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08", ...]
+        }
+    **Example reply**
+    .. sourcecode:: javascript
+        {
+            "missing": ["9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08"]
+        }
+    :status 200: OK
+    :status 400: Bad request
+*/
+func (app *Application) BlobsMissingHandler() AppHandler {
+	return func(w http.ResponseWriter, r *http.Request) (err error) {
+		_, auth_err := app.CurrentManager(r)
+		if auth_err != nil {
+			return auth_err
+		}
+		type Message struct {
+			Hashes []string `json:"hashes"`
+		}
+		msg := Message{}
+		decoder := json.NewDecoder(r.Body)
+		err = decoder.Decode(&msg)
+		if err != nil {
+			return errors.New("Bad request: " + err.Error())
+		}
+		missing := make([]string, 0)
+		now := time.Now()
+		app.blobsMutex.RLock()
+		defer app.blobsMutex.RUnlock()
+		for _, hash := range msg.Hashes {
+			if validBlobHash(hash) == false {
+				return errors.New("Bad hash: " + hash)
+			}
+			// touch the blobs found so they are kept until they are linked
+			if e := os.Chtimes(filepath.Join(app.BlobDir(), hash), now, now); e != nil {
+				missing = append(missing, hash)
+			}
+		}
+		data, _ := json.Marshal(map[string][]string{"missing": missing})
+		w.Write(data)
+		return
+	}
+}
+
+/*
+.. http:put:: /blobs/:hash
+    Upload a seed file that can be shared by many streams. The body is
+    stored as is, and must hash to ``hash`` under sha256.
+    :reqheader Authorization: manager authorization token
+    :status 200: OK
+    :status 400: Bad request
+*/
+func (app *Application) BlobUploadHandler() AppHandler {
+	return func(w http.ResponseWriter, r *http.Request) (err error) {
+		_, auth_err := app.CurrentManager(r)
+		if auth_err != nil {
+			return auth_err
+		}
+		hash := mux.Vars(r)["hash"]
+		if validBlobHash(hash) == false {
+			return errors.New("Bad hash: " + hash)
+		}
+		body, err := ioutil.ReadAll(r.Body)
+		if err != nil {
+			return errors.New("Unable to read body.")
+		}
+		sum := sha256.Sum256(body)
+		if hex.EncodeToString(sum[:]) != hash {
+			return errors.New("Hash mismatch.")
+		}
+		os.MkdirAll(app.BlobDir(), 0776)
+		// write to a temporary file first so concurrent readers never see a
+		// partially written blob.
+		tmpFile, err := ioutil.TempFile(app.BlobDir(), "upload_")
+		if err != nil {
+			return err
+		}
+		_, err = tmpFile.Write(body)
+		tmpFile.Close()
+		if err != nil {
+			os.Remove(tmpFile.Name())
+			return err
+		}
+		return os.Rename(tmpFile.Name(), filepath.Join(app.BlobDir(), hash))
+	}
+}
+
+// Remove the blobs that no stream links to anymore, ie. whose link count
+// dropped back to one, unless they were uploaded or reported present by
+// /blobs/missing within maxAge, since a stream may be about to use them.
+// Returns the number of blobs removed.
+func (app *Application) CollectBlobs(maxAge time.Duration) int {
+	app.blobsMutex.Lock()
+	defer app.blobsMutex.Unlock()
+	fileData, err := ioutil.ReadDir(app.BlobDir())
+	if err != nil {
+		return 0
+	}
+	removed := 0
+	deadline := time.Now().Add(-maxAge)
+	for _, info := range fileData {
+		if validBlobHash(info.Name()) == false || info.ModTime().After(deadline) {
+			continue
+		}
+		stat, ok := info.Sys().(*syscall.Stat_t)
+		if ok && stat.Nlink == 1 {
+			if os.Remove(filepath.Join(app.BlobDir(), info.Name())) == nil {
+				removed += 1
+			}
+		}
+	}
+	return removed
+}
+
+// Place blob hash at path. Blobs are hard linked so streams sharing a seed
+// file share its storage, falling back to a copy if linking is unsupported.
+// A blob is removed by CollectBlobs once the streams linking it are deleted.
+func (app *Application) linkBlob(hash, path string) error {
+	blobPath := filepath.Join(app.BlobDir(), hash)
+	if err := os.Link(blobPath, path); err == nil {
+		return nil
+	}
+	binary, err := ioutil.ReadFile(blobPath)
+	if err != nil {
+		return errors.New("Unable to read blob " + hash)
+	}
+	return ioutil.WriteFile(path, binary, 0776)
+}
+
 /*
 .. http:post:: /streams
     Add a new stream to this SCV.
@@ -699,10 +875,15 @@ func (app *Application) StreamDeleteHandler() AppHandler {
             }
             "tags": {
                 "pdb.gz.b64": "file4.b64",
+            }, // optional
+            "blobs": {
+                "system.xml.gz.b64": "sha256 of file5.b64"
             } // optional
         }
     .. note:: Binary files must be base64 encoded.
     .. note:: tags are files that are not used by the core.
+    .. note:: blobs are seed files previously uploaded via ``/blobs/:hash``,
+        referenced by their hash. They are placed alongside ``files``.
     **Example reply**
     .. sourcecode:: javascript
         {
@@ -721,6 +902,7 @@ func (app *Application) StreamsHandler() AppHandler {
 			TargetId string            `json:"target_id"`
 			Files    map[string]string `json:"files"`
 			Tags     map[string]string `json:"tags,omitempty"`
+			Blobs    map[string]string `json:"blobs,omitempty"`
 		}
 		msg := Message{}
 		decoder := json.NewDecoder(r.Body)
@@ -728,6 +910,16 @@ func (app *Application) StreamsHandler() AppHandler {
 		if err != nil {
 			return errors.New("Bad request: " + err.Error())
 		}
+		app.blobsMutex.RLock()
+		defer app.blobsMutex.RUnlock()
+		for _, hash := range msg.Blobs {
+			if validBlobHash(hash) == false {
+				return errors.New("Bad hash: " + hash)
+			}
+			if _, e := os.Stat(filepath.Join(app.BlobDir(), hash)); e != nil {
+				return errors.New("Unknown blob: " + hash)
+			}
+		}
 		streamId := RandSeq(36) + ":" + app.Config.Name
 		// Add files to disk
 		stream := NewStream(streamId, msg.TargetId, user, 0, 0, int(time.Now().Unix()))
@@ -742,6 +934,15 @@ func (app *Application) StreamsHandler() AppHandler {
 				}
 			}
 		}
+		for filename, hash := range msg.Blobs {
+			files_dir := filepath.Join(app.StreamDir(streamId), "files")
+			os.MkdirAll(files_dir, 0776)
+			err = app.linkBlob(hash, filepath.Join(files_dir, filename))
+			if err != nil {
+				os.RemoveAll(app.StreamDir(streamId))
+				return err
+			}
+		}
 		cursor := app.StreamsCursor()
 		err = cursor.Insert(stream)
 		if err != nil {
@@ -3,6 +3,7 @@ package scv
 import (
 	"bytes"
 	"crypto/md5"
+	"crypto/sha256"
 	"encoding/hex"
 	"encoding/json"
 	"fmt"
@@ -270,6 +271,30 @@ func (f *Fixture) postStream(token string, data string) (stream_id string, code
 	return
 }
 
+func (f *Fixture) uploadBlob(token string, data []byte) (hash string, code int) {
+	sum := sha256.Sum256(data)
+	hash = hex.EncodeToString(sum[:])
+	req, _ := http.NewRequest("PUT", "/blobs/"+hash, bytes.NewBuffer(data))
+	req.Header.Add("Authorization", token)
+	w := httptest.NewRecorder()
+	f.app.Router.ServeHTTP(w, req)
+	code = w.Code
+	return
+}
+
+func (f *Fixture) missingBlobs(token string, hashes []string) (missing []string, code int) {
+	data, _ := json.Marshal(map[string][]string{"hashes": hashes})
+	req, _ := http.NewRequest("POST", "/blobs/missing", bytes.NewBuffer(data))
+	req.Header.Add("Authorization", token)
+	w := httptest.NewRecorder()
+	f.app.Router.ServeHTTP(w, req)
+	code = w.Code
+	reply := make(map[string][]string)
+	json.Unmarshal(w.Body.Bytes(), &reply)
+	missing = reply["missing"]
+	return
+}
+
 func (f *Fixture) deleteStream(token, streamId string) (code int) {
 	req, _ := http.NewRequest("PUT", "/streams/delete/"+streamId, nil)
 	req.Header.Add("Authorization", token)
@@ -615,6 +640,74 @@ func TestDownload(t *testing.T) {
 
 }
 
+func TestPostStreamBlobs(t *testing.T) {
+	f := NewFixture()
+	defer f.shutdown()
+	token := f.addManager("yutong", 1)
+	f.addTarget("12345", "yutong", `{"options": {"steps_per_frame": 1}}`)
+	sum := sha256.Sum256([]byte("b123"))
+	systemHash := hex.EncodeToString(sum[:])
+	missing, code := f.missingBlobs(token, []string{systemHash})
+	assert.Equal(t, code, 200)
+	assert.Equal(t, missing, []string{systemHash})
+	// referencing an unknown blob fails
+	jsonData := `{"target_id":"12345", "files": {"state": "b234"},
+		"blobs": {"system": "` + systemHash + `"}}`
+	_, code = f.postStream(token, jsonData)
+	assert.Equal(t, code, 400)
+	// mismatched hashes are rejected
+	req, _ := http.NewRequest("PUT", "/blobs/"+systemHash, bytes.NewBuffer([]byte("b12")))
+	req.Header.Add("Authorization", token)
+	w := httptest.NewRecorder()
+	f.app.Router.ServeHTTP(w, req)
+	assert.Equal(t, w.Code, 400)
+	hash, code := f.uploadBlob(token, []byte("b123"))
+	assert.Equal(t, code, 200)
+	assert.Equal(t, hash, systemHash)
+	missing, _ = f.missingBlobs(token, []string{systemHash})
+	assert.Equal(t, len(missing), 0)
+	stream1, code := f.postStream(token, jsonData)
+	assert.Equal(t, code, 200)
+	stream2, code := f.postStream(token, jsonData)
+	assert.Equal(t, code, 200)
+	assert.Equal(t, f.download(token, stream1, "files/system"), []byte("b123"))
+	assert.Equal(t, f.download(token, stream2, "files/system"), []byte("b123"))
+	assert.Equal(t, f.download(token, stream2, "files/state"), []byte("b234"))
+	assert.Equal(t, f.deleteStream(token, stream1), 200)
+	assert.Equal(t, f.download(token, stream2, "files/system"), []byte("b123"))
+}
+
+func TestCollectBlobs(t *testing.T) {
+	f := NewFixture()
+	defer f.shutdown()
+	token := f.addManager("yutong", 1)
+	f.addTarget("12345", "yutong", `{"options": {"steps_per_frame": 1}}`)
+	systemHash, _ := f.uploadBlob(token, []byte("b123"))
+	jsonData := `{"target_id":"12345", "files": {"state": "b234"},
+		"blobs": {"system": "` + systemHash + `"}}`
+	stream1, _ := f.postStream(token, jsonData)
+	stream2, _ := f.postStream(token, jsonData)
+	unusedHash, _ := f.uploadBlob(token, []byte("b345"))
+	// recently uploaded blobs are kept until the grace period is over
+	assert.Equal(t, f.app.CollectBlobs(BLOB_GRACE_PERIOD*time.Second), 0)
+	missing, _ := f.missingBlobs(token, []string{unusedHash})
+	assert.Equal(t, len(missing), 0)
+	assert.Equal(t, f.app.CollectBlobs(0), 1)
+	missing, _ = f.missingBlobs(token, []string{systemHash, unusedHash})
+	assert.Equal(t, missing, []string{unusedHash})
+	assert.Equal(t, f.deleteStream(token, stream1), 200)
+	time.Sleep(time.Second)
+	_, err := os.Stat(f.app.StreamDir(stream1))
+	assert.True(t, os.IsNotExist(err))
+	assert.Equal(t, f.app.CollectBlobs(0), 0)
+	assert.Equal(t, f.download(token, stream2, "files/system"), []byte("b123"))
+	assert.Equal(t, f.deleteStream(token, stream2), 200)
+	time.Sleep(time.Second)
+	assert.Equal(t, f.app.CollectBlobs(0), 1)
+	missing, _ = f.missingBlobs(token, []string{systemHash})
+	assert.Equal(t, missing, []string{systemHash})
+}
+
 func TestPostStreamAsync(t *testing.T) {
 	f := NewFixture()
 	defer f.shutdown()
@@ -3,4 +3,5 @@ from .base import list_targets
 from .base import load_target
 from .base import load_stream
 from .base import add_target
-from .base import scvs
\ No newline at end of file
+from .base import scvs
+from .base import scv_directory
\ No newline at end of file
@@ -0,0 +1,542 @@
+# Authors: Yutong Zhao <proteneer@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" asyncio flavor of the siegetank API. Unlike siegetank.base, there is no
+module level state: every call goes through a Session which owns the auth
+token, the cc, the scv table and a single connection pool, which is created
+on first use inside the running event loop.
+
+Example:
+
+    async def main():
+        async with siegetank.aio.Session(token, 'cc.proteneer.com') as st:
+            for target in await st.list_targets():
+                streams = await target.streams()
+                await asyncio.gather(*[s.sync(s.id) for s in streams])
+
+    asyncio.get_event_loop().run_until_complete(main())
+
+This module requires Python 3.6 and aiohttp 3.3 or later, pinned in
+requirements-aio.txt.
+
+"""
+
+import asyncio
+import json
+import os
+import time
+
+import aiohttp
+
+from siegetank.util import is_domain, encode_files, encode_files_many
+from siegetank.util import hash_file, share_files, read_file
+from siegetank.util import DEFAULT_COMPRESSLEVEL
+
+
+class Session:
+    """ A Session is a logged in connection to a command center. All targets
+    and streams created from the session share its connection pool. """
+
+    def __init__(self, token, cc='cc.proteneer.com', limit=100,
+                 limit_per_host=20, timeout=10):
+        """ Create a new session.
+
+        :param token: str, your authorization token.
+        :param cc: str, the command center to login to.
+        :param limit: int, maximum number of concurrent connections.
+        :param limit_per_host: int, maximum number of concurrent connections
+            to any single cc or scv.
+        :param timeout: float, default timeout in seconds for connecting to
+            a host and for each read. Time spent waiting for a free
+            connection in the pool is not counted.
+
+        """
+        self.token = token
+        self.cc = cc
+        self.scvs = dict()
+        self._last_scvs_refresh = 0
+        self._scvs_lock = None
+        self._timeout = timeout
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._http = None
+
+    async def __aenter__(self):
+        await self.login()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        """ Close the underlying connection pool. """
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+
+    def _client(self):
+        """ Return the aiohttp session, creating it on first use so that it
+            is bound to the running event loop. """
+        if self._http is None:
+            connector = aiohttp.TCPConnector(
+                limit=self._limit, limit_per_host=self._limit_per_host)
+            self._http = aiohttp.ClientSession(connector=connector)
+        return self._http
+
+    async def _request(self, method, host, path, body=None, headers=None,
+                       timeout=None):
+        """ Issue a request and return (status, body bytes). """
+        if headers is None:
+            headers = {}
+        headers['Authorization'] = self.token
+        if timeout is None:
+            timeout = self._timeout
+        url = 'https://'+host+path
+        ssl = None if is_domain(host) else False
+        # a total timeout would also count the time spent queued behind the
+        # connection limits, failing large gathers of otherwise fast requests
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout,
+                                        sock_read=timeout)
+        async with self._client().request(
+                method, url, data=body, headers=headers, ssl=ssl,
+                timeout=timeout) as reply:
+            return reply.status, await reply.read()
+
+    async def _get(self, host, path, **kwargs):
+        return await self._request('GET', host, path, **kwargs)
+
+    async def _put(self, host, path, body='{}', **kwargs):
+        return await self._request('PUT', host, path, body=body, **kwargs)
+
+    async def _post(self, host, path, body='{}', **kwargs):
+        return await self._request('POST', host, path, body=body, **kwargs)
+
+    async def login(self):
+        """ Verify the token against the cc and load the scvs. """
+        status, content = await self._get(self.cc, '/users/verify')
+        if status != 200:
+            raise Exception('Bad credentials: '+content.decode())
+        await self.refresh_scvs()
+
+    async def refresh_scvs(self):
+        """ Update and return the status of the SCVs. This method is rate
+            limited to once every second, and concurrent callers wait for the
+            refresh in flight instead of issuing their own. """
+        if self._scvs_lock is None:
+            self._scvs_lock = asyncio.Lock()
+        async with self._scvs_lock:
+            if time.time() - self._last_scvs_refresh > 1:
+                status, content = await self._get(self.cc, '/scvs/status')
+                if status == 200:
+                    scvs = json.loads(content.decode())
+                    for scv_name, scv_prop in scvs.items():
+                        self.scvs[scv_name] = scv_prop
+                    self._last_scvs_refresh = time.time()
+        return self.scvs
+
+    async def scv_host(self, scv_name):
+        """ Return the host of an scv, refreshing the scvs if unknown. """
+        if scv_name not in self.scvs:
+            await self.refresh_scvs()
+        return self.scvs[scv_name]['host']
+
+    async def add_target(self, options, engines, weight=1, stage='private'):
+        """ Add a target.
+
+        :param options: dict, describing target's options.
+        :param engine: list, eg. ["openmm_60_opencl", "openmm_50_cuda"]
+        :param stage: str, stage of the target, allowed values are 'disabled',
+            'private', 'public'
+        :param weight: int, the weight of the target relative to your other
+            targets
+
+        """
+        assert type(engines) == list
+        body = {
+            'options': options,
+            'engines': engines,
+            'stage': stage,
+            'weight': weight
+        }
+        status, content = await self._post(self.cc, '/targets',
+                                           json.dumps(body))
+        if status != 200:
+            raise Exception('Cannot add target: '+content.decode())
+        return Target(self, json.loads(content.decode())['target_id'])
+
+    async def list_targets(self):
+        """ Return a list of targets. """
+        status, content = await self._get(self.cc, '/targets')
+        if status != 200:
+            raise Exception('Cannot list targets')
+        target_ids = json.loads(content.decode())['targets']
+        return [Target(self, target_id) for target_id in target_ids]
+
+    def load_target(self, target_id):
+        """ Retrieve an existing target object. No request is made. """
+        return Target(self, target_id)
+
+    def load_stream(self, stream_id):
+        """ Retrieve an existing stream object. No request is made. """
+        return Stream(self, stream_id)
+
+
+class Stream:
+    """ A Stream is a single trajectory residing on a remote server. """
+
+    def __init__(self, session, stream_id):
+        """ Retrieve an existing stream object.
+
+        :param session: Session, the session the stream belongs to.
+        :param stream_id: str, id of the stream.
+
+        """
+        self._session = session
+        self._id = stream_id
+        self._frames = None
+        self._status = None
+        self._error_count = None
+        self._active = None
+
+    def __repr__(self):
+        return '<stream '+str(self.id)+' s:'+str(self._status)+' f:' + \
+            str(self._frames)+'>'
+
+    async def _host(self):
+        return await self._session.scv_host(self.id.split(':')[1])
+
+    async def _check(self, coro):
+        status, content = await coro
+        if status != 200:
+            raise Exception('Bad status code: '+content.decode())
+        return content
+
+    async def enable(self):
+        """ Start this stream. """
+        host = await self._host()
+        await self._check(self._session._put(host, '/streams/enable/'+self.id))
+        await self.reload_info()
+
+    async def disable(self):
+        """ Stop this stream. """
+        host = await self._host()
+        await self._check(self._session._put(host,
+                                             '/streams/disable/'+self.id))
+        await self.reload_info()
+
+    async def delete(self):
+        """ Delete this stream from the SCV. You must take care to not
+        use this stream object anymore afterwards.
+
+        """
+        host = await self._host()
+        await self._check(self._session._put(host, '/streams/delete/'+self.id))
+        self._id = None
+
+    async def download(self, filename):
+        """ Download a file from the stream.
+
+        :param filename: name of the file. eg. '2/checkpoint_files/state.xml.gz'
+
+        """
+        host = await self._host()
+        return await self._check(self._session._get(
+            host, '/streams/download/'+self.id+'/'+filename))
+
+    async def partitions(self):
+        """ Return a list of partitions for this stream. """
+        host = await self._host()
+        content = await self._check(self._session._get(
+            host, '/streams/sync/'+self.id))
+        return json.loads(content.decode())['partitions']
+
+    async def sync(self, folder):
+        """ Sync the data for a given stream. This method performs an
+        incremental update and should be ran periodically. Missing frame files
+        are downloaded concurrently, subject to the session's limits.
+
+        :param folder: str, the directory to sync the streams's data to.
+
+        """
+        host = await self._host()
+        content = await self._check(self._session._get(
+            host, '/streams/sync/'+self.id))
+        content = json.loads(content.decode())
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        async def fetch(partition, frame_n):
+            filedata = await self.download(
+                os.path.join(str(partition), '0', frame_n))
+            filepath = os.path.join(folder, str(partition), frame_n)
+            with open(filepath, 'wb') as handle:
+                handle.write(filedata)
+
+        required = set(str(item) for item in content['frame_files'])
+        jobs = []
+        for partition in content['partitions']:
+            p_dir = os.path.join(folder, str(partition))
+            if not os.path.exists(p_dir):
+                os.makedirs(p_dir)
+            for frame_n in required - set(os.listdir(p_dir)):
+                jobs.append(fetch(partition, frame_n))
+        await asyncio.gather(*jobs)
+
+    async def reload_info(self):
+        host = await self._host()
+        content = await self._check(self._session._get(
+            host, '/streams/info/'+self.id))
+        content = json.loads(content.decode())
+        self._frames = content['frames']
+        self._status = content['status']
+        self._error_count = content['error_count']
+        self._active = content['active']
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def active(self):
+        """ Returns True if the stream is worked on by a core. Call
+        reload_info() to refresh. """
+        return self._active
+
+    @property
+    def frames(self):
+        """ Return the number of frames completed as of the last
+        reload_info(). """
+        return self._frames
+
+    @property
+    def status(self):
+        """ Return the status of the stream as of the last reload_info(). """
+        return self._status
+
+    @property
+    def error_count(self):
+        """ Return the number of errors as of the last reload_info(). """
+        return self._error_count
+
+
+class Target:
+    """ A Target is a collection of Streams residing on a remote server. """
+
+    def __init__(self, session, target_id):
+        """ Retrieve an existing target object.
+
+        :param session: Session, the session the target belongs to.
+        :param target_id: str, id of the target.
+
+        """
+        self._session = session
+        self._id = target_id
+        self._options = None
+        self._creation_date = None
+        self._engines = None
+        self._weight = None
+        self._stage = None
+        self._owner = None
+
+    def __repr__(self):
+        return '<target '+str(self.id)+'>'
+
+    async def delete(self):
+        """ Delete this target from the backend """
+        status, content = await self._session._put(
+            self._session.cc, '/targets/delete/'+self.id)
+        if status != 200:
+            raise Exception('Bad status code: '+content.decode())
+        self._id = None
+
+    async def update(self, options=None, engines=None, weight=None,
+                     stage=None):
+        """ Update the target. This method cannot delete properties, only add
+        or modify new properties.
+
+        """
+        message = dict()
+        if options:
+            message['options'] = options
+        if engines:
+            message['engines'] = engines
+        if weight:
+            message['weight'] = weight
+        if stage:
+            message['stage'] = stage
+        status, content = await self._session._put(
+            self._session.cc, '/targets/update/'+self.id, json.dumps(message))
+        if status != 200:
+            raise Exception('could not update target. Reason:' +
+                            content.decode())
+        await self.reload_info()
+
+    async def add_stream(self, files, scv, tags=None, dedup=False,
+                         encode=False, compresslevel=DEFAULT_COMPRESSLEVEL):
+        """ Add a stream to the target belonging to a particular scv.
+
+        :param files: dict, filenames and binaries matching the core's
+            requirements.
+        :param scv: str, which particular SCV to add the stream to.
+        :param tags: dict, a dictionary of tag files to include, such as pdbs
+        :param dedup: bool, if True, files are uploaded to the scv as blobs
+            identified by their sha256, and only blobs the scv does not
+            already have are sent.
+        :param encode: bool, if True, files not ending in .b64 are encoded as
+            per util.encode_files in the default executor.
+        :param compresslevel: int, gzip level used when encode is True.
+
+        """
+        assert isinstance(files, dict)
+        if encode:
+            files = await asyncio.get_event_loop().run_in_executor(
+                None, encode_files, files, compresslevel)
+        if dedup:
+            files = dict((name, read_file(value))
+                         for name, value in files.items())
+            blobs = {name: hash_file(value) for name, value in files.items()}
+            await self._upload_blobs(scv, {blobs[name]: value for name, value
+                                           in files.items()})
+            return await self._add_stream({}, scv, tags, blobs)
+        return await self._add_stream(files, scv, tags)
+
+    async def add_streams(self, list_of_files, scv, tags=None, processes=None,
+                          dedup=True, encode=False,
+                          compresslevel=DEFAULT_COMPRESSLEVEL):
+        """ Add many streams to the target belonging to a particular scv. The
+        streams are uploaded concurrently, subject to the session's limits.
+
+        :param list_of_files: list of dicts, one per stream, of filenames and
+            binaries matching the core's requirements.
+        :param scv: str, which particular SCV to add the streams to.
+        :param tags: dict, a dictionary of tag files to include in every stream
+        :param processes: int, number of encoding processes, defaults to the
+            number of cpus.
+        :param dedup: bool, if True, each file shared by two streams or more
+            is uploaded to the scv once as a blob and the streams reference
+            it by hash, see util.share_files.
+        :param encode: bool, if True, files are encoded as per
+            util.encode_files_many, as in siegetank.base.Target.add_streams.
+        :param compresslevel: int, gzip level used when encode is True.
+
+        Returns a list of Streams in the same order as list_of_files.
+
+        """
+        assert all(isinstance(files, dict) for files in list_of_files)
+        if encode:
+            list_of_files = await asyncio.get_event_loop().run_in_executor(
+                None, encode_files_many, list_of_files, processes,
+                compresslevel)
+        if dedup:
+            blobs, streams = share_files(list_of_files)
+            if blobs:
+                await self._upload_blobs(scv, blobs)
+            jobs = [self._add_stream(files, scv, tags, hashes)
+                    for files, hashes in streams]
+        else:
+            jobs = [self._add_stream(files, scv, tags)
+                    for files in list_of_files]
+        return list(await asyncio.gather(*jobs))
+
+    async def _upload_blobs(self, scv, blobs):
+        """ Upload the blobs, a dict of sha256 to encoded file, that scv does
+            not have yet. """
+        host = await self._session.scv_host(scv)
+        status, content = await self._session._post(
+            host, '/blobs/missing', json.dumps({'hashes': list(blobs)}))
+        if status != 200:
+            raise Exception('Bad status code: '+content.decode())
+
+        async def upload(blob_hash):
+            value = blobs[blob_hash]
+            if isinstance(value, str):
+                value = value.encode()
+            status, content = await self._session._put(
+                host, '/blobs/'+blob_hash, value)
+            if status != 200:
+                raise Exception('Bad status code: '+content.decode())
+
+        missing = json.loads(content.decode())['missing']
+        await asyncio.gather(*[upload(blob_hash) for blob_hash in missing])
+
+    async def _add_stream(self, files, scv, tags=None, blobs=None):
+        body = {
+            'target_id': self.id,
+            'files': files,
+        }
+        if tags:
+            body['tags'] = tags
+        if blobs:
+            body['blobs'] = blobs
+        host = await self._session.scv_host(scv)
+        status, content = await self._session._post(host, '/streams',
+                                                    json.dumps(body))
+        if status != 200:
+            raise Exception('Bad status code: '+content.decode())
+        stream_id = json.loads(content.decode())['stream_id']
+        return Stream(self._session, stream_id)
+
+    async def reload_info(self):
+        """ Reload the target's information """
+        status, content = await self._session._get(
+            self._session.cc, '/targets/info/'+self.id)
+        if status != 200:
+            raise Exception('Failed to load target info')
+        info = json.loads(content.decode())
+        self._options = info['options']
+        self._creation_date = info['creation_date']
+        self._engines = info['engines']
+        self._weight = info['weight']
+        self._stage = info['stage']
+        self._owner = info['owner']
+
+    async def streams(self):
+        """ Get the list of streams in this target. """
+        status, content = await self._session._get(
+            self._session.cc, '/targets/streams/'+self.id)
+        if status != 200:
+            raise Exception('Failed to load streams: '+content.decode())
+        await self._session.refresh_scvs()
+        return [Stream(self._session, stream_id) for stream_id in
+                json.loads(content.decode())['streams']]
+
+    @property
+    def id(self):
+        """ Get the target id """
+        return self._id
+
+    @property
+    def options(self):
+        return self._options
+
+    @property
+    def owner(self):
+        return self._owner
+
+    @property
+    def creation_date(self):
+        return self._creation_date
+
+    @property
+    def engines(self):
+        return self._engines
+
+    @property
+    def weight(self):
+        return self._weight
+
+    @property
+    def stage(self):
+        return self._stage
@@ -20,12 +20,98 @@ import os
 import hashlib
 import functools
 import time
-from siegetank.util import is_domain, encode_files
+import threading
+import concurrent.futures
+from siegetank.util import is_domain, encode_files, encode_files_many
+from siegetank.util import hash_file, iter_stream_body, DEFAULT_COMPRESSLEVEL
+from siegetank.util import share_files, read_file
 
 auth_token = None
 login_cc = None
-scvs = dict()
-last_scvs_refresh = 0
+
+
+class SCVDirectory:
+    """ A thread-safe cache of the SCVs known to the logged in cc. Reads are
+    served from the cache while it is younger than ttl seconds. A stale cache
+    is refreshed by the first caller to notice; concurrent callers keep
+    getting the stale copy rather than waiting on the refresh in flight.
+    Lookups of unknown scvs refresh at most once every min_interval seconds.
+    """
+
+    def __init__(self, ttl=2, min_interval=1, timeout=10):
+        """
+        :param ttl: float, number of seconds a refresh stays valid.
+        :param min_interval: float, minimum number of seconds between the
+            refreshes forced by lookups of unknown scvs.
+        :param timeout: float, seconds to wait for the cc before a refresh
+            fails, so that a hung cc cannot block every caller.
+
+        """
+        self.ttl = ttl
+        self.min_interval = min_interval
+        self.timeout = timeout
+        # kept as the same dict object so siegetank.scvs remains usable
+        self.scvs = dict()
+        self._last_refresh = 0
+        self._refreshing = False
+        self._cond = threading.Condition()
+
+    def refresh(self, max_age=0, wait=False):
+        """ Reload the SCVs from the cc unless the cache is younger than
+        max_age seconds, and return a copy of the SCVs. If another thread is
+        already refreshing, this returns the current copy immediately, only
+        waiting if nothing has been loaded yet or if wait is True.
+
+        """
+        with self._cond:
+            if wait:
+                self._cond.wait_for(lambda: not self._refreshing)
+            if time.time() - self._last_refresh < max_age:
+                return dict(self.scvs)
+            if self._refreshing:
+                if not self.scvs:
+                    self._cond.wait_for(lambda: not self._refreshing)
+                return dict(self.scvs)
+            self._refreshing = True
+        content = None
+        try:
+            url = 'https://'+login_cc+'/scvs/status'
+            reply = requests.get(url, verify=is_domain(login_cc),
+                                 timeout=self.timeout)
+            if reply.status_code == 200:
+                content = reply.json()
+        finally:
+            with self._cond:
+                if content is not None:
+                    # sets host and status fields
+                    self.scvs.update(content)
+                    self._last_refresh = time.time()
+                self._refreshing = False
+                self._cond.notify_all()
+        with self._cond:
+            return dict(self.scvs)
+
+    def get(self):
+        """ Return a copy of the SCVs, refreshing them if older than ttl. """
+        return self.refresh(max_age=self.ttl)
+
+    def host(self, scv_name):
+        """ Return the host of scv_name. An unknown scv waits for any refresh
+        in flight, and triggers a new one if the last is older than
+        min_interval, before KeyError is raised. """
+        current = self.get()
+        if scv_name not in current:
+            current = self.refresh(max_age=self.min_interval, wait=True)
+        return current[scv_name]['host']
+
+    def invalidate(self):
+        """ Mark the cache as stale. """
+        with self._cond:
+            self._last_refresh = 0
+
+
+scv_directory = SCVDirectory()
+scvs = scv_directory.scvs
 
 
 def login(token, cc='cc.proteneer.com'):
@@ -39,6 +125,7 @@ def login(token, cc='cc.proteneer.com'):
     auth_token = token
     global login_cc
     login_cc = cc
+    scv_directory.invalidate()
     refresh_scvs()
 
 
@@ -57,22 +144,8 @@ def require_login(method):
 @require_login
 def refresh_scvs():
     """ Update and return the status of the SCVs. This method is rate limited
-        to once every 2 seconds. """
-    global scvs
-    global last_scvs_refresh
-    global login_cc
-    if time.time() - last_scvs_refresh > 1:
-        url = 'https://'+login_cc+'/scvs/status'
-        reply = requests.get(url, verify=is_domain(login_cc))
-
-        print('REFRESH SCVS called:', reply, reply.status_code, reply.content)
-
-        if reply.status_code == 200:
-            content = reply.json()
-            for scv_name, scv_prop in content.items():
-                # sets host and status fields
-                scvs[scv_name] = scv_prop
-            last_scvs_refresh = time.time()
+        to once every second. """
+    return scv_directory.refresh(max_age=1)
 
 
 class Base:
@@ -126,8 +199,7 @@ class Stream(Base):
         self._error_count = None
         self._active = None
         scv_name = stream_id.split(':')[1]
-        global scvs
-        uri = scvs[scv_name]['host']
+        uri = scv_directory.host(scv_name)
         super(Stream, self).__init__(uri)
 
     def __repr__(self):
@@ -353,32 +425,134 @@ class Target(Base):
             raise Exception('could not update target. Reason:'+reply.content)
         self.reload_info()
 
-    def add_stream(self, files, scv, tags=None):
+    def add_stream(self, files, scv, tags=None, dedup=False, encode=False,
+                   compresslevel=DEFAULT_COMPRESSLEVEL):
         """ Add a stream to the target belonging to a particular scv.
 
         :param files: dict, filenames and binaries matching the core's
             requirements.
         :param scv: str, which particular SCV to add the stream to.
         :param tags: dict, a dictionary of tag files to include, such as pdbs
+        :param dedup: bool, if True, files are uploaded to the scv as blobs
+            identified by their sha256, and only blobs the scv does not
+            already have are sent. Requires scv.
+        :param encode: bool, if True, files and tags not ending in .b64 are
+            encoded as per util.encode_files while the request body is
+            streamed. Values may also be binary file objects.
+        :param compresslevel: int, gzip level used when encode is True.
 
         """
         assert isinstance(files, dict)
+        if encode and not dedup:
+            return self._post_stream(iter_stream_body(
+                self.id, files, tags, compresslevel=compresslevel), scv)
+        elif encode:
+            files = encode_files(files, compresslevel)
+        if dedup and scv:
+            files = dict((name, read_file(value))
+                         for name, value in files.items())
+            blobs = {name: hash_file(value) for name, value in files.items()}
+            self._upload_blobs(scv, {blobs[name]: value for name, value
+                                     in files.items()})
+            return self._add_stream({}, scv, tags, blobs)
+        return self._add_stream(files, scv, tags)
+
+    def add_streams(self, list_of_files, scv, tags=None, processes=None,
+                    threads=8, dedup=True, encode=False,
+                    compresslevel=DEFAULT_COMPRESSLEVEL):
+        """ Add many streams to the target belonging to a particular scv.
+        If encode is True, files are first encoded in a process pool, with
+        identical files shared between streams (eg. system.xml,
+        integrator.xml) encoded only once. The streams are then uploaded
+        concurrently.
+
+        :param list_of_files: list of dicts, one per stream, of filenames and
+            binaries matching the core's requirements.
+        :param scv: str, which particular SCV to add the streams to.
+        :param tags: dict, a dictionary of tag files to include in every stream
+        :param processes: int, number of encoding processes, defaults to the
+            number of cpus.
+        :param threads: int, number of concurrent uploads.
+        :param dedup: bool, if True, each file shared by two streams or more
+            is uploaded to the scv once as a blob and the streams reference
+            it by hash, see util.share_files.
+        :param encode: bool, if True, files not ending in .b64 are encoded as
+            per util.encode_files, as in add_stream. Names are not changed.
+        :param compresslevel: int, gzip level used when encode is True.
+
+        Returns a list of Streams in the same order as list_of_files.
+
+        """
+        assert all(isinstance(files, dict) for files in list_of_files)
+        if encode:
+            list_of_files = encode_files_many(list_of_files, processes,
+                                              compresslevel)
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            if dedup and scv:
+                blobs, streams = share_files(list_of_files)
+                if blobs:
+                    self._upload_blobs(scv, blobs, executor)
+                futures = [executor.submit(self._add_stream, files, scv, tags,
+                                           hashes)
+                           for files, hashes in streams]
+            else:
+                futures = [executor.submit(self._add_stream, files, scv, tags)
+                           for files in list_of_files]
+            return [future.result() for future in futures]
+
+    def _upload_blobs(self, scv, blobs, executor=None):
+        """ Upload the blobs, a dict of sha256 to encoded file, that scv does
+            not have yet. """
+        global auth_token
+        host = scv_directory.host(scv)
+        headers = {'Authorization': auth_token}
+        reply = requests.post('https://'+host+'/blobs/missing',
+                              headers=headers,
+                              data=json.dumps({'hashes': list(blobs)}),
+                              verify=is_domain(host))
+        if reply.status_code != 200:
+            print(reply.text)
+            raise Exception('Bad status code')
+
+        def upload(blob_hash):
+            value = blobs[blob_hash]
+            if isinstance(value, str):
+                value = value.encode()
+            reply = requests.put('https://'+host+'/blobs/'+blob_hash,
+                                 headers=headers, data=value,
+                                 verify=is_domain(host))
+            if reply.status_code != 200:
+                print(reply.text)
+                raise Exception('Bad status code')
+
+        missing = reply.json()['missing']
+        if executor:
+            list(executor.map(upload, missing))
+        else:
+            for blob_hash in missing:
+                upload(blob_hash)
+
+    def _add_stream(self, files, scv, tags=None, blobs=None):
         body = {
             'target_id': self.id,
             'files': files,
         }
         if tags:
             body['tags'] = tags
+        if blobs:
+            body['blobs'] = blobs
+        return self._post_stream(json.dumps(body), scv)
+
+    def _post_stream(self, data, scv):
+        """ Post data, a str or an iterable of bytes, to /streams. """
         if scv:
-            global scvs
             global auth_token
-            refresh_scvs()
-            url = 'https://'+scvs[scv]['host']+'/streams'
+            url = 'https://'+scv_directory.host(scv)+'/streams'
             headers = {'Authorization': auth_token}
-            reply = requests.post(url, headers=headers, data=json.dumps(body),
+            reply = requests.post(url, headers=headers, data=data,
                                   verify=is_domain(self.uri))
         else:
-            reply = self._post('/streams', json.dumps(body))
+            reply = self._post('/streams', data)
         if reply.status_code != 200:
             print(reply.text)
             raise Exception('Bad status code')
@@ -408,7 +582,6 @@ class Target(Base):
         """ Get the list of streams in this target. """
         streams = []
         self.reload_info()
-        global scvs
         reply = self._get('/targets/streams/'+self.id)
         if reply.status_code != 200:
             print(reply.status_code, reply.content)
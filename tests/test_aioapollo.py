@@ -0,0 +1,419 @@
+# Authors: Yutong Zhao <proteneer@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import asyncio
+import unittest
+import unittest.mock
+import subprocess
+import os
+import tempfile
+import time
+
+import redis
+
+try:
+    import redis.asyncio
+except ImportError:
+    raise unittest.SkipTest('aioapollo requires redis-py 5')
+
+import cc.apollo as apollo
+import cc.aioapollo as aioapollo
+
+REDIS_PORT = 3849
+CLUSTER_PORT = 3839
+redis_process = None
+
+
+def setUpModule():
+    global redis_process
+    redis_process = subprocess.Popen(
+        ['redis-server', '--port', str(REDIS_PORT), '--save', ''],
+        stdout=open(os.devnull, 'w'))
+    db = redis.Redis(port=REDIS_PORT)
+    for i in range(50):
+        try:
+            db.ping()
+            break
+        except redis.exceptions.ConnectionError:
+            time.sleep(0.1)
+
+
+def tearDownModule():
+    redis_process.terminate()
+    redis_process.wait()
+
+
+class AsyncPerson(aioapollo.Entity):
+    prefix = 'aperson'
+    fields = {'age': int,
+              'ssn': str,
+              'nicknames': {str},
+              }
+
+
+class AsyncCat(aioapollo.Entity):
+    prefix = 'acat'
+    fields = {'age': int,
+              'queue': apollo.zset(str),
+              }
+
+
+class AsyncToken(aioapollo.Entity):
+    prefix = 'atoken'
+    fields = {'worker': str,
+              'tags': {str},
+              }
+
+
+class AsyncTarget(aioapollo.Entity):
+    prefix = 'atarget'
+    fields = {'owner': str,
+              'weight': int,
+              }
+    cache = apollo.entity_cache(maxsize=4, ttl=60)
+
+
+class ClusterPerson(aioapollo.Entity):
+    prefix = 'cperson'
+    fields = {'age': int,
+              'ssn': str,
+              'nicknames': {str},
+              }
+    hash_tags = True
+
+
+class ClusterCat(aioapollo.Entity):
+    prefix = 'ccat'
+    fields = {'queue': apollo.zset(str)}
+    hash_tags = True
+
+
+class SyncClusterPerson(apollo.Entity):
+    prefix = 'scperson'
+    fields = {'age': int}
+    hash_tags = True
+
+
+class AsyncOwner(aioapollo.Entity):
+    prefix = 'aowner'
+    fields = {'nicknames': {str}}
+    compact_ids = True
+
+
+class AsyncPet(aioapollo.Entity):
+    prefix = 'apet'
+    fields = {'age': int}
+    compact_ids = True
+
+
+ClusterPerson.add_lookup('ssn')
+ClusterPerson.add_lookup('nicknames', injective=False)
+ClusterPerson.add_index('age')
+aioapollo.relate(ClusterPerson, 'cats', {ClusterCat}, 'owner')
+
+AsyncPerson.add_lookup('ssn')
+AsyncPerson.add_lookup('nicknames', injective=False)
+AsyncPerson.add_index('age')
+aioapollo.relate(AsyncPerson, 'cats', {AsyncCat}, 'owner')
+AsyncOwner.add_lookup('nicknames', injective=False)
+aioapollo.relate(AsyncOwner, 'pets', {AsyncPet}, 'owner')
+
+
+class TestAioApollo(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.db = redis.asyncio.Redis(port=REDIS_PORT, decode_responses=True)
+        await self.db.flushdb()
+
+    async def asyncTearDown(self):
+        await self.db.flushdb()
+        await self.db.aclose()
+
+    async def test_entity(self):
+        joe = await AsyncPerson.create('joe', self.db, {'age': 25,
+                                                        'ssn': '123'})
+        self.assertTrue(await AsyncPerson.exists('joe', self.db))
+        self.assertEqual(await AsyncPerson.exists_many(['joe', 'bob'],
+                                                       self.db),
+                         [True, False])
+        self.assertEqual(await joe.hget('age'), 25)
+        self.assertEqual(await joe.hincrby('age', 2), 27)
+        self.assertEqual(await AsyncPerson.range('age', 26, 28, self.db),
+                         ['joe'])
+        await self.db.delete('apersons:age')
+        await AsyncPerson.rebuild_index('age', self.db, count=1)
+        self.assertEqual(await AsyncPerson.range('age', 26, 28, self.db),
+                         ['joe'])
+        self.assertEqual(await joe.hmget('age', 'ssn'), [27, '123'])
+        self.assertEqual(await AsyncPerson.lookup('ssn', '123', self.db),
+                         'joe')
+        with self.assertRaises(KeyError):
+            await AsyncPerson.create('joe', self.db)
+        cats = []
+        for i in range(5):
+            cats.append(await AsyncCat.create('cat'+str(i), self.db))
+        await joe.sadd('cats', *cats)
+        self.assertEqual(await cats[0].hget('owner'), 'joe')
+        bob = await AsyncPerson.create('bob', self.db)
+        async with aioapollo.pipeline(self.db) as pipe:
+            await bob.hset('ssn', '123', pipeline=pipe)
+            await cats[1].hset('owner', bob, pipeline=pipe)
+        self.assertEqual(await AsyncPerson.lookup('ssn', '123', self.db),
+                         'bob')
+        self.assertEqual(await joe.hget('ssn'), None)
+        self.assertEqual(await bob.smembers('cats'), {'cat1'})
+        await joe.delete()
+        self.assertFalse(await AsyncPerson.exists('joe', self.db))
+        self.assertEqual(await cats[0].hget('owner'), None)
+        records = await AsyncPerson.load_many(['bob', 'joe'], self.db,
+                                              fields=['ssn', 'cats'])
+        self.assertEqual(records, [{'ssn': '123', 'cats': {'cat1'}}, None])
+
+    async def test_cache(self):
+        target = await AsyncTarget.create('t', self.db, {'weight': 1})
+        self.assertEqual(await target.hget('weight'), 1)
+        async with aioapollo.pipeline(self.db) as pipeline:
+            await target.hset('weight', 2, pipeline=pipeline)
+            self.assertEqual(await target.hget('weight'), 1)
+        self.assertEqual(await target.hget('weight'), 2)
+        pipeline = self.db.pipeline()
+        await target.hset('weight', 3, pipeline=pipeline)
+        self.assertEqual(await target.hget('weight'), 2)
+        await pipeline.execute()
+        self.assertEqual(await target.hget('weight'), 3)
+
+        async def rename(pipeline):
+            await target.hset('owner', 'bob', pipeline=pipeline)
+            self.assertEqual(await target.hget('owner'), None)
+        await target.transaction(rename)
+        self.assertEqual(await target.hget('owner'), 'bob')
+
+    async def test_create_many(self):
+        await AsyncPerson.create('joe', self.db)
+        conflicts = await AsyncPerson.create_many(
+            [('joe', {}), ('bob', {'ssn': '1'}), ('eve', {'ssn': '1'})],
+            self.db)
+        self.assertEqual(conflicts, ['joe'])
+        self.assertEqual(await AsyncPerson.lookup('ssn', '1', self.db), 'eve')
+        self.assertEqual(await AsyncPerson('bob', self.db).hget('ssn'), None)
+
+    async def test_create_race(self):
+        other = redis.Redis(port=REDIS_PORT, decode_responses=True)
+        create_plan = AsyncPerson._create_plan
+
+        def racing_create_plan(person, fields, pipeline, ttl=None):
+            # another client creates the id once it is checked
+            if not other.sismember(AsyncPerson._members_key, person.id):
+                other.sadd(AsyncPerson._members_key, person.id)
+            return (yield from create_plan(person, fields, pipeline, ttl))
+
+        with unittest.mock.patch.object(AsyncPerson, '_create_plan',
+                                        racing_create_plan):
+            with self.assertRaises(KeyError):
+                await AsyncPerson.create('joe', self.db, {'age': 2})
+            self.assertEqual(await AsyncPerson.create_many(
+                [('bob', {'age': 2})], self.db), ['bob'])
+        self.assertEqual(await AsyncPerson('joe', self.db).hget('age'), None)
+        other.close()
+
+    async def test_instrument(self):
+        db = aioapollo.connect(port=REDIS_PORT, instrument=True,
+                               max_connections=4, parser='python')
+        await db.ping()
+        joe = await AsyncPerson.create('joe', db)
+        with aioapollo.instrument() as stats:
+            await joe.hget('age')
+            await AsyncPerson.load_many(['joe', 'bob'], db)
+        pool = aioapollo.pool_stats(db)
+        await db.aclose()
+        self.assertEqual(pool.max_connections, 4)
+        self.assertEqual(pool.in_use, 0)
+        self.assertGreaterEqual(pool.idle, 1)
+        self.assertEqual(stats.round_trips, 2)
+        self.assertEqual(stats.methods['Entity.hget'].commands, 1)
+        self.assertEqual(stats.methods['Entity.load_many'].pipelines, 1)
+
+    async def test_transaction(self):
+        joe = await AsyncPerson.create('joe', self.db, {'ssn': '123'})
+        other = redis.asyncio.Redis(port=REDIS_PORT, decode_responses=True)
+        attempts = []
+
+        async def bump(pipeline):
+            attempts.append(pipeline)
+            await joe.hset('age', 1, pipeline=pipeline)
+            if len(attempts) == 1:
+                await other.hset('aperson:joe', 'ssn', '456')
+
+        await joe.transaction(bump)
+        await other.aclose()
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(await joe.hmget('age', 'ssn'), [1, '456'])
+
+    async def test_expire(self):
+        token = await AsyncToken.create('a', self.db, {'tags': {'x'}},
+                                        ttl=60)
+        self.assertTrue(59 < await token.time_to_live() <= 60)
+        await token.persist()
+        self.assertEqual(await self.db.ttl('atoken:a:tags'), -1)
+        await AsyncToken.create_many([('b', {'worker': 'w'})], self.db,
+                                     ttl=0.05)
+        await asyncio.sleep(0.1)
+        self.assertEqual(await AsyncToken.purge_expired(self.db), 1)
+        self.assertEqual(await AsyncToken.members(self.db), {'a'})
+        await token.expire(0.05)
+        self.assertTrue(0 < await self.db.pttl('atoken:a:tags') <= 50)
+        await asyncio.sleep(0.1)
+        self.assertFalse(await AsyncToken.exists('a', self.db))
+        await AsyncToken.create('a', self.db, {'worker': 'v'})
+        self.assertEqual(await AsyncToken.create_many([('a', {})], self.db),
+                         ['a'])
+        self.assertEqual(await token.hmget('worker'), ['v'])
+        self.assertEqual(await token.time_to_live(), None)
+        self.assertEqual(await token.smembers('tags'), set())
+
+    async def test_compact_ids(self):
+        joe = await AsyncOwner.create('joe', self.db, {'nicknames': {'jo'}})
+        await AsyncPet.create_many([('a', {}), ('b', {})], self.db)
+        await AsyncPet.create('c', self.db, {'owner': joe})
+        await joe.sadd('pets', 'a', 'b')
+        self.assertEqual(await joe.smembers('pets'), {'a', 'b', 'c'})
+        self.assertEqual(await self.db.object('encoding', 'aowner:joe:pets'),
+                         'intset')
+        self.assertEqual({id async for id in joe.iter_smembers('pets')},
+                         {'a', 'b', 'c'})
+        self.assertTrue(await joe.sismember('pets', 'c'))
+        self.assertIn(await joe.srandmember('pets'), {'a', 'b', 'c'})
+        self.assertEqual(await AsyncOwner.lookup('nicknames', 'jo', self.db),
+                         {'joe'})
+        await joe.srem('pets', 'a')
+        self.assertEqual(await AsyncPet('a', self.db).hget('owner'), None)
+        await joe.delete()
+        self.assertEqual(await AsyncPet('b', self.db).hget('owner'), None)
+        self.assertEqual(await AsyncOwner.lookup('nicknames', 'jo', self.db),
+                         set())
+
+    async def test_zrevpop(self):
+        cat = await AsyncCat.create('kitty', self.db)
+        await cat.zadd('queue', {'a': 1, 'b': 3, 'c': 2})
+        self.assertEqual(await cat.zrange('queue', withscores=True),
+                         [('a', 1.0), ('c', 2.0), ('b', 3.0)])
+        self.assertEqual(await cat.zrevrangebyscore('queue', 3, 2),
+                         ['b', 'c'])
+        self.assertEqual(await cat.zrangebyscore('queue', 1, 3, limit=1,
+                                                 offset=1), ['c'])
+        self.assertEqual(await cat.zscore('queue', 'c'), 2.0)
+        self.assertEqual(await AsyncCat.zrange_many('queue', ['kitty'],
+                                                    self.db, -1, -1),
+                         [['b']])
+        self.assertEqual([pair async for pair in cat.iter_zmembers('queue')],
+                         [('a', 1), ('c', 2), ('b', 3)])
+        self.assertEqual([id async for id in AsyncCat.iter_members(self.db)],
+                         ['kitty'])
+        self.assertEqual(await cat.zrevpop('queue'), 'b')
+        self.assertEqual(await cat.zrevpop('queue', count=0), [])
+        self.assertEqual(await cat.zrevpop('queue', count=5), ['c', 'a'])
+
+
+class TestAioApolloCluster(unittest.IsolatedAsyncioTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.process = subprocess.Popen(
+            ['redis-server', '--port', str(CLUSTER_PORT), '--save', '',
+             '--cluster-enabled', 'yes', '--dir', cls.directory.name],
+            stdout=open(os.devnull, 'w'))
+        db = redis.Redis(port=CLUSTER_PORT, decode_responses=True)
+        for i in range(50):
+            try:
+                db.execute_command('CLUSTER ADDSLOTS', *range(16384))
+                break
+            except redis.exceptions.ConnectionError:
+                time.sleep(0.1)
+        for i in range(50):
+            if db.cluster('INFO')['cluster_state'] == 'ok':
+                break
+            time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.process.terminate()
+        cls.process.wait()
+        cls.directory.cleanup()
+
+    async def asyncSetUp(self):
+        self.db = aioapollo.RedisCluster(host='localhost', port=CLUSTER_PORT,
+                                         decode_responses=True)
+        await self.db.flushdb()
+
+    async def asyncTearDown(self):
+        await self.db.flushdb()
+        await aioapollo.close(self.db)
+
+    async def test_slot_groups(self):
+        self.assertEqual(aioapollo.key_slot(b'foo'), 12182)
+        self.assertEqual(aioapollo.key_slot(b'a:{x}'), 16287)
+        self.assertNotEqual(aioapollo.key_slot(b'a:{}x'),
+                            aioapollo.key_slot(b'x'))
+        writes = aioapollo._cluster_writes()
+        writes.hset('cperson:{a}', 'age', 1)
+        writes.sadd('{cperson}s', 'a')
+        writes.sadd('cperson:{a}:nicknames', 'jo')
+        groups = aioapollo._slot_groups(writes.command_stack)
+        self.assertEqual([slot for slot, commands in groups],
+                         [aioapollo.key_slot(b'a'),
+                          aioapollo.key_slot(b'cperson')])
+        self.assertEqual([position for position, args, options
+                          in groups[0][1]], [0, 2])
+
+    def test_sync_cluster(self):
+        db = redis.RedisCluster(host='localhost', port=CLUSTER_PORT,
+                                decode_responses=True)
+        try:
+            self.assertRaises(TypeError, SyncClusterPerson.create, 'joe', db)
+            self.assertRaises(TypeError, SyncClusterPerson.create_many,
+                              [('joe', {})], db)
+            self.assertRaises(TypeError, apollo.transaction, db,
+                              lambda pipeline: None)
+        finally:
+            db.close()
+
+    async def test_entity(self):
+        joe = await ClusterPerson.create('joe', self.db,
+                                         {'age': 25, 'ssn': '123',
+                                          'nicknames': {'jo'}})
+        self.assertEqual(await ClusterPerson.lookup('ssn', '123', self.db),
+                         'joe')
+        self.assertEqual(await joe.hincrby('age', 2), 27)
+        self.assertEqual(await ClusterPerson.range('age', 26, 28, self.db),
+                         ['joe'])
+        await ClusterPerson.rebuild_index('age', self.db)
+        self.assertEqual(await ClusterPerson.range('age', 26, 28, self.db),
+                         ['joe'])
+        conflicts = await ClusterCat.create_many(
+            [('kitty', {'owner': joe}), ('tom', {}), ('kitty', {})], self.db)
+        self.assertEqual(conflicts, ['kitty'])
+        await joe.sadd('cats', 'tom')
+        self.assertEqual(await joe.smembers('cats'), {'kitty', 'tom'})
+        self.assertEqual(await ClusterCat('tom', self.db).hget('owner'),
+                         'joe')
+        cat = ClusterCat('kitty', self.db)
+        await cat.zadd('queue', {'a': 1, 'b': 2})
+        self.assertEqual(await cat.zrevpop('queue'), 'b')
+        await joe.delete()
+        self.assertEqual(await ClusterCat('tom', self.db).hget('owner'),
+                         None)
+        self.assertEqual(await ClusterPerson.lookup('nicknames', 'jo',
+                                                    self.db), set())
+        self.assertEqual(await ClusterPerson.members(self.db), set())
@@ -0,0 +1,675 @@
+# Authors: Yutong Zhao <proteneer@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+import unittest.mock
+import subprocess
+import os
+import threading
+import time
+
+import redis
+
+import cc.apollo as apollo
+
+REDIS_PORT = 3829
+redis_process = None
+
+
+def setUpModule():
+    global redis_process
+    redis_process = subprocess.Popen(
+        ['redis-server', '--port', str(REDIS_PORT), '--save', ''],
+        stdout=open(os.devnull, 'w'))
+    db = redis.Redis(port=REDIS_PORT)
+    for i in range(50):
+        try:
+            db.ping()
+            break
+        except redis.exceptions.ConnectionError:
+            time.sleep(0.1)
+
+
+def tearDownModule():
+    redis_process.terminate()
+    redis_process.wait()
+
+
+class Person(apollo.Entity):
+    prefix = 'person'
+    fields = {'age': int,
+              'ssn': str,
+              'height': float,
+              'emails': {str},
+              'nicknames': {str},
+              }
+
+
+class Cat(apollo.Entity):
+    prefix = 'cat'
+    fields = {'age': int,
+              'eye_color': str,
+              'favorite_foods': {str},
+              'queue': apollo.zset(str),
+              'litters': apollo.zset(int, score=int),
+              }
+
+
+class Target(apollo.Entity):
+    prefix = 'target'
+    fields = {'owner': str,
+              'weight': int,
+              'stage': str,
+              }
+    cache = apollo.entity_cache(maxsize=4, ttl=60)
+
+
+class Token(apollo.Entity):
+    prefix = 'token'
+    fields = {'worker': str,
+              'score': int,
+              'tags': {str},
+              }
+    ttl = 60
+    hash_tags = True
+
+
+class Owner(apollo.Entity):
+    prefix = 'owner'
+    fields = {'nicknames': {str}}
+    compact_ids = True
+
+
+class Pet(apollo.Entity):
+    prefix = 'pet'
+    fields = {'age': int}
+    compact_ids = True
+
+
+Token.add_index('score')
+Owner.add_lookup('nicknames', injective=False)
+apollo.relate(Owner, 'pets', {Pet}, 'owner')
+apollo.relate({Owner}, 'pets_to_feed', {Pet}, 'feeders')
+
+Person.add_lookup('ssn')
+Person.add_lookup('emails')
+Person.add_lookup('nicknames', injective=False)
+Person.add_index('age')
+Person.add_index('height')
+apollo.relate(Person, 'cats', {Cat}, 'owner')
+apollo.relate({Person}, 'cats_to_feed', {Cat}, 'caretakers')
+
+
+class TestApollo(unittest.TestCase):
+
+    def setUp(self):
+        self.db = redis.Redis(port=REDIS_PORT, decode_responses=True)
+        self.db.flushdb()
+
+    def tearDown(self):
+        self.db.flushdb()
+
+    def test_create(self):
+        joe = Person.create('joe', self.db, {'age': 25, 'ssn': '123',
+                                             'emails': {'a@b.com'}})
+        self.assertTrue(Person.exists('joe', self.db))
+        self.assertEqual(joe.hget('age'), 25)
+        self.assertEqual(Person.lookup('ssn', '123', self.db), 'joe')
+        self.assertEqual(Person.lookup('emails', 'a@b.com', self.db), 'joe')
+        self.assertRaises(KeyError, Person.create, 'joe', self.db)
+
+    def test_create_race(self):
+        create_plan = Person._create_plan
+
+        def racing_create_plan(person, fields, pipeline, ttl=None):
+            # another client creates the id once it is checked
+            if not self.db.sismember(Person._members_key, person.id):
+                self.db.sadd(Person._members_key, person.id)
+                self.db.hset(person._key, 'age', 1)
+            return (yield from create_plan(person, fields, pipeline, ttl))
+
+        with unittest.mock.patch.object(Person, '_create_plan',
+                                        racing_create_plan):
+            self.assertRaises(KeyError, Person.create, 'joe', self.db,
+                              {'age': 2})
+            self.assertEqual(Person.create_many([('bob', {'age': 2}),
+                                                 ('eve', {'age': 2})],
+                                                self.db), ['bob', 'eve'])
+        self.assertEqual(Person('joe', self.db).hget('age'), 1)
+        self.assertEqual(Person('bob', self.db).hget('age'), 1)
+
+    def test_compiled_schema(self):
+        plan = Cat._plans['owner']
+        self.assertEqual(plan.kind, 'hash')
+        self.assertEqual(plan.relation, (Person, 'cats', 'set'))
+        self.assertEqual(Person._plans['nicknames'].lookup, False)
+        self.assertEqual(Person._plans['cats'].primitive, Cat)
+        self.assertEqual(set(Person._reference_set_fields),
+                         {'emails', 'nicknames', 'cats', 'cats_to_feed'})
+        self.assertEqual(Person._reference_hash_fields, ['ssn'])
+        self.assertEqual(Cat('kitty', self.db)._key,
+                         'cat:kitty')
+
+    def test_ref(self):
+        joe = Person.create('joe', self.db, {'age': 25})
+        ghost = Person.ref('ghost', self.db)
+        self.assertFalse(hasattr(ghost, '__dict__'))
+        self.assertEqual(Person.ref('joe', self.db).hget('age'), 25)
+        self.assertEqual(ghost.hget('age'), None)
+        self.assertRaises(KeyError, Person.instance, 'ghost', self.db)
+        self.assertRaises(KeyError, Person, 'ghost', self.db, verify=True)
+        self.assertEqual(Person.exists_many(['joe', 'ghost', 'joe'], self.db,
+                                            chunk_size=2),
+                         [True, False, True])
+        self.assertEqual([p.id for p in Person.instance_many(['joe'],
+                                                             self.db)],
+                         ['joe'])
+        self.assertRaises(KeyError, Person.instance_many, ['joe', 'ghost'],
+                          self.db)
+
+    def test_create_many(self):
+        Person.create('joe', self.db)
+        for i in range(5):
+            Cat.create('cat'+str(i), self.db)
+        items = [('joe', {'age': 1}), ('bob', {'age': 2, 'ssn': '123'}),
+                 ('bob', {'age': 3})]
+        # everyone claims the same ssn and cats, and must be serialized
+        items += [(str(i), {'ssn': 'x', 'cats': {'cat1', 'cat'+str(i % 5)},
+                            'nicknames': {'n'}}) for i in range(20)]
+        self.assertEqual(Person.create_many(items, self.db, chunk_size=8),
+                         ['bob', 'joe'])
+        self.assertEqual(Person('bob', self.db).hmget('age', 'ssn'),
+                         [2, '123'])
+        self.assertEqual(Person.lookup('ssn', '123', self.db), 'bob')
+        self.assertEqual(len(Person.lookup('nicknames', 'n', self.db)), 20)
+        owner = Person.lookup('ssn', 'x', self.db)
+        ssns = [Person(str(i), self.db).hget('ssn') for i in range(20)]
+        self.assertEqual([i for i in range(20) if ssns[i]], [int(owner)])
+        # every cat has a single owner who has it
+        for i in range(5):
+            cat_owner = Cat('cat'+str(i), self.db).hget('owner')
+            self.assertTrue(Person(cat_owner, self.db).sismember(
+                'cats', 'cat'+str(i)))
+        self.assertEqual(sum(Person(str(i), self.db).scard('cats')
+                             for i in range(20)), 5)
+        self.assertRaises(TypeError, Person.create_many, [('x', {'bad': 1})],
+                          self.db)
+
+    def test_hmget_hgetall(self):
+        joe = Person.create('joe', self.db, {'age': 25, 'ssn': '123',
+                                             'height': 1.5})
+        self.assertEqual(joe.hmget('age', 'height', 'ssn'), [25, 1.5, '123'])
+        self.assertRaises(TypeError, joe.hmget, 'age', 'bad_field')
+        self.assertEqual(joe.hgetall(), {'age': 25, 'ssn': '123',
+                                         'height': 1.5})
+        cat = Cat.create('kitty', self.db, {'owner': joe})
+        self.assertEqual(cat.hmget('eye_color', 'owner'), [None, 'joe'])
+        self.assertEqual(cat.hgetall(), {'owner': 'joe'})
+
+    def test_load_many(self):
+        for i in range(25):
+            Person.create(str(i), self.db, {'age': i, 'ssn': 'ssn'+str(i),
+                                            'nicknames': {'n'+str(i)}})
+        Cat.create('kitty', self.db, {'owner': Person('3', self.db)})
+        ids = [str(i) for i in range(25)] + ['ghost']
+        records = Person.load_many(ids, self.db, chunk_size=7)
+        self.assertEqual(len(records), 26)
+        self.assertEqual(records[3], {'age': 3, 'ssn': 'ssn3',
+                                      'nicknames': {'n3'}, 'emails': set(),
+                                      'cats': {'kitty'},
+                                      'cats_to_feed': set()})
+        self.assertIsNone(records[-1])
+        records = Person.load_many(['5', '4'], self.db, fields=['age'])
+        self.assertEqual(records, [{'age': 5}, {'age': 4}])
+
+    def test_range_index(self):
+        for i in range(20):
+            Person.create(str(i), self.db, {'age': i % 10})
+        self.assertEqual(set(Person.range('age', 3, 4, self.db)),
+                         {'3', '4', '13', '14'})
+        self.assertEqual(len(Person.range('age', '(3', '+inf', self.db,
+                                          limit=5)), 5)
+        self.assertEqual(len(Person.range('age', 0, 9, self.db, offset=18)),
+                         2)
+        joe = Person('3', self.db)
+        joe.hincrby('age', 10)
+        joe.hset('height', 1.5)
+        joe.hincrbyfloat('height', 0.25)
+        self.assertEqual(Person.range('age', 10, '+inf', self.db), ['3'])
+        self.assertEqual(Person.range('height', 1.7, 1.8, self.db), ['3'])
+        joe.hdel('height')
+        self.assertEqual(Person.range('height', '-inf', '+inf', self.db), [])
+        joe.delete()
+        self.assertEqual(Person.range('age', 10, '+inf', self.db), [])
+        self.db.delete('persons:age')
+        Person.rebuild_index('age', self.db, count=3)
+        self.assertEqual(set(Person.range('age', 4, 4, self.db)),
+                         {'4', '14'})
+        self.assertEqual(self.db.zcard('persons:age'), 19)
+        self.assertFalse(self.db.exists('{persons:age}:rebuild'))
+        self.db.execute_command('ZADD', 'persons:height', 1, 'ghost')
+        Person.rebuild_index('height', self.db)
+        self.assertFalse(self.db.exists('persons:height'))
+        self.assertRaises(TypeError, Person.range, 'ssn', 0, 1, self.db)
+        self.assertRaises(TypeError, Person.add_index, 'ssn')
+        self.assertRaises(ValueError, Person.add_index, 'age', 'hash')
+
+    def test_cache(self):
+        Target.cache.clear()
+        target = Target.create('t', self.db, {'owner': 'joe', 'weight': 1})
+        self.assertEqual(target.hget('weight'), 1)
+        hits = Target.cache.hits
+        self.assertEqual(target.hmget('weight', 'owner'), [1, 'joe'])
+        self.assertEqual(Target.cache.hits, hits+1)
+        # writes from other clients are not seen until the entry expires
+        self.db.hset('target:t', 'weight', 5)
+        self.assertEqual(target.hget('weight'), 1)
+        self.assertEqual(target.hincrby('weight', 1), 6)
+        self.assertEqual(target.hget('weight'), 6)
+        target.hset('stage', 'public')
+        self.assertEqual(target.hget('stage'), 'public')
+        # values read while a write is queued are evicted once it commits
+        pipeline = self.db.pipeline()
+        target.hset('weight', 9, pipeline=pipeline)
+        self.assertEqual(target.hget('weight'), 6)
+        pipeline.execute()
+        self.assertEqual(target.hget('weight'), 9)
+
+        def publish(pipeline):
+            target.hset('stage', 'public2', pipeline=pipeline)
+            self.assertEqual(target.hget('stage'), 'public')
+        target.transaction(publish)
+        self.assertEqual(target.hget('stage'), 'public2')
+        for i in range(4):
+            Target.create(str(i), self.db, {'weight': i}).hget('weight')
+        self.assertEqual(len(Target.cache._entries), 4)
+        target.delete()
+        self.assertEqual(target.hget('owner'), None)
+        self.db.config_set('notify-keyspace-events', 'Kgh')
+        Target.cache.listen(self.db, Target)
+        try:
+            other = Target('0', self.db)
+            self.assertEqual(other.hget('weight'), 0)
+            self.db.hset('target:0', 'weight', 7)
+            for i in range(50):
+                if other.hget('weight') == 7:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(other.hget('weight'), 7)
+        finally:
+            thread = Target.cache._thread
+            Target.cache.stop()
+        self.assertFalse(thread.is_alive())
+
+    def test_transaction(self):
+        joe = Person.create('joe', self.db, {'ssn': '123'})
+        bob = Person.create('bob', self.db)
+        other = redis.Redis(port=REDIS_PORT, decode_responses=True)
+        attempts = []
+
+        def steal(pipeline):
+            attempts.append(pipeline)
+            bob.hset('ssn', '123', pipeline=pipeline)
+            if len(attempts) == 1:
+                # a concurrent writer binds the ssn after it was read
+                Person.create('eve', other, {'ssn': '123'})
+            return 'done'
+
+        self.assertEqual(apollo.transaction(self.db, steal), 'done')
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(Person.lookup('ssn', '123', self.db), 'bob')
+        self.assertEqual(Person('eve', self.db).hget('ssn'), None)
+        self.assertEqual(joe.hget('ssn'), None)
+
+        def conflict(pipeline):
+            joe.hset('age', 1, pipeline=pipeline)
+            other.hset('person:joe', 'age', 2)
+
+        self.assertRaises(redis.exceptions.WatchError, joe.transaction,
+                          conflict, retries=3)
+        self.assertEqual(joe.hget('age'), 2)
+
+        # scripts queued in a transaction are loaded before MULTI
+        cat = Cat.create('kitty', self.db, {'queue': {'a': 1}})
+        self.db.script_flush()
+
+        def pop(pipeline):
+            Cat._zrevpop_script(pipeline, keys=['cat:kitty:queue'], args=[1])
+            cat.zadd('queue', 'b', 2, pipeline=pipeline)
+
+        apollo.transaction(self.db, pop)
+        self.assertEqual(cat.zrange('queue', 0, -1), ['b'])
+
+    def test_instrument(self):
+        db = apollo.connect(port=REDIS_PORT, instrument=True)
+        joe = Person.create('joe', db, {'ssn': '1'})
+        Person.create_many([(str(i), {}) for i in range(10)], db)
+        with apollo.instrument() as stats:
+            joe.hget('age')
+            with apollo.instrument() as inner:
+                joe.hset('ssn', '2')
+            Person.load_many([str(i) for i in range(10)], db)
+        self.assertEqual(stats.methods['Entity.hget'].round_trips, 1)
+        self.assertEqual(stats.methods['Entity.load_many'].round_trips, 1)
+        self.assertEqual(stats.methods['Entity.load_many'].pipelines, 1)
+        # a sismember, an hmget and four smembers per id
+        self.assertEqual(stats.methods['Entity.load_many'].commands, 60)
+        # watch, read, then commit
+        self.assertLessEqual(inner.round_trips, 4)
+        self.assertEqual(set(inner.methods), {'Entity.hset'})
+        self.assertEqual(stats.round_trips, 2+inner.round_trips)
+        self.assertEqual(stats.commands, sum(
+            method.commands for method in stats.methods.values()))
+        self.assertGreater(stats.bytes_sent, 0)
+        # connections outside of a scope are not recorded
+        joe.hget('age')
+        self.assertEqual(stats.methods['Entity.hget'].round_trips, 1)
+        # nor are those of other threads
+        thread = threading.Thread(target=joe.hget, args=('age',))
+        with apollo.instrument() as stats:
+            thread.start()
+            thread.join()
+        self.assertEqual(stats.round_trips, 0)
+
+    def test_connect(self):
+        db = apollo.connect(port=REDIS_PORT, max_connections=2,
+                            socket_timeout=5, parser='python')
+        self.assertEqual(apollo.pool_stats(db).created, 0)
+        joe = Person.create('joe', db, {'age': 1})
+        self.assertEqual(joe.hget('age'), 1)
+        stats = apollo.pool_stats(db)
+        self.assertEqual((stats.in_use, stats.max_connections), (0, 2))
+        self.assertGreaterEqual(stats.idle, 1)
+        pipeline = db.pipeline()
+        Person.create('bob', pipeline)
+        client = db.connection_pool.apollo_client
+        Person.create('ann', pipeline)
+        self.assertIs(db.connection_pool.apollo_client, client)
+        pipeline.execute()
+        self.assertEqual(Person.members(db), {'joe', 'bob', 'ann'})
+        held = [db.connection_pool.get_connection('PING') for i in range(2)]
+        stats = apollo.pool_stats(db)
+        self.assertEqual((stats.in_use, stats.idle), (2, 0))
+        self.assertRaises(redis.exceptions.ConnectionError, db.ping)
+        for connection in held:
+            db.connection_pool.release(connection)
+        blocking = apollo.connect(port=REDIS_PORT, max_connections=1,
+                                  pool_timeout=0.05)
+        self.assertTrue(blocking.ping())
+        self.assertEqual(repr(apollo.pool_stats(blocking)),
+                         'pool_stats(max_connections=1, created=1, '
+                         'in_use=0, idle=1)')
+        held = blocking.connection_pool.get_connection('PING')
+        self.assertEqual(apollo.pool_stats(blocking).in_use, 1)
+        self.assertRaises(redis.exceptions.ConnectionError, blocking.ping)
+        blocking.connection_pool.release(held)
+        self.assertEqual(repr(apollo.pool_stats(object())),
+                         'pool_stats(max_connections=None, created=None, '
+                         'in_use=None, idle=None)')
+        self.assertRaises(ValueError, apollo.connect, parser='fast')
+
+    def test_iter_members(self):
+        ids = set(str(i) for i in range(250))
+        for id in ids:
+            Person.create(id, self.db, {'nicknames': {'a'+id, 'b'+id}})
+        self.assertEqual(set(Person.iter_members(self.db, count=10)), ids)
+        joe = Person('7', self.db)
+        self.assertEqual(set(joe.iter_smembers('nicknames', count=1)),
+                         {'a7', 'b7'})
+        self.assertRaises(KeyError, joe.iter_smembers, 'age')
+        cat = Cat.create('kitty', self.db)
+        cat.zadd('queue', *[x for i in range(300) for x in (str(i), i)])
+        self.assertEqual(sorted(cat.iter_zmembers('queue', count=7)),
+                         sorted((str(i), float(i)) for i in range(300)))
+
+    def test_zrevpop(self):
+        cat = Cat.create('kitty', self.db)
+        self.assertEqual(cat.zrevpop('queue'), None)
+        cat.zadd('queue', 'a', 1, 'b', 3, 'c', 2, 'd', 0)
+        self.assertEqual(cat.zrevpop('queue'), 'b')
+        self.assertEqual(cat.zrevpop('queue', count=0), [])
+        self.assertEqual(cat.zrevpop('queue', count=-1), [])
+        self.db.script_flush()
+        self.assertEqual(cat.zrevpop('queue', count=2), ['c', 'a'])
+        self.assertEqual(cat.zrevpop('queue', count=5), ['d'])
+        self.assertEqual(cat.zrevpop('queue', count=5), [])
+        # a pipeline loads the scripts it runs before executing
+        cat.zadd('queue', 'e', 1)
+        self.db.script_flush()
+        pipeline = self.db.pipeline()
+        Cat._zrevpop_script(pipeline, keys=['cat:kitty:queue'], args=[1])
+        self.assertEqual(pipeline.execute(), [['e']])
+
+    def test_zset(self):
+        cat = Cat.create('kitty', self.db, {'queue': {'a': 1.5, 'b': 3},
+                                            'litters': {2019: 4, 2021: 2}})
+        self.assertEqual(cat.zrange('queue'), ['a', 'b'])
+        self.assertEqual(cat.zrevrange('queue', withscores=True),
+                         [('b', 3.0), ('a', 1.5)])
+        self.assertEqual(cat.zrange('litters', withscores=True),
+                         [(2021, 2), (2019, 4)])
+        self.assertEqual(cat.zscore('litters', 2019), 4)
+        self.assertIs(type(cat.zscore('litters', 2019)), int)
+        self.assertEqual(cat.zscore('litters', 2000), None)
+        self.assertRaises(KeyError, cat.zrange, 'favorite_foods')
+        self.assertRaises(KeyError, cat.zadd, 'age', 'a', 1)
+        cat.zadd('litters', {2022: 5, 2023: 1})
+        cat.zadd('queue', 'c', 2, 'd', 0)
+        self.assertEqual(cat.zcard('litters'), 4)
+        self.assertEqual(cat.zrangebyscore('queue', 1, '+inf'),
+                         ['a', 'c', 'b'])
+        self.assertEqual(cat.zrangebyscore('queue', '(1.5', 3,
+                                           withscores=True),
+                         [('c', 2.0), ('b', 3.0)])
+        self.assertEqual(cat.zrangebyscore('litters', '-inf', '+inf',
+                                           limit=2, offset=1),
+                         [2021, 2019])
+        self.assertEqual(cat.zrevrangebyscore('litters', 4, 2, limit=1),
+                         [2019])
+        Cat.create('tom', self.db, {'litters': {2020: 3}})
+        self.assertEqual(Cat.zrange_many('litters', ['kitty', 'tom', 'ghost'],
+                                         self.db, 0, 0, withscores=True),
+                         [[(2023, 1)], [(2020, 3)], []])
+        self.assertEqual(Cat.zrangebyscore_many('litters', ['kitty', 'tom'],
+                                                self.db, 3, '+inf', limit=1),
+                         [[2019], [2020]])
+        self.assertEqual(Cat.load_many(['tom'], self.db, ['litters']),
+                         [{'litters': [2020]}])
+        self.assertEqual(cat.zrevpop('litters', count=2), [2022, 2019])
+
+    def test_expire(self):
+        token = Token.create('a', self.db, {'worker': 'w', 'score': 1,
+                                            'tags': {'x'}})
+        self.assertTrue(59 < token.time_to_live() <= 60)
+        self.assertTrue(0 < self.db.pttl('token:{a}') <= 60000)
+        self.assertTrue(0 < self.db.pttl('token:{a}:tags') <= 60000)
+        token.persist()
+        self.assertEqual(token.time_to_live(), None)
+        # redis-py 2.8 reports keys without a time to live as None
+        self.assertIn(self.db.ttl('token:{a}:tags'), (None, -1))
+        Token.create_many([('b', {'worker': 'w', 'score': 2,
+                                  'tags': {'y'}})], self.db, ttl=0.05)
+        Token.create('c', self.db, {'score': 3}, ttl=0.05)
+        Token('c', self.db).sadd('tags', 'z')
+        time.sleep(0.1)
+        self.assertFalse(self.db.exists('token:{b}'))
+        self.assertFalse(Token.exists('b', self.db))
+        self.assertEqual(Token.exists_many(['a', 'b', 'c'], self.db),
+                         [True, False, False])
+        self.assertEqual(Token.range('score', '-inf', '+inf', self.db),
+                         ['a', 'b', 'c'])
+        self.assertEqual(Token.purge_expired(self.db, count=1), 2)
+        self.assertEqual(Token.members(self.db), {'a'})
+        self.assertEqual(Token.range('score', '-inf', '+inf', self.db),
+                         ['a'])
+        self.assertFalse(self.db.exists('token:{c}:tags'))
+        self.assertFalse(self.db.exists(Token._expiry_key))
+        # expired ids can be created again before they are purged
+        Token.create_many([('d', {'score': 4}), ('e', {'score': 5})],
+                          self.db, ttl=0.05)
+        Token('d', self.db).sadd('tags', 'z')
+        time.sleep(0.1)
+        self.assertRaises(KeyError, Token.create, 'a', self.db)
+        d = Token.create('d', self.db, {'worker': 'v'})
+        self.assertTrue(Token.exists('d', self.db))
+        self.assertEqual(d.hmget('worker', 'score'), ['v', None])
+        self.assertEqual(d.smembers('tags'), set())
+        self.assertEqual(Token.create_many([('e', {}), ('a', {})], self.db),
+                         ['a'])
+        self.assertEqual(Token.members(self.db), {'a', 'd', 'e'})
+        self.assertEqual(Token.range('score', '-inf', '+inf', self.db),
+                         ['a'])
+        self.assertEqual(Token.purge_expired(self.db), 0)
+        Token.delete_many(['d', 'e'], self.db)
+        token.expire(60)
+        token.delete()
+        self.assertFalse(self.db.exists(Token._expiry_key))
+        self.assertRaises(TypeError, Person.create, 'joe', self.db, ttl=1)
+        self.assertRaises(TypeError, Person('joe', self.db).expire, 1)
+        self.assertFalse(Person.exists('joe', self.db))
+
+    def test_hash_tags(self):
+        token = Token.create('a', self.db, {'worker': 'w', 'tags': {'x'}})
+        self.assertEqual(token._key, 'token:{a}')
+        self.assertEqual(self.db.smembers('token:{a}:tags'), {'x'})
+        self.assertEqual(Token._members_key, '{token}s')
+        self.assertEqual(Token._plans['score'].index, '{token}s:score')
+        self.assertEqual(Token._lookup_key('worker', 'w'), 'worker:{w}')
+        self.assertEqual(set(self.db.keys('token:*')),
+                         {'token:{a}', 'token:{a}:tags'})
+        self.assertEqual(Person._lookup_set_key('nicknames', 'jo'),
+                         'nicknames:jo:person')
+
+    def test_compact_ids(self):
+        joe = Owner.create('joe', self.db, {'nicknames': {'jo'}})
+        bob = Owner.create('bob', self.db, {'nicknames': {'jo'}})
+        pets = ['pet'+str(i) for i in range(10)]
+        Pet.create_many([(pet, {}) for pet in pets], self.db)
+        joe.sadd('pets', *pets)
+        self.assertEqual(joe.smembers('pets'), set(pets))
+        self.assertEqual(self.db.object('encoding', 'owner:joe:pets'),
+                         'intset')
+        self.assertTrue(all(member.isdigit() for member in
+                            self.db.smembers('owner:joe:pets')))
+        self.assertEqual(set(joe.iter_smembers('pets', count=3)), set(pets))
+        self.assertIn(joe.srandmember('pets'), pets)
+        self.assertEqual(Pet('pet3', self.db).hget('owner'), 'joe')
+        bob.sadd('pets', 'pet1')
+        Pet('pet2', self.db).hset('owner', bob)
+        self.assertEqual(bob.smembers('pets'), {'pet1', 'pet2'})
+        self.assertFalse(joe.sismember('pets', 'pet1'))
+        self.assertFalse(joe.sismember('pets', 'ghost'))
+        self.assertTrue(bob.sismember('pets', 'pet1'))
+        self.assertRaises(KeyError, joe.sadd, 'pets', 'ghost')
+        self.assertRaises(ValueError, joe.srem, 'pets', 'ghost')
+        joe.srem('pets', 'pet4')
+        self.assertEqual(Pet('pet4', self.db).hget('owner'), None)
+        self.assertEqual(joe.scard('pets'), 7)
+        tabby = Pet.create('tabby', self.db, {'feeders': {'joe', 'bob'}})
+        self.assertEqual(tabby.smembers('feeders'), {'joe', 'bob'})
+        self.assertEqual(joe.smembers('pets_to_feed'), {'tabby'})
+        self.assertEqual(self.db.object('encoding', 'pet:tabby:feeders'),
+                         'intset')
+        self.assertEqual(Owner.lookup('nicknames', 'jo', self.db),
+                         {'joe', 'bob'})
+        self.assertEqual(self.db.object('encoding', 'nicknames:jo:owner'),
+                         'intset')
+        self.assertEqual(Owner.load_many(['joe'], self.db,
+                                         ['pets'])[0]['pets'],
+                         joe.smembers('pets'))
+        joe.delete()
+        self.assertEqual(Pet('pet3', self.db).hget('owner'), None)
+        self.assertEqual(tabby.smembers('feeders'), {'bob'})
+        self.assertEqual(Owner.lookup('nicknames', 'jo', self.db), {'bob'})
+        bob.sremall('pets')
+        self.assertEqual(Pet('pet1', self.db).hget('owner'), None)
+        # delete drops the serial and a recreated id gets a new one
+        self.assertEqual(self.db.hget(Owner._serials_key, 'joe'), None)
+        self.assertEqual(self.db.hlen(Owner._ids_key), 2)
+        Owner.create('joe', self.db, {'pets_to_feed': {'tabby'}})
+        self.assertEqual(self.db.hget(Owner._serials_key, 'joe'), '3')
+        self.assertEqual(self.db.hget(Owner._ids_key, '3'), 'joe')
+        self.assertEqual(tabby.smembers('feeders'), {'joe', 'bob'})
+        bob.delete()
+        Pet.delete_many(pets, self.db)
+        self.assertEqual(set(self.db.hkeys(Owner._ids_key)), {'next', '3'})
+        self.assertEqual(self.db.hkeys(Pet._serials_key), ['tabby'])
+
+    def test_delete(self):
+        joe = Person.create('joe', self.db, {'age': 25, 'ssn': '123',
+                                             'emails': {'a@b.com'},
+                                             'nicknames': {'jo'}})
+        bob = Person.create('bob', self.db, {'nicknames': {'jo'}})
+        kitty = Cat.create('kitty', self.db, {'owner': joe,
+                                              'caretakers': {'joe', 'bob'}})
+        tabby = Cat.create('tabby', self.db, {'owner': joe})
+        joe.delete()
+        self.assertFalse(Person.exists('joe', self.db))
+        self.assertEqual(Person.lookup('ssn', '123', self.db), None)
+        self.assertEqual(Person.lookup('emails', 'a@b.com', self.db), None)
+        self.assertEqual(Person.lookup('nicknames', 'jo', self.db), {'bob'})
+        self.assertEqual(kitty.hget('owner'), None)
+        self.assertEqual(kitty.smembers('caretakers'), {'bob'})
+        self.assertEqual(tabby.hget('owner'), None)
+        self.assertEqual(self.db.keys('person:joe*'), [])
+
+    def test_delete_many(self):
+        for i in range(10):
+            Person.create(str(i), self.db, {'ssn': str(i)})
+            Cat.create('cat'+str(i), self.db, {'owner': Person(str(i),
+                                                                self.db)})
+        Person.delete_many([str(i) for i in range(8)], self.db, chunk_size=3)
+        self.assertEqual(Person.members(self.db), {'8', '9'})
+        self.assertEqual(Person.lookup('ssn', '3', self.db), None)
+        self.assertEqual(Person.lookup('ssn', '9', self.db), '9')
+        self.assertEqual(Cat('cat3', self.db).hget('owner'), None)
+        self.assertEqual(Cat('cat9', self.db).hget('owner'), '9')
+
+    def test_relation_updates(self):
+        joe = Person.create('joe', self.db)
+        bob = Person.create('bob', self.db)
+        cats = ['cat'+str(i) for i in range(20)]
+        for cat_id in cats:
+            Cat.create(cat_id, self.db)
+        joe.sadd('cats', *cats)
+        self.assertEqual(joe.smembers('cats'), set(cats))
+        self.assertEqual(Cat('cat3', self.db).hget('owner'), 'joe')
+        # stealing cats removes them from their previous owner
+        bob.sadd('cats', 'cat1', 'cat2')
+        self.assertEqual(joe.scard('cats'), 18)
+        self.assertEqual(Cat('cat1', self.db).hget('owner'), 'bob')
+        Cat('cat5', self.db).hset('owner', bob)
+        self.assertFalse(joe.sismember('cats', 'cat5'))
+        self.assertTrue(bob.sismember('cats', 'cat5'))
+        self.assertRaises(KeyError, joe.sadd, 'cats', 'ghost')
+        self.assertRaises(ValueError, joe.srem, 'cats', 'cat1')
+        joe.srem('cats', 'cat6', 'cat7')
+        self.assertEqual(Cat('cat6', self.db).hget('owner'), None)
+        self.assertEqual(joe.scard('cats'), 15)
+
+    def test_lookup_updates(self):
+        joe = Person.create('joe', self.db, {'ssn': '123',
+                                             'emails': {'a@b.com'}})
+        bob = Person.create('bob', self.db)
+        bob.hset('ssn', '123')
+        self.assertEqual(Person.lookup('ssn', '123', self.db), 'bob')
+        self.assertEqual(joe.hget('ssn'), None)
+        joe.hset('ssn', '456')
+        bob.hset('ssn', '789')
+        self.assertEqual(Person.lookup('ssn', '123', self.db), None)
+        bob.sadd('emails', 'a@b.com', 'c@d.com')
+        self.assertEqual(Person.lookup('emails', 'a@b.com', self.db), 'bob')
+        self.assertEqual(joe.smembers('emails'), set())
+        bob.srem('emails', 'a@b.com')
+        self.assertEqual(Person.lookup('emails', 'a@b.com', self.db), None)
@@ -25,8 +25,14 @@ import filecmp
 import pymongo
 import psutil
 import hashlib
+import io
+import gzip
+import threading
+import json
+import unittest.mock
 
 import siegetank.base
+import siegetank.util
 import tests.utils
 
 class TestSiegeTank(unittest.TestCase):
@@ -53,6 +59,7 @@ class TestSiegeTank(unittest.TestCase):
         time.sleep(3)
 
         result = tests.utils.add_user(manager=True)
+        self.token = result['token']
         siegetank.login(result['token'], '127.0.0.1:8980')
 
     def tearDown(self):
@@ -240,3 +247,191 @@ class TestSiegeTank(unittest.TestCase):
 
         target.delete()
         self.assertEqual(siegetank.list_targets(), [])
+
+    def test_add_streams(self):
+        options = {'description': 'siegetank_demo', 'steps_per_frame': 10000}
+        engines = ['openmm_60_opencl', 'openmm_60_cuda']
+        target = siegetank.base.add_target(options=options, engines=engines)
+        list_of_files = []
+        for i in range(25):
+            list_of_files.append({'system.xml': 'shared_system',
+                                  'integrator.xml.gz.b64': 'some_binary3',
+                                  'state.xml': 'state_'+str(i)})
+        siegetank.base.refresh_scvs()
+        random_scv = random.choice(list(siegetank.base.scvs.keys()))
+        streams = target.add_streams(list_of_files, random_scv, processes=2,
+                                      encode=True)
+        self.assertEqual(len(streams), len(list_of_files))
+        self.assertEqual(set(s.id for s in streams),
+                         set(s.id for s in target.streams))
+        for stream, files in zip(streams, list_of_files):
+            expected = siegetank.util.encode_files(files)
+            self.assertEqual(stream.download('files/state.xml'),
+                             expected['state.xml'].encode())
+            self.assertEqual(stream.download('files/system.xml'),
+                             expected['system.xml'].encode())
+        stream, = target.add_streams(list_of_files[:1], random_scv)
+        self.assertEqual(stream.download('files/state.xml'), b'state_0')
+        stream = target.add_stream(list_of_files[0], random_scv, dedup=True)
+        self.assertEqual(stream.download('files/integrator.xml.gz.b64'),
+                         b'some_binary3')
+        state = os.urandom(4096)
+        stream = target.add_stream({'state.xml': io.BytesIO(state)},
+                                   random_scv, encode=True, compresslevel=1)
+        content = stream.download('files/state.xml')
+        self.assertEqual(gzip.decompress(base64.b64decode(content)), state)
+        encoded = base64.b64encode(gzip.compress(state))
+        stream = target.add_stream({'state.xml.gz.b64': io.BytesIO(encoded)},
+                                   random_scv, encode=True)
+        self.assertEqual(stream.download('files/state.xml.gz.b64'), encoded)
+
+
+class TestUtil(unittest.TestCase):
+
+    sizes = (0, 1, siegetank.util.CHUNK_SIZE-1, siegetank.util.CHUNK_SIZE,
+             siegetank.util.CHUNK_SIZE+1)
+
+    def decode(self, encoded):
+        return gzip.decompress(base64.b64decode(encoded))
+
+    def test_encode_file(self):
+        for size in self.sizes:
+            data = os.urandom(size//2) + b'a'*(size-size//2)
+            encoded = siegetank.util.encode_file('state.xml', data)
+            self.assertEqual(self.decode(encoded), data)
+            self.assertEqual(siegetank.util.encode_file(
+                'state.xml', io.BytesIO(data), 9), encoded)
+            self.assertEqual(siegetank.util.encode_file(
+                'state.xml', bytearray(data), 9), encoded)
+            # chunks that are not a multiple of 3 carry bytes to the next
+            chunks = list(siegetank.util.iter_encode_file(
+                'state.xml', memoryview(data), chunk_size=4096+1))
+            self.assertEqual(b''.join(chunks).decode(), encoded)
+            encoded = siegetank.util.encode_file('state.xml.gz', data)
+            self.assertEqual(base64.b64decode(encoded), data)
+        self.assertEqual(self.decode(siegetank.util.encode_file(
+            'system.xml', 'system', 1)), b'system')
+        self.assertEqual(siegetank.util.encode_file('a.gz.b64', b'YQ=='),
+                         'YQ==')
+
+    def test_throughput(self):
+        stats = siegetank.util.Throughput()
+        self.assertEqual(stats.rate, 0.0)
+        for size in self.sizes:
+            data = b'a'*size
+            encoded = siegetank.util.encode_file('state.xml', data,
+                                                 stats=stats)
+            self.assertEqual(self.decode(encoded), data)
+        self.assertEqual(stats.bytes_in, sum(self.sizes))
+        self.assertEqual(stats.bytes_out,
+                         sum(len(siegetank.util.encode_file(
+                             'state.xml', b'a'*size)) for size in self.sizes))
+        self.assertGreater(stats.rate, 0)
+        self.assertIn('in:'+str(stats.bytes_in), repr(stats))
+
+    def test_iter_stream_body(self):
+        for size in self.sizes:
+            data = os.urandom(size)
+            files = {'state.xml': io.BytesIO(data),
+                     'system.xml.gz.b64': b'c3lz'}
+            body = b''.join(siegetank.util.iter_stream_body(
+                'target"1', files, tags={'pdb': 'x'}, compresslevel=1))
+            body = json.loads(body.decode())
+            self.assertEqual(body['target_id'], 'target"1')
+            self.assertEqual(self.decode(body['files']['state.xml']), data)
+            self.assertEqual(body['files']['system.xml.gz.b64'], 'c3lz')
+            self.assertEqual(self.decode(body['tags']['pdb']), b'x')
+        body = b''.join(siegetank.util.iter_stream_body('t', {}))
+        self.assertEqual(json.loads(body.decode()),
+                         {'target_id': 't', 'files': {}})
+
+    def test_share_files(self):
+        list_of_files = [{'system.xml': 'shared', 'state.xml': 'state_0'},
+                         {'system.xml': 'shared', 'state.xml': 'state_1'},
+                         {'system.xml': 'alone', 'other.xml': b'alone'}]
+        blobs, streams = siegetank.util.share_files(list_of_files)
+        shared = siegetank.util.hash_file('shared')
+        self.assertEqual(blobs, {shared: 'shared'})
+        self.assertEqual(streams[0], ({'state.xml': 'state_0'},
+                                      {'system.xml': shared}))
+        self.assertEqual(streams[1], ({'state.xml': 'state_1'},
+                                      {'system.xml': shared}))
+        # a file repeated within a single stream is not shared
+        self.assertEqual(streams[2], ({'system.xml': 'alone',
+                                       'other.xml': 'alone'}, {}))
+
+    def test_file_objects(self):
+        state = os.urandom(1000)
+        files = {'state.xml': io.BytesIO(state), 'system.xml': 'system'}
+        encoded, = siegetank.util.encode_files_many([files], processes=1)
+        self.assertEqual(gzip.decompress(base64.b64decode(
+            encoded['state.xml'])), state)
+        self.assertRaises(TypeError, siegetank.util.hash_file,
+                          io.BytesIO(state))
+        list_of_files = [{'state.xml': io.BytesIO(state)},
+                         {'state.xml': io.BytesIO(state)}]
+        blobs, streams = siegetank.util.share_files(list_of_files)
+        self.assertEqual(blobs, {siegetank.util.hash_file(state): state})
+
+
+class TestSCVDirectory(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSCVDirectory, self).setUp()
+        self.requests = []
+        self.release = threading.Event()
+        self.release.set()
+        self.reply = {'alpha': {'host': '127.0.0.1:8960'}}
+        patches = [unittest.mock.patch.object(siegetank.base, 'login_cc',
+                                              '127.0.0.1:8980', create=True),
+                   unittest.mock.patch('siegetank.base.requests.get',
+                                       side_effect=self.get)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def get(self, url, **kwargs):
+        self.requests.append((url, kwargs))
+        self.release.wait()
+        return unittest.mock.Mock(status_code=200,
+                                  **{'json.return_value': self.reply})
+
+    def test_ttl(self):
+        directory = siegetank.base.SCVDirectory(ttl=60, timeout=3)
+        self.assertEqual(directory.get(), self.reply)
+        self.assertEqual(directory.host('alpha'), '127.0.0.1:8960')
+        self.assertEqual(len(self.requests), 1)
+        url, kwargs = self.requests[0]
+        self.assertEqual(url, 'https://127.0.0.1:8980/scvs/status')
+        self.assertEqual(kwargs['timeout'], 3)
+        directory.invalidate()
+        directory.get()
+        self.assertEqual(len(self.requests), 2)
+
+    def test_concurrent_refresh(self):
+        directory = siegetank.base.SCVDirectory()
+        self.release.clear()
+        hosts = []
+        threads = [threading.Thread(
+            target=lambda: hosts.append(directory.host('alpha')))
+            for i in range(8)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(hosts, ['127.0.0.1:8960']*8)
+        self.assertEqual(len(self.requests), 1)
+
+    def test_unknown_scv(self):
+        directory = siegetank.base.SCVDirectory(ttl=60, min_interval=60)
+        directory.get()
+        # the last refresh is recent enough, so an unknown scv fails fast
+        for i in range(5):
+            self.assertRaises(KeyError, directory.host, 'beta')
+        self.assertEqual(len(self.requests), 1)
+        directory.min_interval = 0
+        self.reply = {'beta': {'host': '127.0.0.1:8961'}}
+        self.assertEqual(directory.host('beta'), '127.0.0.1:8961')
+        self.assertEqual(len(self.requests), 2)
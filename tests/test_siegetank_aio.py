@@ -0,0 +1,107 @@
+# Authors: Yutong Zhao <proteneer@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import asyncio
+import os
+import ssl
+import unittest
+
+from aiohttp import web
+
+import siegetank.aio
+
+PORT = 3859
+HOST = '127.0.0.1:'+str(PORT)
+CERTS = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..',
+                     'certs')
+
+
+class TestSession(unittest.TestCase):
+    """ Runs siegetank.aio against a fake cc and scv served on HOST """
+
+    def setUp(self):
+        super(TestSession, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.status_requests = 0
+        self.delay = 0
+        app = web.Application()
+        app.router.add_get('/users/verify', self.verify)
+        app.router.add_get('/scvs/status', self.scvs_status)
+        app.router.add_get('/streams/download/{stream_id}/{filename:.+}',
+                           self.download)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(os.path.join(CERTS, 'public.crt'),
+                                os.path.join(CERTS, 'private.pem'))
+        self.runner = web.AppRunner(app)
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, '127.0.0.1', PORT,
+                           ssl_context=context)
+        self.loop.run_until_complete(site.start())
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.runner.cleanup())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        super(TestSession, self).tearDown()
+
+    async def verify(self, request):
+        return web.Response(text='{}')
+
+    async def scvs_status(self, request):
+        self.status_requests += 1
+        await asyncio.sleep(0.1)
+        return web.json_response({'alpha': {'host': HOST}})
+
+    async def download(self, request):
+        await asyncio.sleep(self.delay)
+        return web.Response(text=request.match_info['filename'])
+
+    def test_login(self):
+        async def run():
+            async with siegetank.aio.Session('token', HOST) as session:
+                self.assertEqual(session.scvs, {'alpha': {'host': HOST}})
+                self.assertEqual(await session.scv_host('alpha'), HOST)
+        self.loop.run_until_complete(run())
+        self.assertEqual(self.status_requests, 1)
+
+    def test_scv_refresh(self):
+        async def run():
+            session = siegetank.aio.Session('token', HOST)
+            hosts = await asyncio.gather(
+                *[session.scv_host('alpha') for i in range(10)])
+            self.assertEqual(hosts, [HOST]*10)
+            with self.assertRaises(KeyError):
+                await session.scv_host('beta')
+            await session.close()
+        self.loop.run_until_complete(run())
+        self.assertEqual(self.status_requests, 1)
+
+    def test_queued_requests(self):
+        self.delay = 0.2
+
+        async def run():
+            async with siegetank.aio.Session('token', HOST, limit_per_host=2,
+                                             timeout=0.5) as session:
+                # each request is well within the timeout, though the
+                # last ones wait about a second for a connection
+                streams = [session.load_stream(str(i)+':alpha')
+                           for i in range(10)]
+                contents = await asyncio.gather(
+                    *[s.download('state.xml') for s in streams])
+                self.assertEqual(contents, [b'state.xml']*10)
+        self.loop.run_until_complete(run())
+
+if __name__ == '__main__':
+    unittest.main()